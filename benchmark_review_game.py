@@ -0,0 +1,310 @@
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import numpy
+
+from review_game import _generate_population, _generate_population_matrix, _calculate_sample_labels_oversample, \
+    _rate_population, _rate_population_matrix, _score_ratings, _sample_labels_calculator, _confusion_matrices, \
+    _score_confusion, _rated_group_sizes, _observe_population_matrix, simulate_ratings
+
+# The parameters a benchmark case can vary, and the values each one takes by default
+BENCHMARK_GRID = {
+    'population': [100, 10000, 1000000],
+    'group_size': [8, 64],
+    'num_bins': [3, 5, 9],
+    'repetitions': [1, 100],
+}
+
+# Cases that process more than this many employees (population x repetitions) are skipped
+MAX_EMPLOYEES_PER_CASE = 1000000
+
+# Throughput and peak memory may be this much worse than the baseline before `compare_results` flags a regression
+REGRESSION_THRESHOLD = .2
+
+
+def _even_bins(num_bins):
+    """
+    Rating bins that split the population into `num_bins` roughly equal bins
+
+    :param num_bins:
+    :return:
+    """
+    return [100 // num_bins] * (num_bins - 1)
+
+
+def _production(num_bins):
+    return [1 + .05 * label for label in range(0, num_bins)]
+
+
+def _population(population, num_bins):
+    return _generate_population(bins=_even_bins(num_bins), population_size=population, rng=random.Random(0))
+
+
+def _populations(population, num_bins, repetitions):
+    return _generate_population_matrix(bins=_even_bins(num_bins), population_size=population, entropy=0,
+                                       repetitions=range(0, repetitions))
+
+
+def _bench_generate_population(population, num_bins):
+    bins = _even_bins(num_bins)
+    rng = random.Random(0)
+    return lambda: _generate_population(bins=bins, population_size=population, rng=rng), population
+
+
+def _bench_generate_population_matrix(population, num_bins, repetitions):
+    bins = _even_bins(num_bins)
+    return lambda: _generate_population_matrix(bins=bins, population_size=population, entropy=0,
+                                               repetitions=range(0, repetitions)), population * repetitions
+
+
+def _bench_sample_labels_oversample(population, group_size, num_bins):
+    bins = _even_bins(num_bins)
+    return lambda: _calculate_sample_labels_oversample(sample_size=group_size, bins=bins,
+                                                       population_size=population), population
+
+
+def _bench_rate_population(population, group_size, num_bins):
+    members = _population(population, num_bins)
+    get_sample_labels = _sample_labels_calculator(population_size=population, bins=_even_bins(num_bins))
+    return lambda: _rate_population(population=members, sample_size=group_size,
+                                    get_sample_labels=get_sample_labels), population
+
+
+def _bench_rate_population_matrix(population, group_size, num_bins, repetitions):
+    populations = _populations(population, num_bins, repetitions)
+    get_sample_labels = _sample_labels_calculator(population_size=population, bins=_even_bins(num_bins))
+    return lambda: _rate_population_matrix(populations=populations, sample_size=group_size,
+                                           get_sample_labels=get_sample_labels), population * repetitions
+
+
+def _bench_rate_observations_matrix(population, group_size, num_bins, repetitions):
+    observations = _observe_population_matrix(populations=_populations(population, num_bins, repetitions), entropy=0,
+                                              repetitions=range(0, repetitions), observation_noise=.5)
+    get_sample_labels = _sample_labels_calculator(population_size=population, bins=_even_bins(num_bins))
+    return lambda: _rate_population_matrix(populations=observations, sample_size=group_size,
+                                           get_sample_labels=get_sample_labels, selection=True), \
+        population * repetitions
+
+
+def _bench_score_ratings(population, num_bins):
+    members = _population(population, num_bins)
+    ratings = list(reversed(members))
+    production = _production(num_bins)
+    return lambda: _score_ratings(population=members, ratings=ratings, production=production), population
+
+
+def _bench_score_confusion(population, num_bins, repetitions):
+    populations = _populations(population, num_bins, repetitions)
+    ratings = populations[:, ::-1].copy()
+    production = _production(num_bins)
+
+    def score():
+        confusion = _confusion_matrices(populations=populations, ratings=ratings, num_labels=num_bins)
+        return _score_confusion(confusion=confusion, num_bins=num_bins, productions=[production],
+                                payoffs=[(.5, 1.2, 1)])
+
+    return score, population * repetitions
+
+
+def _bench_simulate_ratings(population, group_size, num_bins, repetitions, **kwargs):
+    bins = _even_bins(num_bins)
+
+    # Calculate the sample labels up front, so only the simulation is timed
+    get_sample_labels = _sample_labels_calculator(population_size=population, bins=bins)
+    sample_labels = {size: get_sample_labels(sample_size=size)
+                     for size in _rated_group_sizes(population_size=population, sample_size=group_size)}
+
+    def simulate():
+        return simulate_ratings(performance_bins=bins, population_size=population, sample_sizes=[group_size],
+                                rating_bins=bins, payoffs=[(.5, 1.2, 1)], production=_production(num_bins),
+                                num_repetitions=repetitions, seed=0, sample_labels=sample_labels, **kwargs)
+
+    return simulate, population * repetitions
+
+
+# Stage => (the parameters of `BENCHMARK_GRID` the stage depends on, a function of those parameters that returns the
+# function to time and the number of employees it processes)
+BENCHMARK_STAGES = {
+    'generate_population': (['population', 'num_bins'], _bench_generate_population),
+    'generate_population_matrix': (['population', 'num_bins', 'repetitions'], _bench_generate_population_matrix),
+    'sample_labels_oversample': (['population', 'group_size', 'num_bins'], _bench_sample_labels_oversample),
+    'rate_population': (['population', 'group_size', 'num_bins'], _bench_rate_population),
+    'rate_population_matrix': (['population', 'group_size', 'num_bins', 'repetitions'],
+                               _bench_rate_population_matrix),
+    'rate_observations_matrix': (['population', 'group_size', 'num_bins', 'repetitions'],
+                                 _bench_rate_observations_matrix),
+    'score_ratings': (['population', 'num_bins'], _bench_score_ratings),
+    'score_confusion': (['population', 'num_bins', 'repetitions'], _bench_score_confusion),
+    'simulate_ratings_python': (['population', 'group_size', 'num_bins', 'repetitions'], _bench_simulate_ratings),
+    'simulate_ratings_numpy': (['population', 'group_size', 'num_bins', 'repetitions'],
+                               lambda **case: _bench_simulate_ratings(engine='numpy', **case)),
+    'simulate_ratings_hierarchical': (['population', 'group_size', 'num_bins', 'repetitions'],
+                                      lambda **case: _bench_simulate_ratings(hierarchical=True, **case)),
+}
+
+
+def benchmark_cases(grid=None, stages=None, max_employees=MAX_EMPLOYEES_PER_CASE):
+    """
+    Expands a grid of parameters into benchmark cases. Each stage only gets one case per combination of the parameters
+    it depends on
+
+    :param grid: Parameter => values, defaults to `BENCHMARK_GRID`
+    :param stages: The names of the stages to benchmark, defaults to all of `BENCHMARK_STAGES`
+    :param max_employees: Skip cases that process more employees than this
+    :return: A list of dicts of the stage name and its parameters
+    """
+    grid = dict(BENCHMARK_GRID, **(grid or {}))
+    unknown = set(stages or []) - set(BENCHMARK_STAGES)
+    if unknown:
+        raise ValueError("Unknown benchmark stages: {}".format(', '.join(sorted(unknown))))
+
+    cases = []
+    for stage in stages or BENCHMARK_STAGES:
+        parameters, _ = BENCHMARK_STAGES[stage]
+        for values in itertools.product(*[grid[parameter] for parameter in parameters]):
+            case = dict(zip(parameters, values))
+            if case['population'] * case.get('repetitions', 1) <= max_employees:
+                cases.append(dict(case, stage=stage))
+    return cases
+
+
+def run_case(case, rounds=3):
+    """
+    Times one benchmark case and measures its peak memory. The time is the best of `rounds` runs. Peak memory is
+    measured on a separate run with `tracemalloc`, which slows down the code it traces
+
+    :param case: A case from `benchmark_cases`
+    :param rounds:
+    :return: The case, with its time in seconds, employees processed per second and peak memory in bytes
+    """
+    _, setup = BENCHMARK_STAGES[case['stage']]
+    run, employees = setup(**{key: value for key, value in case.items() if key != 'stage'})
+
+    seconds = float('inf')
+    for _ in range(0, rounds):
+        start = time.perf_counter()
+        run()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(case, seconds=seconds, employees_per_second=employees / seconds if seconds else float('inf'),
+                peak_memory=peak_memory)
+
+
+def run_benchmarks(cases, rounds=3, log=None):
+    """
+    :param cases: Cases from `benchmark_cases`
+    :param rounds:
+    :param log: A file to report progress to
+    :return: A benchmark baseline: the environment and the result of every case
+    """
+    results = []
+    for case in cases:
+        result = run_case(case, rounds=rounds)
+        if log:
+            log.write("{} {}: {:,.0f} employees/s, {:,} bytes\n".format(
+                case['stage'], ' '.join('{}={}'.format(key, case[key]) for key in BENCHMARK_GRID if key in case),
+                result['employees_per_second'], result['peak_memory']))
+        results.append(result)
+
+    return {'python': platform.python_version(), 'numpy': numpy.__version__, 'results': results}
+
+
+def _case_key(case):
+    return tuple(sorted((key, value) for key, value in case.items() if key == 'stage' or key in BENCHMARK_GRID))
+
+
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """
+    Finds the cases that got slower or use more memory than in the baseline by more than `threshold`. Cases that are
+    only in one of the two are ignored
+
+    :param baseline: A result of `run_benchmarks`
+    :param current: A result of `run_benchmarks`
+    :param threshold: The acceptable relative change, e.g. .2 for 20%
+    :return: A list of (case, metric, baseline value, current value) regressions
+    """
+    baseline_results = {_case_key(result): result for result in baseline['results']}
+
+    regressions = []
+    for result in current['results']:
+        baseline_result = baseline_results.get(_case_key(result))
+        if baseline_result is None:
+            continue
+        case = {key: value for key, value in _case_key(result)}
+        if result['employees_per_second'] < baseline_result['employees_per_second'] * (1 - threshold):
+            regressions.append((case, 'employees_per_second', baseline_result['employees_per_second'],
+                                result['employees_per_second']))
+        if result['peak_memory'] > baseline_result['peak_memory'] * (1 + threshold):
+            regressions.append((case, 'peak_memory', baseline_result['peak_memory'], result['peak_memory']))
+    return regressions
+
+
+def main(args):
+    grid = {key: value for key, value in (('population', args.populations), ('group_size', args.group_sizes),
+                                          ('num_bins', args.bin_counts), ('repetitions', args.repetitions))
+            if value}
+    cases = benchmark_cases(grid=grid, stages=args.stages, max_employees=args.max_employees)
+
+    if args.command == 'run':
+        results = run_benchmarks(cases, rounds=args.rounds, log=sys.stderr)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if args.current:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        # Rerun the cases of the baseline that are in the grid
+        baseline_keys = {_case_key(result) for result in baseline['results']}
+        current = run_benchmarks([case for case in cases if _case_key(case) in baseline_keys], rounds=args.rounds,
+                                 log=sys.stderr)
+
+    regressions = compare_results(baseline, current, threshold=args.threshold)
+    for case, metric, baseline_value, current_value in regressions:
+        print("REGRESSION {}: {} {:,.0f} -> {:,.0f}".format(
+            ' '.join('{}={}'.format(key, value) for key, value in sorted(case.items())), metric, baseline_value,
+            current_value))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Times the stages of review_game.py and checks them against a saved baseline")
+
+    parser.add_argument("command", choices=['run', 'compare'],
+                        help="Run the benchmarks and save a baseline, or compare against a baseline")
+    parser.add_argument("baseline", nargs='?', help="The baseline to compare against")
+    parser.add_argument("--output", default='benchmark_baseline.json', help="Where `run` saves the results")
+    parser.add_argument("--current",
+                        help="Results to compare to the baseline instead of running the benchmarks again")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Flag cases whose throughput or peak memory is this much worse than the baseline")
+    parser.add_argument("--stages", nargs='+', choices=sorted(BENCHMARK_STAGES), help="The stages to benchmark")
+    parser.add_argument("--populations", type=int, nargs='+', help="Population sizes to benchmark")
+    parser.add_argument("--group-sizes", type=int, nargs='+', help="Stack ranking group sizes to benchmark")
+    parser.add_argument("--bin-counts", type=int, nargs='+', help="Numbers of rating bins to benchmark")
+    parser.add_argument("--repetitions", type=int, nargs='+', help="Numbers of repetitions to benchmark")
+    parser.add_argument("--max-employees", type=int, default=MAX_EMPLOYEES_PER_CASE,
+                        help="Skip cases that process more employees than this")
+    parser.add_argument("--rounds", type=int, default=3, help="Time each case this many times and keep the best")
+
+    args = parser.parse_args()
+    if args.command == 'compare' and not args.baseline:
+        parser.error("compare needs a baseline")
+
+    sys.exit(main(args))
@@ -1,84 +1,106 @@
 import matplotlib.pyplot as plt
-import math
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.collections import PolyCollection
 from review_game import _generate_population
 
+# The labels of the plotted population go from 0 up to, but not including, this
+MAX_LABEL = 5
+
 
 def main():
     counts = [8, 4, 2, 1]
     sizes = [8, 16, 32, 64]
 
-    for count, size in zip(counts, sizes):
-        rows = cols = count
-        sample_size = size
-        population = _generate_population(bins=[5, 10, 50, 25, 10], population_size=rows * cols * sample_size)
-
-        fig = draw_samples(population, sample_size, rows, cols)
-        fig.savefig('data/population_{}.eps'.format(size), format='eps')
-
-
-def draw_samples(population, sample_size, rows, cols):
-    fig, axs = plt.subplots(ncols=cols, nrows=rows, sharey=True, sharex=True, squeeze=False)
-    fig.set_size_inches(3, 3)
-    fig.text(.51, .91, 'Sample Size = {}'.format(sample_size), ha='center', va='center')
+    # Generate the populations up front, in order, so the workers don't all start from the same random state
+    populations = [_generate_population(bins=[5, 10, 50, 25, 10], population_size=count * count * size)
+                   for count, size in zip(counts, sizes)]
 
-    for i, row in enumerate(axs):
-        for j, ax in enumerate(row):
-            offset = i * (cols * sample_size) + j * sample_size
+    with ProcessPoolExecutor() as executor:
+        for future in [executor.submit(save_samples, population, size, count, count)
+                       for population, count, size in zip(populations, counts, sizes)]:
+            future.result()
 
-            sample = sorted([x + 0 for x in population[offset:offset + sample_size]])
-            average = round(sum(sample) / len(sample), 1)
 
-            # bars
-            ax.bar(range(0, sample_size), sample, align='edge', width=1, color='#c6d9ec')
-            ax.set_xlim(0, sample_size)
-            ax.set_ylim(0, 5)
-            ax.set_yticklabels([])
-            ax.set_xticklabels([])
-            ax.set_facecolor('#ecf2f9')
+def save_samples(population, sample_size, rows, cols):
+    fig = draw_samples(population, sample_size, rows, cols)
+    fig.savefig('data/population_{}.eps'.format(sample_size), format='eps')
+    plt.close(fig)
 
-            # average
-            ax.text(sample_size / 2, 5 / 2, average, ha='center', va='center', style='normal',
-                    fontdict={'fontweight': 500, 'color': '#000000', 'fontsize': 'smaller'})
 
-            for ax in row[:]:
-                ax.yaxis.set_visible(False)
-                ax.xaxis.set_visible(False)
+def _sample_grid(population, sample_size, rows, cols):
+    """
+    Splits the population into a grid of samples
 
-            fig.subplots_adjust(wspace=0, hspace=0)
-    return fig
+    :param population:
+    :param sample_size:
+    :param rows:
+    :param cols:
+    :return: A (rows x cols x sample_size) array of each sample sorted from low to high, and a (rows x cols) list of
+    lists of the sample averages, rounded to one decimal
+    """
+    samples = numpy.sort(numpy.asarray(population[:rows * cols * sample_size]).reshape(rows, cols, sample_size),
+                         axis=-1)
+    averages = [[round(int(total) / sample_size, 1) for total in row] for row in samples.sum(axis=-1)]
+    return samples, averages
 
 
-def draw_averages(population, sample_size, rows, cols):
-    fig, axs = plt.subplots(ncols=cols, nrows=rows, sharey=True, sharex=True, squeeze=False)
-    fig.set_size_inches(3, 3)
+def draw_samples(population, sample_size, rows, cols):
+    """
+    Draws a rows x cols grid of samples of the population, each sample as a box of sorted bars with its average on
+    top. The whole grid is one Axes: sample (i, j) covers x = j * sample_size .. (j + 1) * sample_size and
+    y = (rows - 1 - i) * MAX_LABEL .. (rows - i) * MAX_LABEL, its bars are one `PolyCollection` and the box borders
+    are grid lines, which is much faster to build and render than an Axes per sample.
+
+    :param population:
+    :param sample_size:
+    :param rows:
+    :param cols:
+    :return:
+    """
+    samples, averages = _sample_grid(population, sample_size, rows, cols)
+
+    fig = plt.figure(figsize=(3, 3))
     fig.text(.51, .91, 'Sample Size = {}'.format(sample_size), ha='center', va='center')
 
-    for i, row in enumerate(axs):
-        for j, ax in enumerate(row):
-            offset = i * (cols * sample_size) + j * sample_size
-
-            sample = sorted([x + 0 for x in population[offset:offset + sample_size]])
-            average = round(sum(sample) / len(sample), 1)
-
-            # bars
-            ax.bar(range(0, sample_size), sample, align='edge', width=1, color='#c6d9ec')
-            ax.set_xlim(0, sample_size)
-            ax.set_ylim(0, 5)
-            ax.set_yticklabels([])
-            ax.set_xticklabels([])
-            ax.set_facecolor('#ecf2f9')
-
-            # average
-            ax.text(sample_size / 2, 5 / 2, average, ha='center', va='center', style='normal',
+    # Where `plt.subplots` puts its grid of Axes
+    params = fig.subplotpars
+    ax = fig.add_axes([params.left, params.bottom, params.right - params.left, params.top - params.bottom])
+    ax.set_xlim(0, cols * sample_size)
+    ax.set_ylim(0, rows * MAX_LABEL)
+    ax.set_facecolor('#ecf2f9')
+    ax.xaxis.set_visible(False)
+    ax.yaxis.set_visible(False)
+
+    # bars, leaving out the empty ones
+    i, j, k = numpy.nonzero(samples)
+    left = j * sample_size + k
+    bottom = (rows - 1 - i) * MAX_LABEL
+    top = bottom + samples[i, j, k]
+    verts = numpy.stack([numpy.stack([left, bottom], axis=-1), numpy.stack([left + 1, bottom], axis=-1),
+                         numpy.stack([left + 1, top], axis=-1), numpy.stack([left, top], axis=-1)], axis=1)
+    ax.add_collection(PolyCollection(verts, facecolors='#c6d9ec', edgecolors='none', linewidths=0))
+
+    # box borders
+    ax.vlines(numpy.arange(1, cols) * sample_size, 0, rows * MAX_LABEL, colors=plt.rcParams['axes.edgecolor'],
+              linewidths=plt.rcParams['axes.linewidth'])
+    ax.hlines(numpy.arange(1, rows) * MAX_LABEL, 0, cols * sample_size, colors=plt.rcParams['axes.edgecolor'],
+              linewidths=plt.rcParams['axes.linewidth'])
+
+    # averages
+    centers_x = (numpy.arange(0, cols) + .5) * sample_size
+    centers_y = (rows - .5 - numpy.arange(0, rows)) * MAX_LABEL
+    for row_averages, y in zip(averages, centers_y):
+        for average, x in zip(row_averages, centers_x):
+            ax.text(x, y, average, ha='center', va='center', style='normal',
                     fontdict={'fontweight': 500, 'color': '#000000', 'fontsize': 'smaller'})
 
-            for ax in row[:]:
-                ax.yaxis.set_visible(False)
-                ax.xaxis.set_visible(False)
-
-            fig.subplots_adjust(wspace=0, hspace=0)
     return fig
 
 
+# The averages are drawn on top of every sample, so drawing them is the same as drawing the samples
+draw_averages = draw_samples
+
+
 if __name__ == '__main__':
     main()
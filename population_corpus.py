@@ -0,0 +1,111 @@
+import json
+import os
+import struct
+
+import numpy
+
+# The first bytes of every corpus file
+CORPUS_MAGIC = b'RGCORPUS'
+
+CORPUS_VERSION = 1
+
+# The populations start at a multiple of this many bytes into the file, after the header
+CORPUS_ALIGNMENT = 64
+
+# The magic, then the length of the JSON header as a little endian uint32
+_PREFIX = struct.Struct('<8sI')
+
+
+class PopulationCorpusWriter(object):
+    """
+    Writes a corpus of populations: one file with a JSON header of `metadata`, followed by a
+    (num_repetitions x population_size) uint8 matrix of labels, one population per row. Populations are appended in
+    chunks of rows, so they never need to be held in memory at once.
+
+    The corpus is written next to `path` and only moved into place by `close` once every row has been written, so an
+    interrupted corpus never looks finished.
+    """
+
+    def __init__(self, path, metadata, num_repetitions, population_size):
+        self.path = path
+        self.num_repetitions = num_repetitions
+        self.population_size = population_size
+        self.num_rows = 0
+
+        header = json.dumps(dict(metadata, version=CORPUS_VERSION, num_repetitions=num_repetitions,
+                                 population_size=population_size)).encode()
+        # Pad the header with spaces so the populations are aligned
+        header += b' ' * (-(_PREFIX.size + len(header)) % CORPUS_ALIGNMENT)
+        self._file = open(path + '.tmp', 'wb')
+        self._file.write(_PREFIX.pack(CORPUS_MAGIC, len(header)) + header)
+
+    def write(self, populations):
+        """
+        Appends a chunk of populations
+
+        :param populations: A (rows x population_size) matrix of labels below 256
+        :return:
+        """
+        populations = numpy.asarray(populations)
+        if populations.ndim != 2 or populations.shape[1] != self.population_size:
+            raise ValueError("Populations need to be rows of {} labels, not an array of shape {}".format(
+                self.population_size, populations.shape))
+        if self.num_rows + len(populations) > self.num_repetitions:
+            raise ValueError("The corpus only has room for {} populations".format(self.num_repetitions))
+        self._file.write(numpy.ascontiguousarray(populations, dtype=numpy.uint8).tobytes())
+        self.num_rows += len(populations)
+
+    def close(self):
+        self._file.close()
+        if self.num_rows != self.num_repetitions:
+            os.remove(self.path + '.tmp')
+            raise ValueError("Only {} of the {} populations of the corpus were written".format(self.num_rows,
+                                                                                             self.num_repetitions))
+        os.replace(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self.path + '.tmp')
+
+
+class PopulationCorpus(object):
+    """
+    Reads a corpus written by `PopulationCorpusWriter`. The populations are a read only `numpy.memmap`, so every
+    process that opens the same corpus shares the pages of the file through the operating system's page cache, and
+    reading a population doesn't copy it.
+
+    Example, the average label of the first population:
+
+    corpus = PopulationCorpus('populations.corpus')
+    print(corpus.metadata['performance_bins'], corpus.populations[0].mean())
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            prefix = f.read(_PREFIX.size)
+            if len(prefix) < _PREFIX.size or prefix[:len(CORPUS_MAGIC)] != CORPUS_MAGIC:
+                raise ValueError("{} isn't a population corpus".format(path))
+            _, header_length = _PREFIX.unpack(prefix)
+            metadata = json.loads(f.read(header_length).decode())
+        if metadata['version'] != CORPUS_VERSION:
+            raise ValueError("Unsupported population corpus version: {}".format(metadata['version']))
+
+        self.path = path
+        self.metadata = metadata
+        self.num_repetitions = metadata['num_repetitions']
+        self.population_size = metadata['population_size']
+        shape = (self.num_repetitions, self.population_size)
+        if self.num_repetitions and self.population_size:
+            self.populations = numpy.memmap(path, dtype=numpy.uint8, mode='r', offset=_PREFIX.size + header_length,
+                                            shape=shape)
+        else:
+            self.populations = numpy.empty(shape, dtype=numpy.uint8)
+
+    def __len__(self):
+        return self.num_repetitions
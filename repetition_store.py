@@ -0,0 +1,138 @@
+import json
+import os
+
+import numpy
+
+# The columns of a repetition store and their little endian dtypes. Each column is one raw binary file
+STORE_COLUMNS = [
+    ('configuration', '<u4'),
+    ('repetition', '<u4'),
+    ('score', '<f8'),
+    ('underestimates', '<u4'),
+    ('correct', '<u4'),
+    ('overestimates', '<u4'),
+]
+
+STORE_VERSION = 1
+
+_MANIFEST = 'manifest.json'
+
+
+def _column_path(path, name):
+    return os.path.join(path, '{}.bin'.format(name))
+
+
+class RepetitionStoreWriter(object):
+    """
+    Writes one record per repetition and configuration to a columnar store: a directory with a raw binary file per
+    column in `STORE_COLUMNS`, and a manifest of the configurations and the number of records. Records are appended in
+    chunks, so the records never need to be held in memory at once.
+
+    The manifest is only written by `close`, so a store that was interrupted while being written can't be opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.num_rows = 0
+        self.configurations = []
+        self._configuration_ids = {}
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, _MANIFEST)):
+            os.remove(os.path.join(path, _MANIFEST))
+        self._files = {name: open(_column_path(path, name), 'wb') for name, _ in STORE_COLUMNS}
+
+    def configuration_id(self, configuration):
+        """
+        :param configuration: A tuple of numbers
+        :return: The id of the configuration in the store, adding it if it's new
+        """
+        configuration = tuple(configuration)
+        if configuration not in self._configuration_ids:
+            self._configuration_ids[configuration] = len(self.configurations)
+            self.configurations.append(configuration)
+        return self._configuration_ids[configuration]
+
+    def write(self, **columns):
+        """
+        Appends a chunk of records
+
+        :param columns: Column name => equally long arrays, for every column in `STORE_COLUMNS`
+        :return:
+        """
+        if set(columns) != {name for name, _ in STORE_COLUMNS}:
+            raise ValueError("Records need exactly the columns {}".format(', '.join(name for name, _ in STORE_COLUMNS)))
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError("Columns of different lengths: {}".format(sorted(lengths)))
+
+        for name, dtype in STORE_COLUMNS:
+            self._files[name].write(numpy.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+        self.num_rows += lengths.pop() if lengths else 0
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+        manifest = {'version': STORE_VERSION, 'num_rows': self.num_rows, 'columns': STORE_COLUMNS,
+                    'configurations': [list(configuration) for configuration in self.configurations]}
+        manifest_path = os.path.join(self.path, _MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self._files.values():
+                f.close()
+
+
+class RepetitionStore(object):
+    """
+    Reads a store written by `RepetitionStoreWriter`. Every column is a read only `numpy.memmap`, so selecting,
+    slicing and reducing them only pages in the parts of the files that are used.
+
+    Example, the 90th percentile score of every configuration:
+
+    store = RepetitionStore('runs')
+    for configuration_id, configuration in enumerate(store.configurations):
+        print(configuration, numpy.percentile(store['score'][store['configuration'] == configuration_id], 90))
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, _MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest['version'] != STORE_VERSION:
+            raise ValueError("Unsupported repetition store version: {}".format(manifest['version']))
+
+        self.path = path
+        self.num_rows = manifest['num_rows']
+        self.configurations = [tuple(configuration) for configuration in manifest['configurations']]
+        self.columns = {}
+        for name, dtype in manifest['columns']:
+            if self.num_rows:
+                self.columns[name] = numpy.memmap(_column_path(path, name), dtype=dtype, mode='r',
+                                                  shape=(self.num_rows,))
+            else:
+                self.columns[name] = numpy.empty(0, dtype=dtype)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def chunks(self, rows_per_chunk=1 << 20):
+        """
+        Scans the records in order without copying them
+
+        :param rows_per_chunk:
+        :return: Yields column name => a view of the next `rows_per_chunk` records of the column
+        """
+        for start in range(0, self.num_rows, rows_per_chunk):
+            yield {name: values[start:start + rows_per_chunk] for name, values in self.columns.items()}
@@ -1,8 +1,84 @@
+import bisect
 import csv
+import json
+import os
 import random
-from argparse import ArgumentParser
+import time
+import tracemalloc
+from argparse import ArgumentParser, ArgumentTypeError
 from collections import defaultdict
-from sys import stdout
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
+from statistics import NormalDist
+from sys import stdout, stderr
+
+import numpy
+
+from population_corpus import PopulationCorpus, PopulationCorpusWriter
+from repetition_store import RepetitionStoreWriter
+
+# Ways of mapping a position in a sorted stack ranking group to a rating. See `_sample_labels_calculator`
+SAMPLE_LABEL_STRATEGIES = ['quantile', 'oversample', 'monte-carlo']
+
+# Ways of simulating repetitions. See `simulate_ratings`
+ENGINES = ['python', 'numpy']
+
+# Repetitions are simulated in chunks of this many. A chunk is the unit of work handed to a worker process
+REPETITIONS_PER_CHUNK = 256
+
+# Ways of generating the populations of the repetitions. See `simulate_ratings`
+VARIANCE_REDUCTION_SCHEMES = ['none', 'stratified', 'antithetic']
+
+# The number of repetitions in each stratified design. See `_repetition_strata`
+STRATIFIED_BLOCK_SIZE = 32
+
+# Repetitions that aren't independent of each other are summarized together, as one sample. Chunks hold a whole
+# number of samples
+REPETITIONS_PER_SAMPLE = {'none': 1, 'stratified': STRATIFIED_BLOCK_SIZE, 'antithetic': 2}
+
+# Random stream of the population each sample size rates without common random numbers. See `_repetition_seed_sequence`
+INDEPENDENT_GROUPS_STREAM = 1
+
+# Random stream of the strata of the stratified variance reduction. See `_repetition_strata`
+STRATIFICATION_STREAM = 2
+
+# Random stream of the managers' observations of a population. See `_observe_population_matrix`
+OBSERVATION_STREAM = 3
+
+# The most repetitions of the plain run used to report the effective variance reduction
+VARIANCE_REDUCTION_PILOT_REPETITIONS = 1000
+
+# Version of the file format of `write_shard`
+SHARD_VERSION = 1
+
+# Version of the file format of `write_state`
+STATE_VERSION = 1
+
+# The command line arguments that don't change the results, so the shards of one experiment can differ in them
+SHARD_EXCLUDED_ARGUMENTS = {'workers', 'profile', 'store', 'shard', 'shard_file', 'merge', 'payoffs_file',
+                            'productions_file', 'generate_corpus', 'state'}
+
+# Hierarchical ratings stream through each population in chunks of about this many employees, rounded to a whole
+# number of top level groups. See `_simulate_repetitions_hierarchical`
+HIERARCHY_CHUNK_SIZE = 2 ** 20
+
+# The most trace events a `_Profiler` keeps. Later events are only counted, so long runs stay cheap to profile
+MAX_TRACE_EVENTS = 100000
+
+# The most bin distributions to keep the `_AliasSampler` of
+BIN_SAMPLER_CACHE_SIZE = 256
+
+# The number of columns of an `_AliasSampler`, and so the most labels it can draw. Draws pick the column with the top
+# 8 of 32 random bits, and split it with the other ALIAS_FRACTION_BITS
+ALIAS_COLUMNS = 256
+ALIAS_FRACTION_BITS = 24
+
+# How far from 100 the percentages of a distribution can add up to, so rounding doesn't add a bin
+BIN_PERCENTAGE_TOLERANCE = 1e-9
+
+# The most population corpora each process keeps mapped. See `_open_corpus`
+CORPUS_CACHE_SIZE = 16
 
 
 def _map_bins_to_labels(bins):
@@ -21,18 +97,165 @@ def _map_bins_to_labels(bins):
     :param bins: A list of integers from 0-100. Each value specifies how many times the label for the bin is repeated
     :return:
     """
-    labels = [len(bins)] * 100
-    label = 0
-    i = 0
-    for bin in bins:
-        for _ in range(0, bin):
-            labels[i] = label
-            i += 1
-        label += 1
-
+    labels = []
+    for label, probability in enumerate(_bin_probabilities(bins)):
+        labels += [label] * int(round(probability * 100))
     return labels
 
 
+def _bin_probabilities(bins):
+    """
+    The probability of each label in the distribution specified by `bins`. Like `_map_bins_to_labels`, any percentage
+    not covered by `bins` goes to a new label. Unlike it, the percentages don't have to be whole, e.g. a top bin of 0.5
+
+    :param bins:
+    :return:
+    """
+    if any(bin < 0 for bin in bins) or sum(bins) > 100 + BIN_PERCENTAGE_TOLERANCE:
+        raise ValueError("Bins must be percentages that add up to at most 100: {}".format(list(bins)))
+    probabilities = [bin / 100 for bin in bins]
+    if sum(bins) < 100 - BIN_PERCENTAGE_TOLERANCE or not bins:
+        probabilities.append((100 - sum(bins)) / 100)
+    return numpy.array(probabilities)
+
+
+def _num_bins(bins):
+    """
+    The number of labels in the distribution specified by `bins`, up to the last one that can occur
+
+    :param bins:
+    :return:
+    """
+    return int(numpy.flatnonzero(_bin_probabilities(bins))[-1]) + 1
+
+
+class _AliasSampler(object):
+    """
+    Draws labels from a discrete distribution in constant time, with the alias tables of Walker's method as built by
+    Vose. The distribution is split into `ALIAS_COLUMNS` equally likely columns: column i is label i with probability
+    `probabilities[i]`, and label `aliases[i]` otherwise. There are far more columns than labels, and the columns past
+    the last label are all alias, so most draws are a single table lookup. A draw takes one uniform random number,
+    whose top bits pick the column and whose remaining bits pick between the label and its alias.
+
+    Alias draws don't grow with the random number, so antithetic pairs are drawn with `draw_inverse` and
+    `fill_inverse` instead, which invert the cumulative distribution.
+    """
+
+    def __init__(self, weights):
+        weights = numpy.asarray(weights, dtype=float)
+        if not len(weights) or numpy.any(weights < 0) or not weights.sum() > 0:
+            raise ValueError("Weights must be non negative, and not all 0: {}".format(weights.tolist()))
+        if len(weights) > ALIAS_COLUMNS:
+            raise ValueError("At most {} labels can be sampled, not {}".format(ALIAS_COLUMNS, len(weights)))
+
+        scaled = numpy.zeros(ALIAS_COLUMNS)
+        scaled[:len(weights)] = weights * ALIAS_COLUMNS / weights.sum()
+        probabilities = numpy.ones(ALIAS_COLUMNS)
+        aliases = numpy.arange(ALIAS_COLUMNS)
+        small = [label for label in range(0, ALIAS_COLUMNS) if scaled[label] < 1]
+        large = [label for label in range(0, ALIAS_COLUMNS) if scaled[label] >= 1]
+        while small and large:
+            label, alias = small.pop(), large.pop()
+            probabilities[label] = scaled[label]
+            aliases[label] = alias
+            # The alias gives the rest of the column to the label, so it has that much less left for its own column
+            scaled[alias] -= 1 - scaled[label]
+            (small if scaled[alias] < 1 else large).append(alias)
+        # Whatever is left is 1 up to rounding, and keeps its whole column
+
+        self.num_labels = len(weights)
+        self.probabilities = probabilities
+        self.aliases = aliases.astype(numpy.uint8)
+        self.cumulative = numpy.cumsum(weights) / weights.sum()
+        # The columns of the labels, as fractions of 2^ALIAS_FRACTION_BITS, for `fill`
+        self._thresholds = numpy.round(probabilities[:self.num_labels] * 2 ** ALIAS_FRACTION_BITS).astype(numpy.uint32)
+        # Plain python copies for single draws, which are faster to index than arrays
+        self._probabilities = probabilities.tolist()
+        self._aliases = aliases.tolist()
+        self._cumulative = self.cumulative.tolist()
+
+    def draw(self, rng=random):
+        """
+        :param rng: A `random.Random`, or the random module
+        :return: One label
+        """
+        u = rng.random() * ALIAS_COLUMNS
+        column = int(u)
+        if column < self.num_labels and u - column < self._probabilities[column]:
+            return column
+        return self._aliases[column]
+
+    def fill(self, out, rng=random):
+        """
+        Fills `out` with independent draws.
+
+        With a `numpy.random.Generator`, `out` is filled in bulk. Each draw takes 32 random bits, and the bits are
+        taken from `ceil(len(out) / 2)` raw 64 bit words, so filling consecutive buffers of even lengths draws the same
+        labels as filling them at once. Probabilities are exact to within 2^-32.
+
+        :param out: The list or array to fill, e.g. a uint8 population
+        :param rng: A `numpy.random.Generator`, or a `random.Random` or the random module to fill one draw at a time
+        :return:
+        """
+        if not isinstance(rng, numpy.random.Generator):
+            for i in range(0, len(out)):
+                out[i] = self.draw(rng)
+            return
+
+        bits = rng.bit_generator.random_raw(-(-len(out) // 2)).view(numpy.uint32)[:len(out)]
+        # Indexing the table with uint8 columns is much faster than with wider integers
+        columns = (bits >> ALIAS_FRACTION_BITS).astype(numpy.uint8)
+        out[:] = self.aliases[columns]
+        # Only the columns of the labels themselves are split between two labels
+        split = numpy.flatnonzero(columns < self.num_labels)
+        split_columns = columns[split]
+        out[split] = numpy.where(bits[split] & (2 ** ALIAS_FRACTION_BITS - 1) < self._thresholds[split_columns],
+                                 split_columns, self.aliases[split_columns])
+
+    def draw_inverse(self, rng=random, antithetic=False):
+        """
+        One label, by inverting the cumulative distribution at a random number `u`, or at `1 - u` if `antithetic`.
+        The draws from the same `rng` state with and without `antithetic` are an antithetic pair
+
+        :param rng: A `random.Random`, or the random module
+        :param antithetic:
+        :return:
+        """
+        u = rng.random()
+        return min(bisect.bisect_right(self._cumulative, 1 - u if antithetic else u), self.num_labels - 1)
+
+    def fill_inverse(self, out, rng, antithetic=False):
+        """
+        Batched version of `draw_inverse`. Takes one random double per draw, so filling consecutive buffers draws the
+        same labels as filling them at once
+
+        :param out: The array to fill
+        :param rng: A `numpy.random.Generator`
+        :param antithetic:
+        :return:
+        """
+        u = rng.random(len(out))
+        if antithetic:
+            u = 1 - u
+        out[:] = numpy.minimum(numpy.searchsorted(self.cumulative, u, side='right'), self.num_labels - 1)
+
+
+@lru_cache(maxsize=BIN_SAMPLER_CACHE_SIZE)
+def _cached_bin_sampler(bins):
+    return _AliasSampler(_bin_probabilities(bins))
+
+
+def _bin_sampler(bins):
+    """
+    The `_AliasSampler` of the distribution specified by `bins`. Samplers are cached, so their tables are only built
+    once per distribution
+
+    :param bins:
+    :return:
+    """
+    return _cached_bin_sampler(tuple(bins))
+
+
 def _calculate_sample_label_monte_carlos(sample_size, bins):
     """
     Creates a mapping between position in a sample of `sample_size` and a rating distribution defined by `bins`
@@ -81,24 +304,174 @@ def _calculate_sample_labels_oversample(sample_size, bins, population_size=10000
     return sample_labels
 
 
-def _generate_population(bins, population_size):
+def _calculate_sample_labels_quantile(sample_size, bins):
+    """
+    Creates a mapping between position in a sample of `sample_size` and a rating distribution defined by `bins`
+
+    This is the exact, deterministic limit of `_calculate_sample_labels_oversample` as its population grows: position
+    `i` of the sample sits at the `(i + 0.5) / sample_size` quantile of the distribution, so its label is the first bin
+    whose cumulative percentage is above that quantile. Like `_map_bins_to_labels`, any percentage not covered by
+    `bins` gets a new label.
+
+    Example:
+
+    sample_size = 10, bins = [10, 20]
+      quantiles 5%, 15%, 25%, ..., 95% => [0] + [1]*2 + [2]*7
+
+    :param sample_size:
+    :param bins:
+    :return:
+    """
+    sample_labels = []
+    cumulative_percentage = 0
+    label = 0
+    for i in range(0, sample_size):
+        # Compare `cumulative_percentage <= 100 * (i + 0.5) / sample_size` without dividing
+        while label < len(bins) and (cumulative_percentage + bins[label]) * sample_size <= (2 * i + 1) * 50:
+            cumulative_percentage += bins[label]
+            label += 1
+        sample_labels.append(label)
+
+    return sample_labels
+
+
+def _generate_population(bins, population_size, rng=random, antithetic=None):
     """
     Generates a population of `population_size` with the ratings distribution specified by `bins`.
 
     :param bins:
     :param population_size:
+    :param rng: The source of randomness. Defaults to the global random module
+    :param antithetic: None to draw every member independently with the distribution's `_AliasSampler`. False or True
+    to draw the first or the second population of an antithetic pair: the populations from the same `rng` state with
+    False and True mirror each other, where one has a top performer, the other has a bottom performer
     :return:
     """
-    range_labels = _map_bins_to_labels(bins=bins)
-    population = []
+    sampler = _bin_sampler(bins)
+    if antithetic is not None:
+        return [sampler.draw_inverse(rng, antithetic) for _ in range(0, population_size)]
+    population = [0] * population_size
+    sampler.fill(population, rng)
+    return population
+
+
+def _stratified_counts(bins, population_size, strata):
+    """
+    Draws how many members of a population of `population_size` have each label in the distribution specified by
+    `bins`, by inverting the distribution of the counts at the random numbers in `strata`.
+
+    The counts are multinomial, which is a chain of binomials: the count of label 0 is Binomial(population_size, p0),
+    the count of label 1 is Binomial(population_size - count 0, p1 / (1 - p0)), and so on. Each binomial is drawn by
+    inverting its CDF at one number from `strata`. Uniform `strata` give exactly multinomial counts, and spreading the
+    `strata` of a set of repetitions evenly over [0, 1) spreads their counts evenly around the expected counts.
+
+    :param bins:
+    :param population_size:
+    :param strata: One random number in [0, 1) per label, except the last
+    :return: A list of counts, one per label
+    """
+    counts = []
+    remaining = population_size
+    remaining_probability = 1.0
+    for probability, stratum in zip(_bin_probabilities(bins)[:-1], strata):
+        p = min(probability / remaining_probability, 1) if remaining_probability > 0 else 0
+        count = int(numpy.searchsorted(1 - _binomial_survival(remaining, p), stratum, side='right'))
+        counts.append(count)
+        remaining -= count
+        remaining_probability -= probability
+    counts.append(remaining)
+    return counts
+
+
+def _repetition_strata(entropy, repetition, rng, dimensions):
+    """
+    Stratified random numbers for `_stratified_counts`. Each block of `STRATIFIED_BLOCK_SIZE` repetitions is a Latin
+    hypercube: in every dimension, each repetition of the block gets its own 1 / STRATIFIED_BLOCK_SIZE wide stratum of
+    [0, 1), and a uniform position within it. Every repetition on its own still gets uniform random numbers.
+
+    :param entropy:
+    :param repetition:
+    :param rng: The repetition's source of randomness, for the positions within the strata
+    :param dimensions:
+    :return: A list of `dimensions` numbers in [0, 1)
+    """
+    block, position = divmod(repetition, STRATIFIED_BLOCK_SIZE)
+    block_rng = numpy.random.default_rng(_repetition_seed_sequence(entropy, block, (STRATIFICATION_STREAM,)))
+    return [(block_rng.permutation(STRATIFIED_BLOCK_SIZE)[position] + rng.random()) / STRATIFIED_BLOCK_SIZE
+            for _ in range(0, dimensions)]
+
+
+def _generate_population_stratified(bins, population_size, strata, rng=random):
+    """
+    Generates a population of `population_size` with bin counts drawn by `_stratified_counts` at `strata`, and the
+    members of the bins placed randomly.
 
-    # Apply the `range_labels` to `population_size` random numbers between 0-100
-    for _ in range(0, population_size):
-        bin = range_labels[random.randint(0, len(range_labels) - 1)]
-        population.append(bin)
+    :param bins:
+    :param population_size:
+    :param strata:
+    :param rng: The source of randomness. Defaults to the global random module
+    :return:
+    """
+    counts = _stratified_counts(bins=bins, population_size=population_size, strata=strata)
+    population = [label for label, count in enumerate(counts) for _ in range(0, count)]
+    rng.shuffle(population)
     return population
 
 
+def _generate_population_matrix(bins, population_size, entropy, repetitions, variance_reduction='none',
+                                stream=()):
+    """
+    Generates the populations of `repetitions`, one population per row, with the ratings distribution specified by
+    `bins`. Each row is drawn from its repetition's random stream, see `_repetition_stream`.
+
+    :param bins:
+    :param population_size:
+    :param entropy:
+    :param repetitions: The indexes of the repetitions to generate
+    :param variance_reduction: One of `VARIANCE_REDUCTION_SCHEMES`
+    :param stream:
+    :return: A (len(repetitions) x population_size) uint8 matrix of labels
+    """
+    sampler = _bin_sampler(bins)
+    populations = numpy.empty((len(repetitions), population_size), dtype=numpy.uint8)
+    for row, repetition in zip(populations, repetitions):
+        seed_sequence, antithetic = _repetition_stream(entropy, repetition, variance_reduction, stream)
+        rng = numpy.random.default_rng(seed_sequence)
+        if variance_reduction == 'stratified':
+            strata = _repetition_strata(entropy, repetition, rng, dimensions=len(_bin_probabilities(bins)) - 1)
+            counts = _stratified_counts(bins=bins, population_size=population_size, strata=strata)
+            row[:] = rng.permutation(numpy.repeat(numpy.arange(0, len(counts), dtype=numpy.uint8), counts))
+        elif variance_reduction == 'antithetic':
+            sampler.fill_inverse(row, rng, antithetic)
+        else:
+            sampler.fill(row, rng)
+    return populations
+
+
+def _observe_population_matrix(populations, entropy, repetitions, observation_noise, stream=()):
+    """
+    What managers observe of the performance of `populations`. Every member has a continuous latent performance: their
+    label plus where they fall within their performance bin, uniformly between 0 and 1. Managers see the latent
+    performance plus normal noise with a standard deviation of `observation_noise` performance bins. Each row is drawn
+    from its own random stream, see `_repetition_seed_sequence`.
+
+    :param populations: A (len(repetitions) x population_size) matrix of labels
+    :param entropy:
+    :param repetitions: The indexes of the repetitions of the rows
+    :param observation_noise:
+    :param stream: The stream the populations were generated from
+    :return: A float32 matrix of observations with the same shape as `populations`
+    """
+    observations = numpy.empty(populations.shape, dtype=numpy.float32)
+    for row, population, repetition in zip(observations, populations, repetitions):
+        rng = numpy.random.default_rng(_repetition_seed_sequence(entropy, repetition,
+                                                                 (OBSERVATION_STREAM,) + tuple(stream)))
+        rng.random(out=row, dtype=numpy.float32)
+        row += population
+        row += rng.standard_normal(len(row), dtype=numpy.float32) * numpy.float32(observation_noise)
+    return observations
+
+
 def _rate_population(population, sample_size, get_sample_labels):
     """
     Goes through the population and applies ratings to the population usings groups of size `sample_size`
@@ -145,6 +518,99 @@ def _rate_population(population, sample_size, get_sample_labels):
     return ratings
 
 
+def _rate_population_matrix(populations, sample_size, get_sample_labels, selection=False):
+    """
+    Batched version of `_rate_population` that rates every row of `populations` using groups of size `sample_size`.
+
+    All the full groups of every row are ranked at once by reshaping to (rows x groups x sample_size) and doing a
+    stable argsort along the last axis, which breaks ties the same way `_rate_population` does. The final group of a
+    row may be smaller than `sample_size` and is ranked separately with its own sample labels.
+
+    With `selection`, groups aren't sorted. The sample labels only change value at a few positions, so it's enough to
+    partition every group around those positions with `numpy.argpartition`, which takes time linear in the group size.
+    Members with equal values may swap ratings, so this is for continuous values like `_observe_population_matrix`.
+
+    :param populations: A (num_repetitions x population_size) matrix of labels, or of observations with `selection`
+    :param sample_size:
+    :param get_sample_labels:
+    :param selection: Rank by quantile selection instead of sorting
+    :return: A matrix of ratings with the same shape as `populations`. uint8 unless `populations` are integers
+    """
+    num_repetitions, population_size = populations.shape
+    dtype = populations.dtype if numpy.issubdtype(populations.dtype, numpy.integer) else numpy.uint8
+    ratings = numpy.empty(populations.shape, dtype=dtype)
+
+    num_groups = population_size // sample_size
+    full_size = num_groups * sample_size
+
+    def rate_groups(groups, group_size):
+        # Position k of a group sorted from low to high gets the k-th label of the (low to high) lookup table
+        labels = numpy.asarray(get_sample_labels(sample_size=group_size), dtype=dtype)
+        if selection:
+            # Only the positions where the label changes need to be in sorted place
+            order = numpy.argpartition(groups, numpy.flatnonzero(labels[1:] != labels[:-1]) + 1, axis=-1)
+        else:
+            order = numpy.argsort(groups, axis=-1, kind='stable')
+        group_ratings = numpy.empty(groups.shape, dtype=dtype)
+        numpy.put_along_axis(group_ratings, order, numpy.broadcast_to(labels, groups.shape), axis=-1)
+        return group_ratings
+
+    if num_groups:
+        groups = populations[:, :full_size].reshape(num_repetitions, num_groups, sample_size)
+        ratings[:, :full_size] = rate_groups(groups, sample_size).reshape(num_repetitions, full_size)
+
+    # The last group may be smaller than `sample_size`, so it needs a different set of sample labels
+    if full_size < population_size:
+        ratings[:, full_size:] = rate_groups(populations[:, full_size:], population_size - full_size)
+
+    return ratings
+
+
+def _confusion_matrix(population, ratings, num_labels):
+    """
+    Counts how many members of the population with each true label got each rating.
+
+    :param population:
+    :param ratings:
+    :param num_labels: The number of labels, large enough for both the true labels and the ratings
+    :return: A (num_labels x num_labels) list of lists. Row is the true label, column is the rating
+    """
+    confusion = [[0] * num_labels for _ in range(0, num_labels)]
+    for employee, rating in zip(population, ratings):
+        confusion[employee][rating] += 1
+    return confusion
+
+
+def _confusion_matrices(populations, ratings, num_labels):
+    """
+    Batched version of `_confusion_matrix` that counts every row of `populations` separately.
+
+    :param populations: A (num_repetitions x population_size) matrix of labels
+    :param ratings: A matrix of ratings with the same shape as `populations`
+    :param num_labels: The number of labels, large enough for both the true labels and the ratings
+    :return: A (num_repetitions x num_labels x num_labels) matrix of counts
+    """
+    codes = populations.astype(numpy.intp) * num_labels + ratings
+    confusion = numpy.empty((len(codes), num_labels * num_labels), dtype=numpy.int64)
+    for row, row_codes in zip(confusion, codes):
+        row[:] = numpy.bincount(row_codes, minlength=num_labels * num_labels)
+    return confusion.reshape(len(codes), num_labels, num_labels)
+
+
+def _get_rating_accuracy_by_bin(confusion):
+    """
+    Reduces confusion matrices to how many members of each true performance bin were underestimated, correctly rated
+    and overestimated.
+
+    :param confusion: A (... x num_labels x num_labels) matrix of counts from `_confusion_matrices`
+    :return: A (... x num_labels x 3) matrix of (underestimate, correct, overestimate) counts
+    """
+    confusion = numpy.asarray(confusion)
+    return numpy.stack([numpy.tril(confusion, -1).sum(axis=-1),
+                        numpy.diagonal(confusion, axis1=-2, axis2=-1),
+                        numpy.triu(confusion, 1).sum(axis=-1)], axis=-1)
+
+
 def _score_ratings(population, ratings, production, correct_score=100, underestimate_score=-100,
                    over_estimate_score=50):
     """
@@ -192,100 +658,1748 @@ def _get_rating_accuracy_stats(population, ratings):
     return num_underestimates, num_correct, num_overestimates
 
 
-def calculate_monte_carlo_stats(scores, rating_accuracy):
+class _RunningStats(object):
+    """
+    The count, mean and sum of squared differences from the mean of a stream of values, which is all that's needed
+    for the mean and its confidence interval. Memory stays constant however many values are seen.
+
+    Values can be numbers or equally shaped numpy arrays, in which case every element is tracked independently. Stats
+    for separate parts of a stream are combined with `merge`, using the parallel form of Welford's algorithm.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        :param values: A list of numbers, or of equally shaped arrays
+        :return:
+        """
+        values = numpy.asarray(values, dtype=float)
+        if not len(values):
+            return cls()
+        mean = values.mean(axis=0)
+        return cls(count=len(values), mean=mean, m2=((values - mean) ** 2).sum(axis=0))
+
+    def merge(self, other):
+        """
+        Adds the values summarized by `other` to these stats
+
+        :param other:
+        :return:
+        """
+        if not other.count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+
+    def element(self, index):
+        """
+        The stats of one element of the tracked arrays
+
+        :param index:
+        :return:
+        """
+        if not self.count:
+            return _RunningStats()
+        return _RunningStats(count=self.count, mean=self.mean[index], m2=self.m2[index])
+
+    def variance(self):
+        if self.count < 2:
+            return numpy.full(numpy.shape(self.mean), numpy.inf)[()]
+        return self.m2 / (self.count - 1)
+
+    def confidence_interval(self, confidence):
+        """
+        The half width of the normal approximation confidence interval of the mean
+
+        :param confidence: The confidence level, e.g. .95
+        :return:
+        """
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        return z * numpy.sqrt(self.variance() / max(self.count, 1))
+
+    def __eq__(self, other):
+        return isinstance(other, _RunningStats) and self.count == other.count and \
+            numpy.array_equal(self.mean, other.mean) and numpy.array_equal(self.m2, other.m2)
+
+    def __repr__(self):
+        return "_RunningStats(count={!r}, mean={!r}, m2={!r})".format(self.count, self.mean, self.m2)
+
+
+def _as_running_stats(stats):
+    """
+    Accepts either `_RunningStats` or the list of values they summarize
+
+    :param stats:
+    :return:
+    """
+    return stats if isinstance(stats, _RunningStats) else _RunningStats.from_values(stats)
+
+
+class _Profiler(object):
+    """
+    Records the wall time, number of calls and allocated bytes of each stage of a simulation, for each group size, and
+    how often label tables were looked up and whether they had to be calculated. Also keeps a trace event per call.
+
+    Allocated bytes are the peak memory a stage allocated on top of what was allocated when it started, and are only
+    recorded while `tracemalloc` is tracing. Profilers of chunks simulated in other processes are combined with
+    `merge`.
+    """
+
+    def __init__(self):
+        # (stage, group size) => [seconds, calls, allocated bytes]
+        self.stages = {}
+        # Group size => [hits, misses]
+        self.label_lookups = {}
+        # Group sizes of the smaller final groups of a population
+        self.final_group_sizes = set()
+        self.events = []
+        self.dropped_events = 0
+
+    @contextmanager
+    def stage(self, name, group_size=None):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            allocated_before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start_us = time.time_ns() // 1000
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            allocated = max(0, tracemalloc.get_traced_memory()[1] - allocated_before) if tracing else 0
+
+            stats = self.stages.setdefault((name, group_size), [0.0, 0, 0])
+            stats[0] += seconds
+            stats[1] += 1
+            stats[2] += allocated
+
+            if len(self.events) < MAX_TRACE_EVENTS:
+                self.events.append({'name': name, 'cat': 'review_game', 'ph': 'X', 'ts': start_us,
+                                    'dur': seconds * 1e6, 'pid': os.getpid(), 'tid': 0,
+                                    'args': {'group_size': group_size, 'allocated_bytes': allocated}})
+            else:
+                self.dropped_events += 1
+
+    def label_lookup(self, group_size, hit):
+        """
+        :param group_size:
+        :param hit: Whether the labels were already calculated
+        :return:
+        """
+        self.label_lookups.setdefault(group_size, [0, 0])[0 if hit else 1] += 1
+
+    def merge(self, other):
+        for key, (seconds, calls, allocated) in other.stages.items():
+            stats = self.stages.setdefault(key, [0.0, 0, 0])
+            stats[0] += seconds
+            stats[1] += calls
+            stats[2] += allocated
+        for group_size, (hits, misses) in other.label_lookups.items():
+            lookups = self.label_lookups.setdefault(group_size, [0, 0])
+            lookups[0] += hits
+            lookups[1] += misses
+        self.final_group_sizes |= other.final_group_sizes
+
+        kept = other.events[:max(0, MAX_TRACE_EVENTS - len(self.events))]
+        self.events += kept
+        self.dropped_events += other.dropped_events + len(other.events) - len(kept)
+
+    def chrome_trace(self):
+        """
+        :return: The trace events in the Chrome trace event format, which chrome://tracing and Perfetto open
+        """
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                'otherData': {'dropped_events': self.dropped_events}}
+
+
+def _profile_stage(profiler, name, group_size=None):
+    """
+    Profiles a stage with `profiler`, if there is one
+
+    :param profiler: A `_Profiler` or None
+    :param name:
+    :param group_size:
+    :return: A context manager
+    """
+    return profiler.stage(name, group_size) if profiler else nullcontext()
+
+
+def calculate_monte_carlo_stats(scores, rating_accuracy, confidence=None, by_bin=False, plain_scores=None,
+                                repetitions_per_sample=1):
     """
     Assumes `scores` and `rating_counts` have stats for the same configurations. Collates the monte carlo stats for
     the simulation runs
 
-    :param scores:
-    :param rating_accuracy:
+    :param scores: Configuration => `_RunningStats` of the total score, or a list of the total scores
+    :param rating_accuracy: Configuration => `_RunningStats` of the (underestimates, correct, overestimates) counts,
+    optionally followed by those counts for each true performance bin, or a list of those counts
+    :param confidence: If set, also adds the half width of the confidence interval of the average score at this
+    confidence level, and the number of repetitions
+    :param by_bin: If set, also adds the average (underestimates, correct, overestimates) for each true performance bin
+    :param plain_scores: Configuration => `_RunningStats` of the total scores of a run without variance reduction. If
+    set, also adds the effective variance reduction: how many times more repetitions the plain run needs to average
+    the score as precisely
+    :param repetitions_per_sample: How many repetitions went into each value summarized by `scores`. See
+    `REPETITIONS_PER_SAMPLE`
     :return:
     """
     averages = []
 
     for key, stats in scores.items():
-        average_score = sum(stats) / len(stats)
-        average_underestimates = sum([stats[0] for stats in rating_accuracy[key]]) / len(stats)
-        average_correct = sum([stats[1] for stats in rating_accuracy[key]]) / len(stats)
-        average_overestimates = sum([stats[2] for stats in rating_accuracy[key]]) / len(stats)
-        averages.append(list(key) + [average_score, average_underestimates, average_correct, average_overestimates])
+        score_stats = _as_running_stats(stats)
+        accuracy_means = [float(a) for a in _as_running_stats(rating_accuracy[key]).mean]
+        average = list(key) + [float(score_stats.mean)] + accuracy_means[0:3]
+        if confidence is not None:
+            average += [float(score_stats.confidence_interval(confidence)), score_stats.count]
+        if plain_scores is not None:
+            variance = score_stats.variance()
+            average += [float(plain_scores[key].variance() / (repetitions_per_sample * variance)) if variance
+                        else float('inf')]
+        if by_bin:
+            average += accuracy_means[3:]
+        averages.append(average)
 
     return averages
 
 
-def _sample_labels_calculator(population_size, bins):
+def _sample_labels_calculator(population_size, bins, strategy='quantile'):
     """
     Returns a function that gets and memoizes sample label mappings for a distribution specified by `bins`
     :param population_size:
     :param bins:
+    :param strategy: One of `SAMPLE_LABEL_STRATEGIES`
     :return:
     """
+    if strategy not in SAMPLE_LABEL_STRATEGIES:
+        raise ValueError("Unknown sample label strategy: {}".format(strategy))
     sample_labels = {}
 
     def get_sample_labels(sample_size):
         if sample_size not in sample_labels:
-            sample_labels[sample_size] = _calculate_sample_labels_oversample(
-                sample_size=min(sample_size, population_size),
-                bins=bins,
-                population_size=max(100000,
-                                    population_size * 100))
+            if strategy == 'quantile':
+                sample_labels[sample_size] = _calculate_sample_labels_quantile(
+                    sample_size=min(sample_size, population_size),
+                    bins=bins)
+            elif strategy == 'oversample':
+                sample_labels[sample_size] = _calculate_sample_labels_oversample(
+                    sample_size=min(sample_size, population_size),
+                    bins=bins,
+                    population_size=max(100000,
+                                        population_size * 100))
+            else:
+                sample_labels[sample_size] = _calculate_sample_label_monte_carlos(
+                    sample_size=min(sample_size, population_size),
+                    bins=bins)
         return sample_labels[sample_size]
 
     return get_sample_labels
 
 
+def _rated_group_sizes(population_size, sample_size):
+    """
+    The group sizes `_rate_population` looks up sample labels for when rating with groups of `sample_size`: the full
+    group size, plus the size of the smaller final group when `population_size` isn't a multiple of `sample_size`
+
+    :param population_size:
+    :param sample_size:
+    :return:
+    """
+    group_sizes = [sample_size]
+    if population_size % sample_size:
+        group_sizes.append(population_size % sample_size)
+    return group_sizes
+
+
+def _repetition_seed_sequence(entropy, repetition, stream=()):
+    """
+    Every repetition draws its population from its own random stream, derived from the master `entropy` and the index
+    of the repetition. That makes a repetition's population independent of how the repetitions are split into chunks
+    or spread across worker processes.
+
+    :param entropy:
+    :param repetition:
+    :param stream: Extra integers that pick out another independent stream for the same repetition
+    :return: A `numpy.random.SeedSequence`
+    """
+    return numpy.random.SeedSequence(entropy, spawn_key=(repetition,) + tuple(stream))
+
+
+def _repetition_stream(entropy, repetition, variance_reduction='none', stream=()):
+    """
+    The random stream a repetition draws its population from. With antithetic variance reduction, repetitions come in
+    pairs that share the stream of the first repetition of the pair, and the second one is drawn antithetically.
+
+    :param entropy:
+    :param repetition:
+    :param variance_reduction: One of `VARIANCE_REDUCTION_SCHEMES`
+    :param stream:
+    :return: A `numpy.random.SeedSequence`, and whether to draw antithetically from it
+    """
+    if variance_reduction == 'antithetic':
+        return _repetition_seed_sequence(entropy, repetition - repetition % 2, stream), repetition % 2 == 1
+    return _repetition_seed_sequence(entropy, repetition, stream), False
+
+
+def _repetition_random(seed_sequence):
+    """
+    The python engine's random stream for a `numpy.random.SeedSequence`. See `_repetition_seed_sequence`
+
+    :param seed_sequence:
+    :return: A `random.Random`
+    """
+    return random.Random(int(seed_sequence.generate_state(1, dtype=numpy.uint64)[0]))
+
+
+def _generate_repetition_population(bins, population_size, entropy, repetition, variance_reduction='none',
+                                    stream=()):
+    """
+    Generates the population of `repetition` for the python engine. See `_generate_population_matrix`
+
+    :param bins:
+    :param population_size:
+    :param entropy:
+    :param repetition:
+    :param variance_reduction: One of `VARIANCE_REDUCTION_SCHEMES`
+    :param stream:
+    :return:
+    """
+    seed_sequence, antithetic = _repetition_stream(entropy, repetition, variance_reduction, stream)
+    rng = _repetition_random(seed_sequence)
+    if variance_reduction == 'stratified':
+        strata = _repetition_strata(entropy, repetition, rng, dimensions=len(_bin_probabilities(bins)) - 1)
+        return _generate_population_stratified(bins=bins, population_size=population_size, strata=strata, rng=rng)
+    return _generate_population(bins=bins, population_size=population_size, rng=rng,
+                                antithetic=antithetic if variance_reduction == 'antithetic' else None)
+
+
+def generate_corpus(path, performance_bins, population_size, num_repetitions, seed=None, variance_reduction='none'):
+    """
+    Generates the populations of repetitions 0 to `num_repetitions` once, and writes them to a population corpus at
+    `path` (see `population_corpus.PopulationCorpus`) for `simulate_ratings` to read instead of generating them. The
+    populations are the ones the numpy engine draws with the same `seed`, so with either engine, reading them gives
+    the same results as a numpy engine run with that seed.
+
+    :param path:
+    :param performance_bins:
+    :param population_size:
+    :param num_repetitions:
+    :param seed: The master seed the populations are drawn with. Recorded in the corpus, with its entropy
+    :param variance_reduction: One of `VARIANCE_REDUCTION_SCHEMES`
+    :return:
+    """
+    if variance_reduction not in VARIANCE_REDUCTION_SCHEMES:
+        raise ValueError("Unknown variance reduction scheme: {}".format(variance_reduction))
+    if _num_bins(performance_bins) > ALIAS_COLUMNS:
+        raise ValueError("A corpus holds at most {} performance bins".format(ALIAS_COLUMNS))
+
+    entropy = numpy.random.SeedSequence(seed).entropy
+    metadata = {'performance_bins': [float(b) for b in performance_bins], 'seed': seed, 'entropy': entropy,
+                'variance_reduction': variance_reduction}
+    with PopulationCorpusWriter(path, metadata=metadata, num_repetitions=num_repetitions,
+                                population_size=population_size) as writer:
+        for first, count in _repetition_chunks(num_repetitions=num_repetitions):
+            writer.write(_generate_population_matrix(bins=performance_bins, population_size=population_size,
+                                                     entropy=entropy, repetitions=range(first, first + count),
+                                                     variance_reduction=variance_reduction))
+
+
+@lru_cache(maxsize=CORPUS_CACHE_SIZE)
+def _cached_corpus(path, inode, modified):
+    return PopulationCorpus(path)
+
+
+def _open_corpus(path):
+    """
+    The `PopulationCorpus` at `path`. Corpora are passed to worker processes by path and mapped once per process, so
+    the workers share the pages of the file instead of each getting a pickled copy. A corpus that was regenerated
+    since it was mapped is mapped again.
+
+    :param path:
+    :return:
+    """
+    stat = os.stat(path)
+    return _cached_corpus(os.path.abspath(path), stat.st_ino, stat.st_mtime_ns)
+
+
+def _check_corpus(path, performance_bins, population_size, variance_reduction, common_random_numbers,
+                  num_repetitions):
+    """
+    Checks that the corpus at `path` holds the populations of a simulation
+
+    :param path:
+    :param performance_bins:
+    :param population_size:
+    :param variance_reduction:
+    :param common_random_numbers: Must be set. The corpus has one population per repetition
+    :param num_repetitions: The number of repetitions the simulation needs at least
+    :return: The `PopulationCorpus`
+    """
+    corpus = _open_corpus(path)
+    metadata = corpus.metadata
+    if [float(b) for b in performance_bins] != metadata['performance_bins']:
+        raise ValueError("{} has populations with performance bins {}, not {}".format(
+            path, metadata['performance_bins'], list(performance_bins)))
+    if population_size != corpus.population_size:
+        raise ValueError("{} has populations of {}, not {}".format(path, corpus.population_size, population_size))
+    if variance_reduction != metadata['variance_reduction']:
+        raise ValueError("{} has populations drawn with variance reduction '{}', not '{}'".format(
+            path, metadata['variance_reduction'], variance_reduction))
+    if not common_random_numbers:
+        raise ValueError("A population corpus only has common populations, not independent ones per sample size")
+    if num_repetitions > len(corpus):
+        raise ValueError("{} only has {} populations, not {}".format(path, len(corpus), num_repetitions))
+    return corpus
+
+
+def _repetition_chunks(num_repetitions, chunk_size=REPETITIONS_PER_CHUNK):
+    """
+    Splits `num_repetitions` into consecutive (first repetition, number of repetitions) chunks of work
+
+    :param num_repetitions:
+    :param chunk_size:
+    :return:
+    """
+    return [(first, min(chunk_size, num_repetitions - first)) for first in range(0, num_repetitions, chunk_size)]
+
+
+def _sample_labels_lookup(sample_labels, profiler=None):
+    """
+    Returns a `get_sample_labels` function for `_rate_population` that reads from precomputed sample label mappings
+
+    :param sample_labels: A dict of group size => sample labels
+    :param profiler: A `_Profiler` to count the lookups with. They're all hits
+    :return:
+    """
+
+    def get_sample_labels(sample_size):
+        if profiler:
+            profiler.label_lookup(sample_size, hit=True)
+        return sample_labels[sample_size]
+
+    return get_sample_labels
+
+
+def _simulate_repetitions_python(performance_bins, population_size, sample_sizes, num_labels, get_sample_labels,
+                                 entropy, first_repetition, num_repetitions, variance_reduction='none',
+                                 common_random_numbers=True, observation_noise=0, corpus=None, profiler=None):
+    """
+    Simulates repetitions `first_repetition` to `first_repetition + num_repetitions` one at a time
+
+    With `observation_noise`, groups are ranked by noisy observations of their members' performance instead of by
+    their labels. See `_observe_population_matrix`
+
+    With a `corpus`, the populations are read from it instead of generated. See `generate_corpus`
+
+    :param performance_bins:
+    :param population_size:
+    :param sample_sizes:
+    :param num_labels:
+    :param get_sample_labels:
+    :param entropy:
+    :param first_repetition:
+    :param num_repetitions:
+    :param variance_reduction: One of `VARIANCE_REDUCTION_SCHEMES`
+    :param common_random_numbers: Rate the same population with every sample size, instead of an independent one
+    :param observation_noise: The standard deviation of the managers' observations, in performance bins. 0 to rank by
+    the labels
+    :param corpus: The path of a population corpus holding the repetitions' populations
+    :param profiler: A `_Profiler` to record the stages with
+    :return: Sample size => (num_repetitions x num_labels x num_labels) confusion matrices
+    """
+    confusion = defaultdict(list)
+    populations = _open_corpus(corpus).populations if corpus else None
+
+    def observe(population, repetition, sample_size=None):
+        # The population of a sample size without common random numbers is observed from its own stream too
+        stream = () if sample_size is None else (INDEPENDENT_GROUPS_STREAM, sample_size)
+        with _profile_stage(profiler, 'observe', sample_size):
+            return _observe_population_matrix(populations=numpy.array([population], dtype=numpy.uint8),
+                                              entropy=entropy, repetitions=[repetition],
+                                              observation_noise=observation_noise, stream=stream)
+
+    for repetition in range(first_repetition, first_repetition + num_repetitions):
+
+        # Random variable: the true distribution of ratings varies from run to run
+        if populations is not None:
+            with _profile_stage(profiler, 'read_corpus'):
+                population = populations[repetition].tolist()
+        else:
+            with _profile_stage(profiler, 'generate_population'):
+                population = _generate_repetition_population(bins=performance_bins, population_size=population_size,
+                                                             entropy=entropy, repetition=repetition,
+                                                             variance_reduction=variance_reduction)
+        if observation_noise:
+            observations = observe(population, repetition)
+
+        # Now see how our stats are affected by rating this population using different sample sizes
+        for sample_size in sample_sizes:
+            if not common_random_numbers:
+                with _profile_stage(profiler, 'generate_population', sample_size):
+                    population = _generate_repetition_population(bins=performance_bins,
+                                                                 population_size=population_size, entropy=entropy,
+                                                                 repetition=repetition,
+                                                                 variance_reduction=variance_reduction,
+                                                                 stream=(INDEPENDENT_GROUPS_STREAM, sample_size))
+                if observation_noise:
+                    observations = observe(population, repetition, sample_size)
+            with _profile_stage(profiler, 'rate', sample_size):
+                if observation_noise:
+                    ratings = _rate_population_matrix(populations=observations, sample_size=sample_size,
+                                                      get_sample_labels=get_sample_labels, selection=True)[0]
+                else:
+                    ratings = _rate_population(population=population, sample_size=sample_size,
+                                               get_sample_labels=get_sample_labels)
+            with _profile_stage(profiler, 'confusion', sample_size):
+                confusion[sample_size].append(_confusion_matrix(population=population, ratings=ratings,
+                                                                num_labels=num_labels))
+
+    return {sample_size: numpy.array(matrices, dtype=numpy.int64) for sample_size, matrices in confusion.items()}
+
+
+def _simulate_repetitions_numpy(performance_bins, population_size, sample_sizes, num_labels, get_sample_labels,
+                                entropy, first_repetition, num_repetitions, variance_reduction='none',
+                                common_random_numbers=True, observation_noise=0, corpus=None, profiler=None):
+    """
+    Array backed version of `_simulate_repetitions_python`. All the repetitions are held in one
+    (num_repetitions x population_size) matrix and each sample size rates the whole matrix in one pass. With a
+    `corpus`, that matrix is a slice of the memory mapped corpus, so the populations aren't even copied.
+
+    :param performance_bins:
+    :param population_size:
+    :param sample_sizes:
+    :param num_labels:
+    :param get_sample_labels:
+    :param entropy:
+    :param first_repetition:
+    :param num_repetitions:
+    :param variance_reduction: One of `VARIANCE_REDUCTION_SCHEMES`
+    :param common_random_numbers: Rate the same populations with every sample size, instead of independent ones
+    :param observation_noise: See `_simulate_repetitions_python`
+    :param corpus: See `_simulate_repetitions_python`
+    :param profiler: A `_Profiler` to record the stages with
+    :return: Sample size => (num_repetitions x num_labels x num_labels) confusion matrices
+    """
+    repetitions = range(first_repetition, first_repetition + num_repetitions)
+    if corpus:
+        with _profile_stage(profiler, 'read_corpus'):
+            populations = _open_corpus(corpus).populations[first_repetition:first_repetition + num_repetitions]
+    else:
+        with _profile_stage(profiler, 'generate_population'):
+            populations = _generate_population_matrix(bins=performance_bins, population_size=population_size,
+                                                      entropy=entropy, repetitions=repetitions,
+                                                      variance_reduction=variance_reduction)
+    if observation_noise:
+        with _profile_stage(profiler, 'observe'):
+            observations = _observe_population_matrix(populations=populations, entropy=entropy,
+                                                      repetitions=repetitions, observation_noise=observation_noise)
+
+    confusion = {}
+    for sample_size in sample_sizes:
+        if not common_random_numbers:
+            stream = (INDEPENDENT_GROUPS_STREAM, sample_size)
+            with _profile_stage(profiler, 'generate_population', sample_size):
+                populations = _generate_population_matrix(bins=performance_bins, population_size=population_size,
+                                                          entropy=entropy, repetitions=repetitions,
+                                                          variance_reduction=variance_reduction, stream=stream)
+            if observation_noise:
+                with _profile_stage(profiler, 'observe', sample_size):
+                    observations = _observe_population_matrix(populations=populations, entropy=entropy,
+                                                              repetitions=repetitions,
+                                                              observation_noise=observation_noise, stream=stream)
+        with _profile_stage(profiler, 'rate', sample_size):
+            if observation_noise:
+                ratings = _rate_population_matrix(populations=observations, sample_size=sample_size,
+                                                  get_sample_labels=get_sample_labels, selection=True)
+            else:
+                ratings = _rate_population_matrix(populations=populations, sample_size=sample_size,
+                                                  get_sample_labels=get_sample_labels)
+        with _profile_stage(profiler, 'confusion', sample_size):
+            confusion[sample_size] = _confusion_matrices(populations=populations, ratings=ratings,
+                                                         num_labels=num_labels)
+
+    return confusion
+
+
+def _validate_levels(level_sizes):
+    """
+    Checks that the group sizes of a rating hierarchy nest: every level's groups are made of whole groups of the level
+    below
+
+    :param level_sizes: The group size of each level, from the bottom up
+    :return:
+    """
+    if not level_sizes:
+        raise ValueError("A rating hierarchy needs at least one level")
+    for lower, upper in zip(level_sizes, level_sizes[1:]):
+        if upper <= lower or upper % lower:
+            raise ValueError("Level group size {} isn't a larger multiple of the level below's {}".format(upper, lower))
+
+
+def _rate_hierarchy(population, level_sizes, get_sample_labels, num_labels):
+    """
+    Rates `population` level by level. The bottom level ranks its groups by true performance, like
+    `_rate_population`. Every level above calibrates the ratings of the level below across its larger groups: it
+    ranks its groups by the ratings from the level below and only uses true performance to order the members that got
+    the same rating, then applies the rating distribution for its own group size.
+
+    :param population: A uint8 array of labels
+    :param level_sizes: The group size of each level, from the bottom up. See `_validate_levels`
+    :param get_sample_labels:
+    :param num_labels: The number of labels, large enough for both the true labels and the ratings
+    :return: Yields the level's group size and its uint8 array of ratings, from the bottom level up
+    """
+    key_dtype = numpy.uint8 if num_labels * num_labels <= 256 else numpy.uint16
+    keys = population
+    for level_size in level_sizes:
+        ratings = _rate_population_matrix(populations=keys[None], sample_size=level_size,
+                                          get_sample_labels=get_sample_labels)[0].astype(numpy.uint8)
+        yield level_size, ratings
+
+        # The next level orders by this level's rating, then by true performance
+        keys = ratings.astype(key_dtype)
+        keys *= num_labels
+        keys += population
+
+
+def _simulate_repetitions_hierarchical(performance_bins, population_size, sample_sizes, num_labels, get_sample_labels,
+                                       entropy, first_repetition, num_repetitions, variance_reduction='none',
+                                       common_random_numbers=True, chunk_size=HIERARCHY_CHUNK_SIZE, corpus=None,
+                                       profiler=None):
+    """
+    Hierarchical version of `_simulate_repetitions_numpy`, where `sample_sizes` are the group sizes of the levels of
+    one rating hierarchy (see `_rate_hierarchy`) instead of alternative group sizes.
+
+    Each population is generated and rated in chunks of whole top level groups, so that the memory used doesn't grow
+    with the size of the organization. Populations and ratings are uint8 arrays. The chunks are drawn one after the
+    other from the repetition's random stream, so they add up to the same population as `_generate_population_matrix`
+    gives. With a `corpus`, the chunks are views of the memory mapped corpus instead.
+
+    :param performance_bins:
+    :param population_size:
+    :param sample_sizes: The group size of each level, from the bottom up
+    :param num_labels:
+    :param get_sample_labels:
+    :param entropy:
+    :param first_repetition:
+    :param num_repetitions:
+    :param variance_reduction: 'none' or 'antithetic'. Stratified bin counts need the whole population at once
+    :param common_random_numbers: Must be set. Every level rates the same population
+    :param chunk_size: The approximate number of employees to hold in memory at once
+    :param corpus: See `_simulate_repetitions_python`
+    :param profiler: A `_Profiler` to record the stages with
+    :return: Level group size => (num_repetitions x num_labels x num_labels) confusion matrices
+    """
+    if variance_reduction == 'stratified' or not common_random_numbers:
+        raise ValueError("Hierarchical ratings don't support stratified or independent populations")
+    _validate_levels(sample_sizes)
+
+    sampler = _bin_sampler(performance_bins)
+    # Whole top level groups, and an even number of people so `_AliasSampler.fill` draws the same across chunks
+    chunk_step = sample_sizes[-1] * (1 + sample_sizes[-1] % 2)
+    chunk_size = max(1, chunk_size // chunk_step) * chunk_step
+    # One buffer for the chunks of every population
+    buffer = numpy.empty(min(chunk_size, population_size), dtype=numpy.uint8)
+    corpus_populations = _open_corpus(corpus).populations if corpus else None
+
+    confusion = {level_size: numpy.zeros((num_repetitions, num_labels, num_labels), dtype=numpy.int64)
+                 for level_size in sample_sizes}
+    for row, repetition in enumerate(range(first_repetition, first_repetition + num_repetitions)):
+        seed_sequence, antithetic = _repetition_stream(entropy, repetition, variance_reduction)
+        rng = numpy.random.default_rng(seed_sequence)
+
+        for start in range(0, population_size, chunk_size):
+            if corpus_populations is not None:
+                with _profile_stage(profiler, 'read_corpus'):
+                    population = corpus_populations[repetition, start:start + chunk_size]
+            else:
+                with _profile_stage(profiler, 'generate_population'):
+                    population = buffer[:min(chunk_size, population_size - start)]
+                    if variance_reduction == 'antithetic':
+                        sampler.fill_inverse(population, rng, antithetic)
+                    else:
+                        sampler.fill(population, rng)
+
+            levels = _rate_hierarchy(population=population, level_sizes=sample_sizes,
+                                     get_sample_labels=get_sample_labels, num_labels=num_labels)
+            for level_size in sample_sizes:
+                with _profile_stage(profiler, 'rate', level_size):
+                    _, ratings = next(levels)
+                with _profile_stage(profiler, 'confusion', level_size):
+                    confusion[level_size][row] += _confusion_matrices(populations=population[None],
+                                                                      ratings=ratings[None],
+                                                                      num_labels=num_labels)[0]
+
+    return confusion
+
+
+def _score_confusion(confusion, num_bins, productions, payoffs):
+    """
+    Scores rated populations from their confusion matrices. An employee's score is their production times the payoff
+    for how their rating compares to their true label, so the total score of a population only depends on how many
+    members of each bin were underestimated, correctly rated and overestimated. That makes scoring any number of
+    production vectors and payoffs a couple of small matrix products.
+
+    :param confusion: A (num_repetitions x num_labels x num_labels) matrix of counts
+    :param num_bins: The number of true performance labels
+    :param productions: A list of production vectors
+    :param payoffs: A list of (underestimate, correct, overestimate) payoffs
+    :return: The (num_repetitions x len(productions) x len(payoffs)) total scores, and the
+    (num_repetitions x (3 + 3 * num_bins)) rating accuracy: the total (underestimate, correct, overestimate) counts
+    followed by the counts for each true performance bin
+    """
+    return _score_accuracy_by_bin(_get_rating_accuracy_by_bin(confusion)[:, :num_bins], productions, payoffs)
+
+
+def _score_accuracy_by_bin(accuracy_by_bin, productions, payoffs):
+    """
+    Scores rated populations from how many members of each performance bin were underestimated, correctly rated and
+    overestimated. See `_score_confusion`
+
+    :param accuracy_by_bin: A (num_repetitions x num_bins x 3) matrix of counts
+    :param productions:
+    :param payoffs:
+    :return: See `_score_confusion`
+    """
+    num_bins = accuracy_by_bin.shape[1]
+    accuracy_by_bin = accuracy_by_bin.astype(float)
+    produced = numpy.einsum('rbo,pb->rpo', accuracy_by_bin, numpy.asarray(productions, dtype=float)[:, :num_bins])
+    scores = produced @ numpy.asarray(payoffs, dtype=float).T
+
+    accuracy = numpy.concatenate([accuracy_by_bin.sum(axis=1), accuracy_by_bin.reshape(len(accuracy_by_bin), -1)],
+                                 axis=1)
+    return scores, accuracy
+
+
+def _simulate_repetitions(engine, sample_labels, num_bins, productions, payoffs, sample_sizes, first_repetition,
+                          num_repetitions, variance_reduction='none', hierarchical=False, profile=False, raw=False,
+                          known_accuracy=None, keep_accuracy=False, **kwargs):
+    """
+    Simulates and scores one chunk of repetitions with `engine`. This is the unit of work handed to worker processes,
+    so it only takes picklable arguments: the sample labels are passed as precomputed mappings instead of a function.
+
+    With variance reduction, the stats are of the averages of each antithetic pair or stratified block of repetitions,
+    because the repetitions of a pair or block aren't independent of each other. See `REPETITIONS_PER_SAMPLE`
+
+    Repetitions in `known_accuracy` aren't simulated again, only scored. Every repetition has its own random stream
+    and every sample size rates it on its own, so the scores are exactly the same as if they had been simulated.
+
+    :param engine:
+    :param sample_labels: A dict of group size => sample labels
+    :param num_bins:
+    :param productions:
+    :param payoffs:
+    :param variance_reduction: One of `VARIANCE_REDUCTION_SCHEMES`
+    :param hierarchical: Rate with the hierarchy of `_simulate_repetitions_hierarchical`, whatever the `engine`
+    :param profile: Record the stages of the chunk with a `_Profiler`
+    :param raw: Also return the outcome of every repetition
+    :param known_accuracy: Sample size => the (underestimate, correct, overestimate) counts of each performance bin of
+    the first repetitions of the chunk, as returned with `keep_accuracy`, e.g. from an earlier run
+    :param keep_accuracy: Also return the counts of each performance bin of every repetition
+    :param kwargs: Arguments for `_simulate_repetitions_python`, `_simulate_repetitions_numpy` or
+    `_simulate_repetitions_hierarchical`
+    :return: Sample size => (`_RunningStats` of the scores, `_RunningStats` of the rating accuracy) (see
+    `_score_confusion`), the `_Profiler` of the chunk, or None if not `profile`, sample size =>
+    ((num_repetitions x productions x payoffs) scores, (num_repetitions x 3) rating accuracy counts), or None if not
+    `raw`, and sample size => (num_repetitions x num_bins x 3) counts, or None if not `keep_accuracy`
+    """
+    if hierarchical:
+        simulate = _simulate_repetitions_hierarchical
+    elif engine == 'numpy':
+        simulate = _simulate_repetitions_numpy
+    else:
+        simulate = _simulate_repetitions_python
+    profiler = _Profiler() if profile else None
+    # Worker processes trace their own allocations
+    start_tracing = profile and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    try:
+        # Group the sample sizes by how many of the repetitions they already know. The levels of a hierarchy are
+        # rated together
+        known_accuracy = known_accuracy or {}
+        known_counts = {sample_size: min(len(known_accuracy.get(sample_size, ())), num_repetitions)
+                        for sample_size in sample_sizes}
+        if hierarchical:
+            known_counts = dict.fromkeys(sample_sizes, min(known_counts.values()))
+        known_sample_sizes = defaultdict(list)
+        for sample_size in sample_sizes:
+            known_sample_sizes[known_counts[sample_size]].append(sample_size)
+
+        accuracy_by_bin = {}
+        for known, group_sample_sizes in sorted(known_sample_sizes.items()):
+            if known < num_repetitions:
+                confusion = simulate(get_sample_labels=_sample_labels_lookup(sample_labels, profiler=profiler),
+                                     sample_sizes=group_sample_sizes, first_repetition=first_repetition + known,
+                                     num_repetitions=num_repetitions - known, variance_reduction=variance_reduction,
+                                     profiler=profiler, **kwargs)
+            for sample_size in group_sample_sizes:
+                parts = [numpy.asarray(known_accuracy[sample_size][:known], dtype=numpy.int64)] if known else []
+                if known < num_repetitions:
+                    parts.append(_get_rating_accuracy_by_bin(confusion[sample_size])[:, :num_bins])
+                accuracy_by_bin[sample_size] = numpy.concatenate(parts) if len(parts) > 1 else parts[0]
+
+        results = {}
+        repetition_results = {} if raw else None
+        for sample_size in sample_sizes:
+            with _profile_stage(profiler, 'score', sample_size):
+                scores, accuracy = _score_accuracy_by_bin(accuracy_by_bin=accuracy_by_bin[sample_size],
+                                                          productions=productions, payoffs=payoffs)
+                if raw:
+                    repetition_results[sample_size] = (scores, accuracy[:, :3])
+                repetitions_per_sample = REPETITIONS_PER_SAMPLE[variance_reduction]
+                if repetitions_per_sample > 1:
+                    # The last sample of a run may be partial
+                    scores, accuracy = [[values[i:i + repetitions_per_sample].mean(axis=0)
+                                         for i in range(0, len(values), repetitions_per_sample)]
+                                        for values in (scores, accuracy)]
+                results[sample_size] = (_RunningStats.from_values(scores), _RunningStats.from_values(accuracy))
+    finally:
+        if start_tracing:
+            tracemalloc.stop()
+    return results, profiler, repetition_results, accuracy_by_bin if keep_accuracy else None
+
+
+def _precompute_sample_labels(population_size, sample_sizes, rating_bins, label_strategy='quantile',
+                              sample_labels=None, profiler=None):
+    """
+    The sample labels of every group size that `sample_sizes` rate, including the smaller final groups
+
+    :param population_size:
+    :param sample_sizes:
+    :param rating_bins:
+    :param label_strategy:
+    :param sample_labels: Group size => sample labels that were already calculated. Missing group sizes are added to it
+    :param profiler: A `_Profiler` to record the label table lookups with
+    :return: Group size => sample labels
+    """
+    get_sample_labels = _sample_labels_calculator(population_size=population_size, bins=rating_bins,
+                                                  strategy=label_strategy)
+    if sample_labels is None:
+        sample_labels = {}
+    for sample_size in sample_sizes:
+        group_sizes = _rated_group_sizes(population_size=population_size, sample_size=sample_size)
+        for group_size in group_sizes:
+            if profiler:
+                profiler.label_lookup(group_size, hit=group_size in sample_labels)
+            if group_size not in sample_labels:
+                with _profile_stage(profiler, 'sample_labels', group_size):
+                    sample_labels[group_size] = get_sample_labels(sample_size=group_size)
+        if profiler:
+            profiler.final_group_sizes.update(group_sizes[1:])
+    return sample_labels
+
+
+def _validate_productions(productions, num_bins):
+    """
+    Checks that every production vector has a production for each of the `num_bins` performance bins
+
+    :param productions:
+    :param num_bins:
+    :return:
+    """
+    for production in productions:
+        if len(production) < num_bins:
+            raise ValueError("Production {} doesn't cover all {} performance bins".format(production, num_bins))
+
+
+def _converged_sample_sizes(size_scores, tolerance, confidence):
+    """
+    The sample sizes whose average score is known to within `tolerance` for every payoff and production
+
+    :param size_scores: Sample size => `_RunningStats` of the scores
+    :param tolerance: The largest acceptable half width of the confidence interval of the average score
+    :param confidence:
+    :return:
+    """
+    return {sample_size for sample_size, scores in size_scores.items()
+            if scores.count and numpy.all(scores.confidence_interval(confidence) <= tolerance)}
+
+
 def simulate_ratings(performance_bins, population_size, sample_sizes, rating_bins, payoffs, production,
-                     num_repetitions=1):
+                     num_repetitions=1, engine='python', seed=None, label_strategy='quantile', workers=1,
+                     tolerance=None, max_repetitions=None, confidence=.95, productions=None, sample_labels=None,
+                     variance_reduction='none', common_random_numbers=True, hierarchical=False,
+                     observation_noise=0, corpus=None, profiler=None, store=None, executor=None, progress=None,
+                     shard=None, chunk_stats=None, state=None):
     """
     Simulate all of the configurations specified in the arguments and return the aggregated states for the simulations
 
+    Every population is rated once per sample size, which gives a (true label x rating) confusion matrix. All the
+    payoffs, and all the production vectors in `productions`, are scored from those matrices.
+
+    The repetitions are simulated in chunks, optionally spread across `workers` processes. Every repetition has its
+    own random stream derived from `seed`, and the chunks are collated in order, so the results for a given seed are
+    the same whatever the number of workers.
+
+    If `tolerance` is set, repetitions continue past `num_repetitions` until the confidence interval of every
+    configuration's average score is narrower than `tolerance` on each side, or `max_repetitions` is reached. A sample
+    size stops being simulated as soon as all of its configurations have converged.
+
+    Populations are independent draws unless `variance_reduction` says otherwise:
+    * 'stratified': the number of members in each performance bin is stratified across each block of
+      `STRATIFIED_BLOCK_SIZE` repetitions, so the bin counts of a block evenly cover their distribution, and only the
+      placement of the members is random
+    * 'antithetic': repetitions come in pairs, the second drawn with the flipped random numbers of the first, so
+      their errors tend to cancel
+    Either way every repetition is still an unbiased draw. The stats are of the averages of the pairs or blocks, so
+    their count is the number of pairs or blocks
+
+    With `common_random_numbers`, every sample size rates the same populations, which makes the differences between
+    sample sizes much more precise than their absolute scores.
+
+    With `hierarchical`, `sample_sizes` are the group sizes of the levels of one rating hierarchy, e.g. teams of 8
+    calibrated across orgs of 64 and divisions of 512, and the stats of each sample size are the stats of the ratings
+    of that level. See `_rate_hierarchy`. Populations are streamed through compact arrays, so this scales to
+    organizations of millions.
+
+    With `observation_noise`, managers don't see performance perfectly: every member has a continuous latent
+    performance, and groups are ranked by noisy observations of it, see `_observe_population_matrix`. Ratings are
+    assigned by selecting the quantiles of each group rather than sorting it, so this stays linear in the group size.
+
+    With a `corpus`, the populations are read from a population corpus written by `generate_corpus` instead of
+    generated, so separate runs, e.g. with different `rating_bins` or payoffs, rate exactly the same populations. The
+    corpus is memory mapped, and shared by the worker processes without copying it. With a `tolerance`, the
+    repetitions stop at the end of the corpus.
+
+    With a `state`, the simulation is incremental: the state keeps how many members of each performance bin were
+    underestimated, correctly rated and overestimated in every repetition of every sample size, which is all that
+    scoring needs, and the label tables they were rated with. Repetitions that are already in the state are only
+    scored, so adding sample sizes only simulates the new ones, adding repetitions only simulates the extra ones, and
+    changing payoffs or productions doesn't simulate anything. Each repetition has its own random stream, and its
+    scores are collated in the same chunks and order, so the results are exactly those of a run from scratch. A state
+    of a simulation with other populations or rating bins is cleared first.
+
     :param performance_bins:
     :param population_size:
     :param sample_sizes:
     :param rating_bins:
     :param payoffs:
     :param production:
-    :param num_repetitions:
+    :param num_repetitions: The number of repetitions, or the minimum number of repetitions when `tolerance` is set
+    :param engine: 'python' to simulate one repetition at a time, or 'numpy' to simulate a chunk of repetitions as one
+    matrix
+    :param seed: The master seed that all the random streams are derived from. Defaults to the seed of the `corpus`
+    :param label_strategy: How to map positions in a group to ratings. One of `SAMPLE_LABEL_STRATEGIES`
+    :param workers: The number of processes to simulate with
+    :param tolerance: The largest acceptable half width of the confidence interval of an average score
+    :param max_repetitions: The most repetitions to simulate when `tolerance` is set
+    :param confidence: The confidence level `tolerance` applies to
+    :param productions: A list of production vectors to score instead of `production`. Each production vector is
+    added to the end of the configurations it was scored with
+    :param sample_labels: Group size => sample labels that were already calculated for `rating_bins`,
+    `population_size` and `label_strategy`. Missing group sizes are calculated and added to it, so it can be kept
+    and passed to later calls
+    :param variance_reduction: One of `VARIANCE_REDUCTION_SCHEMES`
+    :param common_random_numbers: Rate the same populations with every sample size
+    :param hierarchical: Rate with `sample_sizes` as nested levels instead of as alternatives
+    :param observation_noise: The standard deviation of the managers' observations, in performance bins
+    :param corpus: The path of a population corpus to read the populations from
+    :param profiler: A `_Profiler` to record the label tables, and the stages of every chunk, with
+    :param store: A `RepetitionStoreWriter` to write the score and rating accuracy of every repetition of every
+    configuration to, chunk by chunk
+    :param executor: A process pool to simulate the chunks on, instead of starting `workers` processes for this call.
+    It's left running
+    :param progress: Called with the number of repetitions done and the most that will be done after every chunk. An
+    exception raised by it stops the simulation
+    :param shard: (index, count) to only simulate shard `index` of `count` disjoint shards of the repetitions: every
+    `count`-th chunk of `REPETITIONS_PER_CHUNK` repetitions, starting from chunk `index`. See `merge_shards`
+    :param chunk_stats: A list to append the (first repetition, number of repetitions, sample size =>
+    (`_RunningStats` of the scores, `_RunningStats` of the rating accuracy)) of every chunk to, in order
+    :param state: A dict to keep the state of the simulation in, for later calls. Start with an empty one, see
+    `write_state` and `read_state`
+    :return: Configuration => `_RunningStats` of the total scores, and configuration => `_RunningStats` of the
+    rating accuracy: the (underestimates, correct, overestimates) counts, followed by those counts for each true
+    performance bin
+    """
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine: {}".format(engine))
+    if tolerance is not None and max_repetitions is None:
+        raise ValueError("max_repetitions is required with a tolerance")
+    if shard is not None and tolerance is not None:
+        raise ValueError("Shards can't stop at a tolerance, every shard needs to know its repetitions up front")
+    if shard is not None and state is not None:
+        raise ValueError("Shards can't keep a state, they only simulate some of the repetitions")
+    if variance_reduction not in VARIANCE_REDUCTION_SCHEMES:
+        raise ValueError("Unknown variance reduction scheme: {}".format(variance_reduction))
+    if hierarchical:
+        _validate_levels(sample_sizes)
+        if variance_reduction == 'stratified' or not common_random_numbers:
+            raise ValueError("Hierarchical ratings don't support stratified or independent populations")
+        if observation_noise:
+            raise ValueError("Hierarchical ratings don't support observation noise")
+    if observation_noise < 0:
+        raise ValueError("Observation noise can't be negative: {}".format(observation_noise))
+
+    num_bins = _num_bins(performance_bins)
+    _validate_productions(productions or [production], num_bins)
+
+    entropy = numpy.random.SeedSequence(seed).entropy
+    if corpus:
+        opened_corpus = _check_corpus(corpus, performance_bins=performance_bins, population_size=population_size,
+                                      variance_reduction=variance_reduction,
+                                      common_random_numbers=common_random_numbers, num_repetitions=num_repetitions)
+        if tolerance is not None:
+            max_repetitions = min(max_repetitions, len(opened_corpus))
+        if seed is None:
+            entropy = opened_corpus.metadata['entropy']
+
+    if state is not None:
+        experiment = {'performance_bins': [float(b) for b in performance_bins], 'population_size': population_size,
+                      'rating_bins': [float(b) for b in rating_bins], 'label_strategy': label_strategy,
+                      'entropy': entropy, 'engine': engine, 'variance_reduction': variance_reduction,
+                      'common_random_numbers': common_random_numbers,
+                      'levels': list(sample_sizes) if hierarchical else None,
+                      'observation_noise': float(observation_noise), 'corpus': corpus}
+        if state.get('experiment') != experiment:
+            state.clear()
+            state.update(experiment=experiment, sample_labels={}, accuracy={})
+        if label_strategy == 'quantile':
+            # Quantile label tables don't depend on the random state, so the earlier runs' tables are reused
+            sample_labels = {} if sample_labels is None else sample_labels
+            for group_size, labels in state['sample_labels'].items():
+                sample_labels.setdefault(group_size, labels)
+
+    # The oversample and monte carlo label strategies draw from the global random module
+    if seed is not None or corpus:
+        random.seed(entropy)
+
+    # Precompute the distributions for the different sample sizes, including the smaller final groups. These are
+    # computed once here and shared with all the chunks
+    sample_labels = _precompute_sample_labels(population_size=population_size, sample_sizes=sample_sizes,
+                                              rating_bins=rating_bins, label_strategy=label_strategy,
+                                              sample_labels=sample_labels, profiler=profiler)
+
+    if state is not None:
+        _update_state_labels(state, population_size=population_size, sample_sizes=sample_sizes,
+                             sample_labels=sample_labels)
+    num_labels = max([num_bins] + [label + 1 for labels in sample_labels.values() for label in labels])
+
+    simulate_chunk = partial(_simulate_repetitions, engine=engine, sample_labels=sample_labels, num_bins=num_bins,
+                             productions=[list(p[:num_bins]) for p in productions or [production]], payoffs=payoffs,
+                             performance_bins=performance_bins, population_size=population_size,
+                             num_labels=num_labels, entropy=entropy, variance_reduction=variance_reduction,
+                             common_random_numbers=common_random_numbers, hierarchical=hierarchical,
+                             profile=profiler is not None, raw=store is not None, corpus=corpus,
+                             keep_accuracy=state is not None,
+                             **({'observation_noise': observation_noise} if observation_noise else {}))
+
+    if tolerance is None:
+        chunks = _repetition_chunks(num_repetitions=num_repetitions)
+        if shard is not None:
+            chunks = chunks[shard[0]::shard[1]]
+        # Without a stopping rule, every chunk can be handed out at once
+        wave_size = len(chunks)
+    else:
+        chunks = _repetition_chunks(num_repetitions=max(num_repetitions, max_repetitions))
+        # Convergence is checked after every chunk, so only get a chunk ahead per worker
+        wave_size = max(1, workers)
+
+    size_scores = {sample_size: _RunningStats() for sample_size in sample_sizes}
+    size_accuracy = {sample_size: _RunningStats() for sample_size in sample_sizes}
+    # The accuracy of every chunk of every sample size, for the state
+    state_accuracy = defaultdict(list)
+
+    def known_accuracy(first, count):
+        if state is None:
+            return None
+        return {sample_size: accuracy[first:first + count] for sample_size, accuracy in state['accuracy'].items()
+                if len(accuracy) > first}
+
+    own_executor = executor is None and workers > 1 and len(chunks) > 1
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    futures = []
+    try:
+        if progress and chunks:
+            progress(0, chunks[-1][0] + chunks[-1][1])
+        active_sample_sizes = list(sample_sizes)
+        for wave_start in range(0, len(chunks), wave_size):
+            if not active_sample_sizes:
+                break
+
+            wave = chunks[wave_start:wave_start + wave_size]
+            # Every level of a hierarchy depends on the levels below it, so they're all rated until the last one has
+            # converged
+            chunk_sample_sizes = list(sample_sizes) if hierarchical else active_sample_sizes
+            if executor:
+                futures = [executor.submit(simulate_chunk, sample_sizes=chunk_sample_sizes, first_repetition=first,
+                                           num_repetitions=count, known_accuracy=known_accuracy(first, count))
+                           for first, count in wave]
+                results = (future.result() for future in futures)
+            else:
+                results = (simulate_chunk(sample_sizes=chunk_sample_sizes, first_repetition=first,
+                                          num_repetitions=count, known_accuracy=known_accuracy(first, count))
+                           for first, count in wave)
+
+            # Collate the chunks in order and check for convergence after each one, exactly as if they had been
+            # simulated one at a time. Results for sample sizes that converged earlier in the wave are dropped
+            for (first, count), (chunk_results, chunk_profiler, repetition_results, chunk_accuracy) in zip(wave,
+                                                                                                          results):
+                if profiler:
+                    profiler.merge(chunk_profiler)
+                if store:
+                    _store_repetitions(store, repetition_results, active_sample_sizes, first, payoffs, productions)
+                if chunk_stats is not None:
+                    chunk_stats.append((first, count, {s: chunk_results[s] for s in active_sample_sizes}))
+                if state is not None:
+                    for sample_size, accuracy in chunk_accuracy.items():
+                        state_accuracy[sample_size].append(accuracy)
+                for sample_size in active_sample_sizes:
+                    chunk_scores, chunk_accuracy = chunk_results[sample_size]
+                    size_scores[sample_size].merge(chunk_scores)
+                    size_accuracy[sample_size].merge(chunk_accuracy)
+                if tolerance is not None and first + count >= num_repetitions:
+                    converged = _converged_sample_sizes({s: size_scores[s] for s in active_sample_sizes}, tolerance,
+                                                        confidence)
+                    active_sample_sizes = [s for s in active_sample_sizes if s not in converged]
+                if progress:
+                    progress(first + count, chunks[-1][0] + chunks[-1][1])
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+        else:
+            # Don't leave the rest of an abandoned wave queued on a shared pool
+            for future in futures:
+                future.cancel()
+
+    if state is not None:
+        # Repetitions past the ones simulated now are kept for later calls
+        for sample_size, parts in state_accuracy.items():
+            accuracy = numpy.concatenate(parts)
+            known = state['accuracy'].get(sample_size)
+            if known is not None and len(known) > len(accuracy):
+                accuracy = numpy.concatenate([accuracy, known[len(accuracy):]])
+            state['accuracy'][sample_size] = accuracy
+
+    return _configuration_stats(size_scores=size_scores, size_accuracy=size_accuracy, payoffs=payoffs,
+                                productions=productions)
+
+
+def _update_state_labels(state, population_size, sample_sizes, sample_labels):
+    """
+    Adds the label tables of `sample_sizes` to the state of `simulate_ratings`. The oversample and monte carlo label
+    tables depend on the random state, and so on which other tables were calculated before them. The repetitions of
+    sample sizes that were rated with a table that has changed since are dropped from the state.
+
+    :param state:
+    :param population_size:
+    :param sample_sizes:
+    :param sample_labels: Group size => sample labels, for every group size `sample_sizes` rate
     :return:
     """
-    rating_scores = defaultdict(list)
-    rating_accuracy = defaultdict(list)
+    group_sizes = {group_size for sample_size in sample_sizes
+                   for group_size in _rated_group_sizes(population_size=population_size, sample_size=sample_size)}
+    changed = {group_size for group_size in group_sizes
+               if state['sample_labels'].get(group_size, sample_labels[group_size]) != sample_labels[group_size]}
+    for sample_size in list(state['accuracy']):
+        if changed & set(_rated_group_sizes(population_size=population_size, sample_size=sample_size)):
+            del state['accuracy'][sample_size]
+    state['sample_labels'].update({group_size: sample_labels[group_size] for group_size in group_sizes})
+
+
+def _configurations(sample_size, payoffs, productions=None):
+    """
+    The run configurations of a sample size, in the order of its (productions x payoffs) scores
+
+    :param sample_size:
+    :param payoffs:
+    :param productions: The production vectors that were scored, if they should be part of the configurations
+    :return: A (len(productions) x len(payoffs)) list of lists of configurations
+    """
+    return [[tuple([sample_size] + list(payoff) + list(production)) for payoff in payoffs]
+            for production in productions or [()]]
 
-    # Precompute the distributions for the different sample sizes
-    get_sample_labels = _sample_labels_calculator(population_size=population_size, bins=rating_bins)
+
+def _store_repetitions(store, repetition_results, sample_sizes, first_repetition, payoffs, productions=None):
+    """
+    Writes the outcome of every repetition of a chunk to `store`, one record per repetition and configuration
+
+    :param store: A `RepetitionStoreWriter`
+    :param repetition_results: The raw results of `_simulate_repetitions`
+    :param sample_sizes: The sample sizes to write
+    :param first_repetition: The index of the first repetition of the chunk
+    :param payoffs:
+    :param productions:
+    :return:
+    """
     for sample_size in sample_sizes:
-        get_sample_labels(sample_size=sample_size)
+        scores, accuracy = repetition_results[sample_size]
+        configuration_ids = numpy.array([[store.configuration_id(configuration) for configuration in row]
+                                         for row in _configurations(sample_size, payoffs, productions)])
+        repetitions = numpy.arange(first_repetition, first_repetition + len(scores))
+        counts = numpy.repeat(accuracy.astype(numpy.uint32), configuration_ids.size, axis=0)
+        store.write(configuration=numpy.tile(configuration_ids.ravel(), len(scores)),
+                    repetition=numpy.repeat(repetitions, configuration_ids.size),
+                    score=scores.reshape(-1),
+                    underestimates=counts[:, 0], correct=counts[:, 1], overestimates=counts[:, 2])
+
+
+def _configuration_stats(size_scores, size_accuracy, payoffs, productions=None):
+    """
+    Splits the stats collected for each sample size into stats for each run configuration
 
-    # Repeat the simulation of each configuration `num_repetitions` times
-    for _ in range(0, num_repetitions):
+    :param size_scores: Sample size => `_RunningStats` of the (productions x payoffs) scores
+    :param size_accuracy: Sample size => `_RunningStats` of the rating accuracy
+    :param payoffs:
+    :param productions: The production vectors that were scored, if they should be part of the configurations
+    :return:
+    """
+    rating_scores = {}
+    rating_accuracy = {}
+    for sample_size, scores in size_scores.items():
+        for production_idx, row in enumerate(_configurations(sample_size, payoffs, productions)):
+            for payoff_idx, run_configuration in enumerate(row):
+                rating_scores[run_configuration] = scores.element((production_idx, payoff_idx))
+                rating_accuracy[run_configuration] = size_accuracy[sample_size]
 
-        # Random variable: the true distribution of ratings varies from run to run
-        population = _generate_population(bins=performance_bins, population_size=population_size)
+    return rating_scores, rating_accuracy
 
-        # Now see how our stats are affected by rating this population using different sample sizes
+
+def write_shard(path, experiment, shard, runs):
+    """
+    Writes the stats of every chunk of one shard of an experiment to a numpy `.npz` file, for `merge_shards`. The file
+    is written next to `path` and then moved into place, so an interrupted shard never looks finished.
+
+    :param path:
+    :param experiment: The JSON serializable arguments that determine the results of the experiment. Only shards of
+    the same experiment can be merged
+    :param shard: (index, count), see `simulate_ratings`
+    :param runs: Run name => the `chunk_stats` of a `simulate_ratings` run, e.g. the main run and the variance
+    reduction pilot run
+    :return:
+    """
+    metadata = {'version': SHARD_VERSION, 'experiment': experiment, 'shard': list(shard), 'runs': sorted(runs)}
+    arrays = {'metadata': numpy.array(json.dumps(metadata))}
+    for run, chunks in runs.items():
+        arrays['{}_first'.format(run)] = numpy.array([first for first, _, _ in chunks], dtype=numpy.int64)
+        arrays['{}_count'.format(run)] = numpy.array([count for _, count, _ in chunks], dtype=numpy.int64)
+        for sample_size in experiment['sample_sizes'] if chunks else []:
+            for stat_idx, name in enumerate(['scores', 'accuracy']):
+                stats = [size_stats[sample_size][stat_idx] for _, _, size_stats in chunks]
+                prefix = '{}_{}_{}'.format(run, sample_size, name)
+                arrays[prefix + '_count'] = numpy.array([s.count for s in stats], dtype=numpy.int64)
+                arrays[prefix + '_mean'] = numpy.array([s.mean for s in stats], dtype=float)
+                arrays[prefix + '_m2'] = numpy.array([s.m2 for s in stats], dtype=float)
+
+    with open(path + '.tmp', 'wb') as f:
+        numpy.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def read_shard(path):
+    """
+    :param path: A file written by `write_shard`
+    :return: A dict of the 'experiment', the (index, count) of the 'shard' and the 'runs', with the `chunk_stats` of
+    every run
+    """
+    with numpy.load(path) as data:
+        metadata = json.loads(str(data['metadata']))
+        if metadata['version'] != SHARD_VERSION:
+            raise ValueError("Unsupported shard version in {}: {}".format(path, metadata['version']))
+
+        runs = {}
+        for run in metadata['runs']:
+            chunks = [(int(first), int(count), {}) for first, count in zip(data['{}_first'.format(run)],
+                                                                            data['{}_count'.format(run)])]
+            for sample_size in metadata['experiment']['sample_sizes'] if chunks else []:
+                columns = [[data['{}_{}_{}_{}'.format(run, sample_size, name, column)]
+                            for column in ('count', 'mean', 'm2')] for name in ('scores', 'accuracy')]
+                for chunk_idx, (_, _, size_stats) in enumerate(chunks):
+                    size_stats[sample_size] = tuple(_RunningStats(count=int(counts[chunk_idx]), mean=means[chunk_idx],
+                                                                  m2=m2s[chunk_idx])
+                                                    for counts, means, m2s in columns)
+            runs[run] = chunks
+
+    return {'experiment': metadata['experiment'], 'shard': tuple(metadata['shard']), 'runs': runs}
+
+
+def write_state(path, runs):
+    """
+    Writes the states of `simulate_ratings` runs to a numpy `.npz` file, for `read_state`. The file is written next
+    to `path` and then moved into place, so an interrupted write never replaces a good state.
+
+    :param path:
+    :param runs: Run name => the `state` of a `simulate_ratings` run, e.g. the main run and the variance reduction
+    pilot run
+    :return:
+    """
+    metadata = {'version': STATE_VERSION, 'runs': {}}
+    arrays = {}
+    for run, state in runs.items():
+        if not state:
+            continue
+        metadata['runs'][run] = {'experiment': state['experiment'],
+                                 'sample_labels': [[group_size, list(labels)]
+                                                   for group_size, labels in sorted(state['sample_labels'].items())],
+                                 'sample_sizes': sorted(state['accuracy'])}
+        for sample_size, accuracy in state['accuracy'].items():
+            arrays['{}_{}_accuracy'.format(run, sample_size)] = numpy.asarray(accuracy, dtype=numpy.uint32)
+    arrays['metadata'] = numpy.array(json.dumps(metadata))
+
+    with open(path + '.tmp', 'wb') as f:
+        numpy.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def read_state(path):
+    """
+    :param path: A file written by `write_state`
+    :return: Run name => the `state` to continue the `simulate_ratings` run with
+    """
+    with numpy.load(path) as data:
+        metadata = json.loads(str(data['metadata']))
+        if metadata['version'] != STATE_VERSION:
+            raise ValueError("Unsupported state version in {}: {}".format(path, metadata['version']))
+
+        runs = {}
+        for run, state in metadata['runs'].items():
+            runs[run] = {'experiment': state['experiment'],
+                         'sample_labels': {group_size: labels for group_size, labels in state['sample_labels']},
+                         'accuracy': {sample_size: data['{}_{}_accuracy'.format(run, sample_size)].astype(numpy.int64)
+                                      for sample_size in state['sample_sizes']}}
+    return runs
+
+
+def _merge_chunk_stats(chunks, num_repetitions, sample_sizes):
+    """
+    Combines the stats of the chunks of a run in chunk order, exactly like `simulate_ratings` combines them
+
+    :param chunks: The `chunk_stats` of all the shards of the run
+    :param num_repetitions: The number of repetitions of the run
+    :param sample_sizes:
+    :return: Sample size => `_RunningStats` of the scores, and sample size => `_RunningStats` of the rating accuracy
+    """
+    chunks = sorted(chunks, key=lambda chunk: chunk[0])
+    if [(first, count) for first, count, _ in chunks] != _repetition_chunks(num_repetitions=num_repetitions):
+        raise ValueError("The shards don't cover repetitions 0 to {} exactly once".format(num_repetitions))
+
+    size_scores = {sample_size: _RunningStats() for sample_size in sample_sizes}
+    size_accuracy = {sample_size: _RunningStats() for sample_size in sample_sizes}
+    for _, _, size_stats in chunks:
         for sample_size in sample_sizes:
-            ratings = _rate_population(population=population, sample_size=sample_size,
-                                       get_sample_labels=get_sample_labels)
+            chunk_scores, chunk_accuracy = size_stats[sample_size]
+            size_scores[sample_size].merge(chunk_scores)
+            size_accuracy[sample_size].merge(chunk_accuracy)
+    return size_scores, size_accuracy
+
 
-            # These stats don't change by payoff functions
-            num_underestimates, num_correct, num_overestimates = _get_rating_accuracy_stats(population=population,
-                                                                                            ratings=ratings)
+def merge_shards(paths):
+    """
+    Merges the shard files of one experiment into the rows `run_simulation` gives for the whole experiment run at
+    once. The stats of the chunks are combined in the same order as in one run, so the rows are exactly the same.
 
-            # Score ratings using different payoff functions. Collate stats by simulation configuration
-            for payoff in payoffs:
-                run_configuration = tuple([sample_size] + list(payoff))
+    :param paths: The files written by `write_shard` for every shard of the experiment, in any order
+    :return: The rows to print
+    """
+    if not paths:
+        raise ValueError("No shards to merge")
+    shards = [read_shard(path) for path in paths]
+    experiment = shards[0]['experiment']
+    num_shards = shards[0]['shard'][1]
+
+    shard_paths = {}
+    for path, shard in zip(paths, shards):
+        index, count = shard['shard']
+        if shard['experiment'] != experiment:
+            raise ValueError("{} is a shard of a different experiment than {}".format(path, paths[0]))
+        if count != num_shards:
+            raise ValueError("{} is shard {}/{}, but {} is split into {} shards".format(path, index + 1, count,
+                                                                                      paths[0], num_shards))
+        if index in shard_paths:
+            raise ValueError("{} and {} are both shard {}/{}".format(shard_paths[index], path, index + 1, count))
+        shard_paths[index] = path
+    missing = sorted(set(range(num_shards)) - set(shard_paths))
+    if missing:
+        raise ValueError("Missing shards {} of {}".format(', '.join(str(index + 1) for index in missing), num_shards))
+
+    sample_sizes = experiment['sample_sizes']
+    payoffs = [tuple(payoff) for payoff in experiment['payoffs']]
+    productions = experiment['productions'] and [tuple(production) for production in experiment['productions']]
+    variance_reduction = experiment['variance_reduction']
+
+    size_scores, size_accuracy = _merge_chunk_stats([chunk for shard in shards for chunk in shard['runs']['main']],
+                                                    experiment['num_repetitions'], sample_sizes)
+    rating_scores, rating_accuracy = _configuration_stats(size_scores=size_scores, size_accuracy=size_accuracy,
+                                                          payoffs=payoffs, productions=productions)
+
+    plain_scores = None
+    if variance_reduction != 'none':
+        size_scores, size_accuracy = _merge_chunk_stats(
+            [chunk for shard in shards for chunk in shard['runs']['pilot']],
+            min(experiment['num_repetitions'], VARIANCE_REDUCTION_PILOT_REPETITIONS), sample_sizes)
+        plain_scores, _ = _configuration_stats(size_scores=size_scores, size_accuracy=size_accuracy, payoffs=payoffs,
+                                               productions=productions)
+
+    return calculate_monte_carlo_stats(scores=rating_scores, rating_accuracy=rating_accuracy,
+                                       confidence=experiment['confidence'], by_bin=experiment['per_bin_accuracy'],
+                                       plain_scores=plain_scores,
+                                       repetitions_per_sample=REPETITIONS_PER_SAMPLE[variance_reduction])
+
+
+def _racing_rounds(num_repetitions, max_repetitions):
+    """
+    The number of repetitions every candidate still in the race has after each round of `optimize_sample_size`: it
+    starts at `num_repetitions` and doubles until `max_repetitions`
 
-                scores = \
-                    _score_ratings(population, ratings,
-                                   production=production,
-                                   underestimate_score=payoff[0],
-                                   over_estimate_score=payoff[2],
-                                   correct_score=payoff[1])
+    :param num_repetitions:
+    :param max_repetitions:
+    :return:
+    """
+    rounds = [max(1, min(num_repetitions, max_repetitions))]
+    while rounds[-1] < max_repetitions:
+        rounds.append(min(rounds[-1] * 2, max_repetitions))
+    return rounds
 
-                rating_accuracy[run_configuration].append((num_underestimates, num_correct, num_overestimates))
-                rating_scores[run_configuration].append(sum(scores))
 
-    return rating_scores, rating_accuracy
+def _race_elimination(candidate_scores, within, confidence):
+    """
+    One round of racing: compares every pair of candidates on the repetitions they have in common
+
+    Candidate c is out when there is a candidate b whose score scaled by (1 - within) is higher than c's with
+    `confidence`, i.e. the upper end of the confidence interval of the average of the paired differences
+    `c - (1 - within) * b` is below 0. It's confirmed within `within` of the best when the lower end is above 0 for
+    every other candidate b.
+
+    :param candidate_scores: Sample size => the scores of the repetitions simulated so far, the same repetitions for
+    every candidate
+    :param within: The fraction of the best score a candidate can fall short by
+    :param confidence: The confidence level of each comparison
+    :return: The set of candidates that are out, and the set of candidates that are confirmed to be within
+    """
+    eliminated = set()
+    confirmed = set()
+    for candidate, scores in candidate_scores.items():
+        lower_bounds = []
+        for other, other_scores in candidate_scores.items():
+            if other == candidate:
+                continue
+            differences = _RunningStats.from_values(scores - (1 - within) * other_scores)
+            half_width = differences.confidence_interval(confidence)
+            if differences.mean + half_width < 0:
+                eliminated.add(candidate)
+            lower_bounds.append(differences.mean - half_width)
+        if all(bound > 0 for bound in lower_bounds):
+            confirmed.add(candidate)
+    return eliminated, confirmed
+
+
+def optimize_sample_size(performance_bins, population_size, rating_bins, payoff, production, sample_sizes=None,
+                         within=0, num_repetitions=100, max_repetitions=100000, confidence=.95, engine='python',
+                         seed=None, label_strategy='quantile', workers=1, observation_noise=0, corpus=None,
+                         sample_labels=None, executor=None, progress=None):
+    """
+    Searches `sample_sizes` for the one with the best average score, or with `within`, for the smallest one whose
+    average score is within that fraction of the best, without simulating every sample size to full precision.
+
+    The search races the candidates: every round simulates the next repetitions for the candidates still in the race,
+    doubling their number of repetitions, and drops the ones that are worse than another candidate with
+    `confidence` (see `_race_elimination`). The race ends when the answer is confirmed, or after `max_repetitions`.
+    Every candidate rates the same populations, so candidates are compared by their paired differences, which are
+    much more precise than their scores. Repetitions have their own random streams, so continuing a candidate's
+    repetitions in the next round gives the same results as simulating them at once.
+
+    The comparisons are Bonferroni corrected for the number of candidates and rounds, so the answer holds with at
+    least `confidence` overall. Scores are assumed to be positive when `within` is set.
+
+    :param performance_bins:
+    :param population_size:
+    :param rating_bins:
+    :param payoff: The (underestimate, correct, overestimate) payoff to score
+    :param production:
+    :param sample_sizes: The candidate group sizes, `default_sample_sizes` if not given
+    :param within: The fraction of the best score the answer can fall short by, e.g. .05 for the smallest group size
+    within 5% of the best
+    :param num_repetitions: The number of repetitions of the first round
+    :param max_repetitions: The most repetitions to simulate for a candidate
+    :param confidence:
+    :param engine:
+    :param seed:
+    :param label_strategy:
+    :param workers:
+    :param observation_noise: See `simulate_ratings`
+    :param corpus: See `simulate_ratings`. The race stops at the end of the corpus
+    :param sample_labels: See `simulate_ratings`
+    :param executor: See `simulate_ratings`
+    :param progress: Called with the number of repetitions done and the most repetitions a candidate can get, after
+    every chunk. An exception raised by it stops the race
+    :return: A dict of the answer ('sample_size'), its average score ('score') and the half width of its confidence
+    interval ('confidence_interval'), the repetitions it was simulated with ('repetitions'), whether it's confirmed
+    with `confidence` ('confirmed'), the candidates still in the race when it ended ('remaining'), and the number of
+    group size repetitions that were simulated ('simulated') and that the grid of all the candidates at the same
+    number of repetitions would have taken ('grid')
+    """
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine: {}".format(engine))
+    if not 0 <= within < 1:
+        raise ValueError("within must be at least 0 and less than 1, not {}".format(within))
+    if observation_noise < 0:
+        raise ValueError("Observation noise can't be negative: {}".format(observation_noise))
+    sample_sizes = sorted(set(sample_sizes or default_sample_sizes(population_size=population_size)))
+
+    num_bins = _num_bins(performance_bins)
+    _validate_productions([production], num_bins)
+
+    entropy = numpy.random.SeedSequence(seed).entropy
+    if corpus:
+        opened_corpus = _check_corpus(corpus, performance_bins=performance_bins, population_size=population_size,
+                                      variance_reduction='none', common_random_numbers=True,
+                                      num_repetitions=num_repetitions)
+        max_repetitions = min(max_repetitions, len(opened_corpus))
+        if seed is None:
+            entropy = opened_corpus.metadata['entropy']
+    if seed is not None or corpus:
+        random.seed(entropy)
+    sample_labels = _precompute_sample_labels(population_size=population_size, sample_sizes=sample_sizes,
+                                              rating_bins=rating_bins, label_strategy=label_strategy,
+                                              sample_labels=sample_labels)
+    num_labels = max([num_bins] + [label + 1 for labels in sample_labels.values() for label in labels])
+
+    simulate_chunk = partial(_simulate_repetitions, engine=engine, sample_labels=sample_labels, num_bins=num_bins,
+                             productions=[list(production[:num_bins])], payoffs=[payoff],
+                             performance_bins=performance_bins, population_size=population_size,
+                             num_labels=num_labels, entropy=entropy, raw=True, corpus=corpus,
+                             **({'observation_noise': observation_noise} if observation_noise else {}))
+
+    rounds = _racing_rounds(num_repetitions=num_repetitions, max_repetitions=max_repetitions)
+    comparison_confidence = 1 - (1 - confidence) / (max(1, len(sample_sizes) - 1) * len(rounds))
+
+    scores = {sample_size: numpy.empty(0) for sample_size in sample_sizes}
+    remaining = list(sample_sizes)
+    confirmed = set()
+    simulated = 0
+    done = 0
+
+    own_executor = executor is None and workers > 1
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    futures = []
+    try:
+        if progress:
+            progress(0, rounds[-1])
+        for target in rounds:
+            chunks = [(done + first, count) for first, count in _repetition_chunks(num_repetitions=target - done)]
+            if executor:
+                futures = [executor.submit(simulate_chunk, sample_sizes=remaining, first_repetition=first,
+                                           num_repetitions=count) for first, count in chunks]
+                pending = (future.result() for future in futures)
+            else:
+                pending = (simulate_chunk(sample_sizes=remaining, first_repetition=first, num_repetitions=count)
+                           for first, count in chunks)
+            results = []
+            for (first, count), result in zip(chunks, pending):
+                results.append(result)
+                if progress:
+                    progress(first + count, rounds[-1])
+
+            for sample_size in remaining:
+                scores[sample_size] = numpy.concatenate(
+                    [scores[sample_size]] + [repetition_results[sample_size][0][:, 0, 0]
+                                             for _, _, repetition_results, _ in results])
+            simulated += len(remaining) * (target - done)
+            done = target
+
+            eliminated, confirmed = _race_elimination({s: scores[s] for s in remaining}, within,
+                                                      comparison_confidence)
+            remaining = [s for s in remaining if s not in eliminated]
+            if len(remaining) == 1 or (confirmed and remaining[0] in confirmed):
+                break
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+        else:
+            for future in futures:
+                future.cancel()
+
+    if len(remaining) == 1 or remaining[0] in confirmed:
+        sample_size = remaining[0]
+    else:
+        # Not resolved: the smallest candidate that looks good enough so far
+        best = max(scores[s].mean() for s in remaining)
+        sample_size = next(s for s in remaining if scores[s].mean() >= (1 - within) * best)
+
+    stats = _RunningStats.from_values(scores[sample_size])
+    return {'sample_size': sample_size, 'score': float(stats.mean),
+            'confidence_interval': float(stats.confidence_interval(confidence)), 'repetitions': done,
+            'confirmed': len(remaining) == 1 or sample_size in confirmed, 'remaining': remaining,
+            'simulated': simulated, 'grid': len(sample_sizes) * done}
+
+
+def optimization_statement(result, within=0, confidence=.95):
+    """
+    :param result: The result of `optimize_sample_size`
+    :param within:
+    :param confidence:
+    :return: A sentence saying what the result of `optimize_sample_size` means and what it cost
+    """
+    if within:
+        claim = "is the smallest group size with an average score within {:g}% of the best".format(within * 100)
+    else:
+        claim = "has the best average score"
+    if result['confirmed']:
+        statement = "Group size {} {} ({:.2f} +/- {:.2f}) with {:g}% confidence after {} repetitions".format(
+            result['sample_size'], claim, result['score'], result['confidence_interval'], confidence * 100,
+            result['repetitions'])
+    else:
+        statement = "Group sizes {} are still in contention at {:g}% confidence after {} repetitions. Group size " \
+                    "{} looks best ({:.2f} +/- {:.2f})".format(' '.join(map(str, result['remaining'])),
+                                                               confidence * 100, result['repetitions'],
+                                                               result['sample_size'], result['score'],
+                                                               result['confidence_interval'])
+    return "{}. Simulated {} group size repetitions, {:.0%} of the {} of the full grid".format(
+        statement, result['simulated'], result['simulated'] / max(result['grid'], 1), result['grid'])
+
+
+def _binomial_survival(n, p):
+    """
+    P(X > k) for k = 0 .. n - 1 where X ~ Binomial(n, p)
+
+    :param n:
+    :param p:
+    :return:
+    """
+    if p <= 0:
+        return numpy.zeros(n)
+    if p >= 1:
+        return numpy.ones(n)
+
+    # Work with logs so large groups don't underflow. log(k!) for k = 0 .. n
+    log_factorials = numpy.concatenate([[0.], numpy.cumsum(numpy.log(numpy.arange(1, n + 1)))])
+    k = numpy.arange(0, n + 1)
+    pmf = numpy.exp(log_factorials[n] - log_factorials - log_factorials[::-1] + k * numpy.log(p) +
+                    (n - k) * numpy.log1p(-p))
+    return numpy.clip(numpy.cumsum(pmf[::-1])[::-1][1:], 0, 1)
+
+
+def _expected_group_confusion(probabilities, sample_labels, num_labels):
+    """
+    The expected confusion matrix of one group rated with `sample_labels`, when the true labels of the group's members
+    are independent draws from `probabilities`.
+
+    The group is sorted from low to high and position k gets `sample_labels[k]`. The true label at position k is the
+    k-th order statistic, and the k-th order statistic is at most v exactly when more than k members have a label of
+    at most v. So P(position k has label v) comes straight from binomial tails of the cumulative distribution.
+
+    :param probabilities: The probability of each true label
+    :param sample_labels:
+    :param num_labels:
+    :return: A (num_labels x num_labels) matrix of expected counts. Row is the true label, column is the rating
+    """
+    group_size = len(sample_labels)
+    confusion = numpy.zeros((num_labels, num_labels))
+    at_most_previous = numpy.zeros(group_size)
+    for label, cumulative_probability in enumerate(numpy.cumsum(probabilities)):
+        at_most_label = _binomial_survival(group_size, min(cumulative_probability, 1))
+        confusion[label] = numpy.bincount(sample_labels, weights=at_most_label - at_most_previous,
+                                          minlength=num_labels)
+        at_most_previous = at_most_label
+    return confusion
+
+
+def calculate_exact_stats(performance_bins, population_size, sample_sizes, rating_bins, payoffs, production,
+                          label_strategy='quantile', seed=None, productions=None, confidence=None, by_bin=False,
+                          progress=None):
+    """
+    Calculates the expected value of everything `calculate_monte_carlo_stats` reports for `simulate_ratings`, without
+    simulating. Expectations are linear, so the expected confusion matrix of a population is the sum of the expected
+    confusion matrices of its groups, including the smaller final group, and the expected scores and rating accuracy
+    follow from it exactly like they do for a simulated confusion matrix.
+
+    :param performance_bins:
+    :param population_size:
+    :param sample_sizes:
+    :param rating_bins:
+    :param payoffs:
+    :param production:
+    :param label_strategy:
+    :param seed: Seeds the oversample and monte carlo label strategies
+    :param productions:
+    :param confidence: If set, adds the (zero) confidence interval and (zero) number of repetitions columns
+    :param by_bin:
+    :param progress: Called with the number of sample sizes done and the number of sample sizes, before the first one
+    and after every one. An exception raised by it stops the calculation
+    :return: The same columns as `calculate_monte_carlo_stats`
+    """
+    # Like for simulations, bins after the last one that can occur aren't performance bins
+    num_bins = _num_bins(performance_bins)
+    probabilities = _bin_probabilities(performance_bins)[:num_bins]
+    _validate_productions(productions or [production], num_bins)
+
+    if seed is not None:
+        random.seed(seed)
+    get_sample_labels = _sample_labels_calculator(population_size=population_size, bins=rating_bins,
+                                                  strategy=label_strategy)
+
+    averages = []
+    if progress:
+        progress(0, len(sample_sizes))
+    for sample_size_idx, sample_size in enumerate(sample_sizes):
+        group_sizes = _rated_group_sizes(population_size=population_size, sample_size=sample_size)
+        sample_labels = [numpy.asarray(get_sample_labels(sample_size=group_size), dtype=numpy.intp)
+                         for group_size in group_sizes]
+        num_labels = max([num_bins] + [int(labels.max()) + 1 for labels in sample_labels if len(labels)])
+
+        # `population_size // sample_size` full groups, plus the final group when there is one
+        confusion = (population_size // sample_size) * _expected_group_confusion(probabilities, sample_labels[0],
+                                                                                  num_labels)
+        if len(group_sizes) > 1:
+            confusion += _expected_group_confusion(probabilities, sample_labels[1], num_labels)
+
+        scores, accuracy = _score_confusion(confusion=confusion[None], num_bins=num_bins,
+                                            productions=[list(p[:num_bins]) for p in productions or [production]],
+                                            payoffs=payoffs)
+        for production_idx, production_vector in enumerate(productions or [()]):
+            for payoff_idx, payoff in enumerate(payoffs):
+                average = [sample_size] + list(payoff) + list(production_vector) + \
+                    [float(scores[0, production_idx, payoff_idx])] + [float(a) for a in accuracy[0, 0:3]]
+                if confidence is not None:
+                    average += [0.0, 0]
+                if by_bin:
+                    average += [float(a) for a in accuracy[0, 3:]]
+                averages.append(average)
+        if progress:
+            progress(sample_size_idx + 1, len(sample_sizes))
+
+    return averages
+
+
+def default_sample_sizes(population_size):
+    """
+    The stack ranking group sizes to test when none are given: doublings from 5, then half the population and the
+    entire population
+
+    :param population_size:
+    :return:
+    """
+    sample_sizes = [5]
+    while sample_sizes[-1] * 2 < int(population_size / 2):
+        sample_sizes.append(sample_sizes[-1] * 2)
+
+    # always include half the population and the entire population
+    sample_sizes += [int(population_size / 2), population_size]
+    return sample_sizes
+
+
+def _read_vectors(f):
+    """
+    Reads one vector of numbers per CSV row, e.g. a payoff or a production vector per row
+
+    :param f:
+    :return:
+    """
+    return [tuple(float(value) for value in row) for row in csv.reader(f) if row]
 
 
 def print_simulation(f, scores):
@@ -294,49 +2408,353 @@ def print_simulation(f, scores):
         writer.writerow(score)
 
 
-def main(args):
+def print_profile(f, profiler):
+    """
+    Prints a summary table of the stages and label table lookups recorded by `profiler`
+
+    :param f:
+    :param profiler: A `_Profiler`
+    :return:
+    """
+    total_seconds = sum(seconds for seconds, _, _ in profiler.stages.values()) or 1
+    f.write("{:<20} {:>10} {:>10} {:>10} {:>7} {:>14}\n".format('stage', 'group size', 'calls', 'seconds', 'share',
+                                                                 'allocated MB'))
+    for (stage, group_size), (seconds, calls, allocated) in sorted(
+            profiler.stages.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+        f.write("{:<20} {:>10} {:>10} {:>10.3f} {:>6.1%} {:>14.1f}\n".format(
+            stage, '' if group_size is None else group_size, calls, seconds, seconds / total_seconds,
+            allocated / 1e6))
+
+    f.write("\n{:<20} {:>10} {:>10} {:>12}\n".format('label table', 'hits', 'misses', 'final group'))
+    for group_size, (hits, misses) in sorted(profiler.label_lookups.items()):
+        f.write("{:<20} {:>10} {:>10} {:>12}\n".format(group_size, hits, misses,
+                                                        'yes' if group_size in profiler.final_group_sizes else ''))
+    if profiler.dropped_events:
+        f.write("\n{} trace events past the first {} were dropped\n".format(profiler.dropped_events,
+                                                                            MAX_TRACE_EVENTS))
+
+
+def sample_sizes_from_args(args):
+    """
+    The group sizes the command line arguments `args` rate with
+
+    :param args:
+    :return:
+    """
+    if args.levels:
+        return list(args.levels)
     if args.sample_sizes:
-        sample_sizes = [int(s) for s in args.sample_sizes]
-    else:
-        sample_sizes = [5]
-        while sample_sizes[-1] * 2 < int(args.population / 2):
-            sample_sizes.append(sample_sizes[-1] * 2)
+        return [int(s) for s in args.sample_sizes]
+    return default_sample_sizes(population_size=args.population)
+
 
-        # always include half the population and the entire population
-        sample_sizes += [int(args.population / 2), args.population]
+def run_simulation(args, sample_labels=None, executor=None, progress=None, notes=None):
+    """
+    Runs what the command line arguments `args` ask for
+
+    :param args: The parsed arguments of `build_parser`
+    :param sample_labels: Passed to `simulate_ratings`
+    :param executor: Passed to `simulate_ratings`
+    :param progress: Called with the work done and the total work, see `simulate_ratings`. With variance reduction,
+    the pilot run is counted after the main run
+    :param notes: If set, a list that gets the sentences explaining the rows, like what the race of `--optimize` found
+    :return: The rows to print. Nothing with `--shard`, which writes its results to `--shard-file` instead, or with
+    `--generate-corpus`
+    """
+    if args.merge:
+        return merge_shards(args.merge)
+    if args.generate_corpus:
+        generate_corpus(args.generate_corpus, performance_bins=args.performance_bins, population_size=args.population,
+                        num_repetitions=args.num_repetitions, seed=args.seed,
+                        variance_reduction=args.variance_reduction)
+        return []
+    if args.shard and (args.exact or args.optimize or args.tolerance is not None):
+        raise ValueError("--shard doesn't support --exact, --optimize or --tolerance")
+    if args.shard and (args.seed is None or not args.shard_file):
+        raise ValueError("--shard needs a --seed shared by all the shards, and a --shard-file")
+    if args.state and (args.shard or args.exact or args.optimize):
+        raise ValueError("--state doesn't support --shard, --exact or --optimize")
+    if args.state and args.seed is None:
+        raise ValueError("--state needs a --seed, so that later runs draw the same populations")
+    if args.exact and (args.levels or args.observation_noise or args.corpus or args.variance_reduction != 'none'):
+        raise ValueError("--exact doesn't support --levels, --observation-noise, --corpus or --variance-reduction")
+    sample_sizes = sample_sizes_from_args(args)
 
     # payoffs = [(-1, 1, .5), (0, 1, .5), (0, 0, 0), (-.5, 1, .5), (-.25, 1, .5), (-.25, .5, .25)]
     payoffs = [(.5, 1.2, 1)]
+    if args.payoffs_file:
+        with open(args.payoffs_file) as f:
+            payoffs = _read_vectors(f)
+
+    productions = None
+    if args.productions_file:
+        with open(args.productions_file) as f:
+            productions = _read_vectors(f)
+
+    if args.optimize:
+        if args.levels or args.exact:
+            raise ValueError("--optimize doesn't support --levels or --exact")
+        if len(payoffs) != 1 or (productions and len(productions) != 1):
+            raise ValueError("--optimize needs exactly one payoff and one production vector")
+        result = optimize_sample_size(performance_bins=args.performance_bins,
+                                      population_size=args.population,
+                                      rating_bins=args.rating_bins,
+                                      payoff=payoffs[0],
+                                      production=productions[0] if productions else args.production,
+                                      sample_sizes=[int(s) for s in args.sample_sizes or []],
+                                      within=args.within / 100,
+                                      num_repetitions=args.num_repetitions,
+                                      max_repetitions=args.max_repetitions,
+                                      confidence=args.confidence,
+                                      engine=args.engine,
+                                      seed=args.seed,
+                                      label_strategy=args.label_strategy,
+                                      workers=args.workers,
+                                      observation_noise=args.observation_noise,
+                                      corpus=args.corpus,
+                                      sample_labels=sample_labels,
+                                      executor=executor,
+                                      progress=progress)
+        if notes is not None:
+            notes.append(optimization_statement(result, within=args.within / 100, confidence=args.confidence))
+        results = [[result['sample_size']] + list(payoffs[0]) + list(productions[0] if productions else []) +
+                   [result['score'], result['confidence_interval'], result['repetitions'], int(result['confirmed'])]]
+    elif args.exact:
+        results = calculate_exact_stats(performance_bins=args.performance_bins,
+                                        population_size=args.population,
+                                        sample_sizes=sample_sizes,
+                                        rating_bins=args.rating_bins,
+                                        payoffs=payoffs,
+                                        production=args.production,
+                                        label_strategy=args.label_strategy,
+                                        seed=args.seed,
+                                        productions=productions,
+                                        confidence=args.confidence,
+                                        by_bin=args.per_bin_accuracy,
+                                        progress=progress)
+    else:
+        profiler = None
+        if args.profile:
+            profiler = _Profiler()
+            tracemalloc.start()
+        # Left without a manifest, and so unreadable, if the simulation fails
+        store = RepetitionStoreWriter(args.store) if args.store else None
+        shard_runs = {'main': []} if args.shard else None
+        # The pilot run's progress is reported after the main run's
+        main_done = [0]
+
+        def main_progress(done, total):
+            main_done[0] = done
+            if progress:
+                progress(done, total)
+
+        def pilot_progress(done, total):
+            if progress:
+                progress(main_done[0] + done, main_done[0] + total)
+
+        states = None
+        if args.state:
+            states = read_state(args.state) if os.path.exists(args.state) else {}
+            states.setdefault('main', {})
+
+        rating_scores, rating_accuracy = simulate_ratings(performance_bins=args.performance_bins,
+                                                          population_size=args.population,
+                                                          sample_sizes=sample_sizes,
+                                                          rating_bins=args.rating_bins,
+                                                          payoffs=payoffs,
+                                                          production=args.production,
+                                                          num_repetitions=args.num_repetitions,
+                                                          engine=args.engine,
+                                                          seed=args.seed,
+                                                          label_strategy=args.label_strategy,
+                                                          workers=args.workers,
+                                                          tolerance=args.tolerance,
+                                                          max_repetitions=args.max_repetitions,
+                                                          confidence=args.confidence,
+                                                          productions=productions,
+                                                          variance_reduction=args.variance_reduction,
+                                                          common_random_numbers=not args.independent_groups,
+                                                          hierarchical=bool(args.levels),
+                                                          observation_noise=args.observation_noise,
+                                                          corpus=args.corpus,
+                                                          profiler=profiler,
+                                                          store=store,
+                                                          sample_labels=sample_labels,
+                                                          executor=executor,
+                                                          progress=main_progress,
+                                                          shard=args.shard,
+                                                          chunk_stats=shard_runs and shard_runs['main'],
+                                                          state=states and states['main'])
+        if store:
+            store.close()
+
+        if profiler:
+            tracemalloc.stop()
+            print_profile(stderr, profiler)
+            with open(args.profile, 'w') as f:
+                json.dump(profiler.chrome_trace(), f)
+
+        # Estimate how much the variance reduction helps from a plain run
+        plain_scores = None
+        if args.variance_reduction != 'none':
+            if shard_runs:
+                shard_runs['pilot'] = []
+            if states is not None:
+                states.setdefault('pilot', {})
+            plain_scores, _ = simulate_ratings(performance_bins=args.performance_bins,
+                                               population_size=args.population,
+                                               sample_sizes=sample_sizes,
+                                               rating_bins=args.rating_bins,
+                                               payoffs=payoffs,
+                                               production=args.production,
+                                               num_repetitions=min(args.num_repetitions,
+                                                                   VARIANCE_REDUCTION_PILOT_REPETITIONS),
+                                               engine=args.engine,
+                                               seed=args.seed,
+                                               label_strategy=args.label_strategy,
+                                               workers=args.workers,
+                                               productions=productions,
+                                               hierarchical=bool(args.levels),
+                                               observation_noise=args.observation_noise,
+                                               sample_labels=sample_labels,
+                                               executor=executor,
+                                               progress=pilot_progress,
+                                               shard=args.shard,
+                                               chunk_stats=shard_runs and shard_runs['pilot'],
+                                               state=states and states['pilot'])
+
+        if states is not None:
+            write_state(args.state, states)
+
+        if shard_runs:
+            experiment = {name: value for name, value in vars(args).items() if name not in SHARD_EXCLUDED_ARGUMENTS}
+            experiment.update(sample_sizes=sample_sizes, payoffs=[list(payoff) for payoff in payoffs],
+                              productions=productions and [list(production) for production in productions])
+            write_shard(args.shard_file, experiment=experiment, shard=args.shard, runs=shard_runs)
+            return []
+
+        results = calculate_monte_carlo_stats(scores=rating_scores, rating_accuracy=rating_accuracy,
+                                              confidence=args.confidence, by_bin=args.per_bin_accuracy,
+                                              plain_scores=plain_scores,
+                                              repetitions_per_sample=REPETITIONS_PER_SAMPLE[args.variance_reduction])
+    return results
 
-    rating_scores, rating_accuracy = simulate_ratings(performance_bins=args.performance_bins,
-                                                      population_size=args.population,
-                                                      sample_sizes=sample_sizes,
-                                                      rating_bins=args.rating_bins,
-                                                      payoffs=payoffs,
-                                                      production=args.production,
-                                                      num_repetitions=args.num_repetitions)
 
-    results = calculate_monte_carlo_stats(scores=rating_scores, rating_accuracy=rating_accuracy)
-    print_simulation(stdout, results)
+def main(args):
+    notes = []
+    print_simulation(stdout, run_simulation(args, notes=notes))
+    for note in notes:
+        print(note, file=stderr)
 
 
-if __name__ == "__main__":
+def _shard_argument(value):
+    """
+    Parses a shard of the form i/N, for shard i of N starting from 1
+
+    :param value:
+    :return: The (index, count) of the shard, with the index starting from 0
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ArgumentTypeError("Shards look like 2/8, not {}".format(value))
+    if not 1 <= index <= count:
+        raise ArgumentTypeError("Shard {} isn't one of 1/{} to {}/{}".format(value, count, count, count))
+    return index - 1, count
+
+
+def build_parser():
     parser = ArgumentParser(
         description="Demonstrates the effect of proper sample size usage in the context of a game with cost and payoff")
 
-    parser.add_argument("--performance-bins", type=int, nargs='+', default=[5, 10, 50, 25, 10],
+    parser.add_argument("--performance-bins", type=float, nargs='+', default=[5, 10, 50, 25, 10],
                         help="The true distribution of the population's performance")
-    parser.add_argument("--rating-bins", type=int, nargs='+', default=[5, 10, 50, 25, 10],
+    parser.add_argument("--rating-bins", type=float, nargs='+', default=[5, 10, 50, 25, 10],
                         help="The distribution the stack ranking policy assumes")
     parser.add_argument("--sample-sizes", type=int, nargs='+',
                         help="The sizes of stack ranking groups to test")
+    parser.add_argument("--levels", type=int, nargs='+',
+                        help="Rate hierarchically instead of testing --sample-sizes: the group size of each level, "
+                             "from teams up, e.g. 8 64 512. Each level calibrates the ratings of the level below")
     parser.add_argument("--population", type=int, default=200,
                         help="The total size of the organization being stack ranked")
     parser.add_argument("--num-repetitions", type=int, default=100,
-                        help="The number of Monte Carlo runs to use")
-    parser.add_argument("--production", type=int, nargs='+', default=[1.05, 1.1, 1.15, 1.2, 1.25],
+                        help="The number of Monte Carlo runs to use, or the minimum number with --tolerance")
+    parser.add_argument("--tolerance", type=float,
+                        help="Keep adding Monte Carlo runs until the confidence interval of every average score is "
+                             "within this much of the average")
+    parser.add_argument("--max-repetitions", type=int, default=100000,
+                        help="The most Monte Carlo runs to use with --tolerance")
+    parser.add_argument("--confidence", type=float, default=.95,
+                        help="The confidence level of the reported confidence intervals")
+    parser.add_argument("--production", type=float, nargs='+', default=[1.05, 1.1, 1.15, 1.2, 1.25],
                         help="The true production of employees in each performance bin")
+    parser.add_argument("--payoffs-file",
+                        help="CSV file of (underestimate, correct, overestimate) payoffs to score, one per row")
+    parser.add_argument("--productions-file",
+                        help="CSV file of production vectors to score instead of --production, one per row. Each "
+                             "production vector is added to the end of the run configuration columns")
+    parser.add_argument("--per-bin-accuracy", action='store_true',
+                        help="Also output the average underestimates, correct and overestimates for each true "
+                             "performance bin")
+    parser.add_argument("--exact", action='store_true',
+                        help="Calculate the expected results exactly instead of running Monte Carlo simulations")
+    parser.add_argument("--observation-noise", type=float, default=0, metavar='SIGMA',
+                        help="Give everyone a continuous performance within their performance bin and have managers "
+                             "rank noisy observations of it, with a standard deviation of SIGMA performance bins")
+    parser.add_argument("--optimize", action='store_true',
+                        help="Race the group sizes against each other, only simulating the ones still in contention, "
+                             "and output the group size with the best average score instead of every group size")
+    parser.add_argument("--within", type=float, default=0, metavar='PERCENT',
+                        help="With --optimize, find the smallest group size whose average score is within PERCENT "
+                             "of the best")
+    parser.add_argument("--engine", choices=ENGINES, default='python',
+                        help="Simulate one repetition at a time in pure python, or all repetitions at once with numpy")
+    parser.add_argument("--seed", type=int,
+                        help="Master seed that every repetition's random stream is derived from")
+    parser.add_argument("--variance-reduction", choices=VARIANCE_REDUCTION_SCHEMES, default='none',
+                        help="Stratify the populations' bin counts across repetitions, or draw populations in "
+                             "antithetic pairs. Also outputs the effective variance reduction")
+    parser.add_argument("--independent-groups", action='store_true',
+                        help="Rate an independent population with each group size, instead of using common random "
+                             "numbers across group sizes")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of processes to spread the repetitions across")
+    parser.add_argument("--profile", metavar='TRACE_FILE',
+                        help="Print the time, calls and allocated memory of each stage of the simulation and the label "
+                             "table cache hits to stderr, and save a Chrome trace (chrome://tracing, Perfetto) of "
+                             "the stages to TRACE_FILE. Tracing allocations slows the simulation down")
+    parser.add_argument("--store", metavar='DIRECTORY',
+                        help="Also write the score and rating accuracy of every Monte Carlo run of every configuration "
+                             "to a memory mapped columnar store in DIRECTORY. See `repetition_store.RepetitionStore`")
+    parser.add_argument("--shard", type=_shard_argument, metavar='I/N',
+                        help="Only run shard I of N disjoint shards of the Monte Carlo runs, e.g. one per machine, and "
+                             "write their stats to --shard-file for --merge instead of printing the results. Needs "
+                             "--seed")
+    parser.add_argument("--shard-file",
+                        help="The file to write the stats of --shard to")
+    parser.add_argument("--merge", nargs='+', metavar='SHARD_FILE',
+                        help="Print the results of an experiment from the --shard-file of each of its shards, exactly "
+                             "as one run of it would")
+    parser.add_argument("--generate-corpus", metavar='CORPUS_FILE',
+                        help="Generate the populations of --num-repetitions Monte Carlo runs of --performance-bins and "
+                             "--population (with --seed and --variance-reduction) once, and write them to CORPUS_FILE "
+                             "for --corpus instead of simulating")
+    parser.add_argument("--corpus", metavar='CORPUS_FILE',
+                        help="Read the populations from a --generate-corpus CORPUS_FILE instead of generating them, so "
+                             "runs with different rating bins or payoffs rate exactly the same populations. Defaults "
+                             "--seed to the seed of the corpus")
+    parser.add_argument("--state", metavar='STATE_FILE',
+                        help="Keep the outcome of every Monte Carlo run in STATE_FILE, and only simulate what it's "
+                             "missing: new group sizes, extra runs. Changing --production or payoffs only rescores. "
+                             "The output is the same as without it. Needs --seed")
+    parser.add_argument("--label-strategy", choices=SAMPLE_LABEL_STRATEGIES, default='quantile',
+                        help="How to map positions in a stack ranking group to ratings: exactly from the rating bin "
+                             "quantiles, or estimated by oversampling or monte carlo")
+    return parser
+
 
-    args = parser.parse_args()
+if __name__ == "__main__":
+    args = build_parser().parse_args()
 
     main(args)
@@ -0,0 +1,511 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Event
+
+from review_game import build_parser, run_simulation, sample_sizes_from_args, _rated_group_sizes
+
+# review_game.py options that don't make sense for a job: the server owns the workers, and profiles, stores, corpora
+# and states are written by the command line tool
+EXCLUDED_PARAMETERS = {'help', 'workers', 'profile', 'store', 'shard', 'shard_file', 'merge', 'generate_corpus',
+                       'state'}
+
+# The number of label tables and of job results the server keeps
+LABEL_CACHE_SIZE = 1024
+RESULT_CACHE_SIZE = 256
+
+# The number of finished jobs the server keeps, with their results. Older ones are forgotten, oldest first
+JOB_HISTORY_SIZE = 1024
+
+# Statuses of a job. A job ends in one of `FINISHED_STATUSES`
+JOB_STATUSES = ['queued', 'running', 'done', 'failed', 'cancelled']
+FINISHED_STATUSES = {'done', 'failed', 'cancelled'}
+
+# Parameters that name a file the job reads
+FILE_PARAMETERS = ['payoffs_file', 'productions_file', 'corpus']
+
+_HTTP_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                 500: 'Internal Server Error'}
+
+
+class LRUCache(object):
+    """
+    A dict that keeps at most `capacity` entries, evicting the least recently used one first
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'size': len(self), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses}
+
+
+def parse_job_args(params):
+    """
+    Turns the JSON parameters of a job into the arguments `review_game.run_simulation` takes. The parameters are the
+    options of `review_game.py`, named like the attributes argparse gives them (e.g. `sample_sizes` for
+    `--sample-sizes`), and options that aren't given get the same defaults as on the command line.
+
+    :param params: A dict of parameters
+    :return: An `argparse.Namespace`
+    """
+    if not isinstance(params, dict):
+        raise ValueError("Job parameters must be a JSON object")
+
+    parser = build_parser()
+    args = parser.parse_args([])
+    actions = {action.dest: action for action in parser._actions if action.dest not in EXCLUDED_PARAMETERS}
+
+    for name, value in params.items():
+        if name not in actions:
+            raise ValueError("Unknown parameter: {}".format(name))
+        action = actions[name]
+
+        if action.nargs == 0:
+            if not isinstance(value, bool):
+                raise ValueError("{} must be true or false".format(name))
+        elif value is not None:
+            if action.nargs == '+':
+                if not isinstance(value, list) or not value:
+                    raise ValueError("{} must be a non empty list".format(name))
+                value = [_convert(name, action, v) for v in value]
+            else:
+                value = _convert(name, action, value)
+            for v in value if action.nargs == '+' else [value]:
+                if action.choices is not None and v not in action.choices:
+                    raise ValueError("{} must be one of {}".format(name, ', '.join(map(str, action.choices))))
+        setattr(args, name, value)
+
+    for name in FILE_PARAMETERS:
+        path = getattr(args, name)
+        if path is not None and not (os.path.isfile(path) and os.access(path, os.R_OK)):
+            raise ValueError("{} isn't a readable file: {}".format(name, path))
+
+    return args
+
+
+def _convert(name, action, value):
+    """
+    Converts one JSON value of a parameter like argparse converts a command line value
+
+    :param name:
+    :param action: The argparse action of the parameter
+    :param value:
+    :return:
+    """
+    if action.type is None:
+        if not isinstance(value, str):
+            raise ValueError("{} must be a string, not {}".format(name, json.dumps(value)))
+        return value
+    if isinstance(value, (list, dict, bool)):
+        raise ValueError("{} must be a single value, not {}".format(name, json.dumps(value)))
+    try:
+        return action.type(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid {}: {}".format(name, json.dumps(value)))
+
+
+def _label_cache_key(args, group_size):
+    return args.label_strategy, tuple(args.rating_bins), args.population, group_size
+
+
+def _result_cache_key(args):
+    """
+    The key of a job's result. The files a job reads can change between jobs, so the key covers the contents of the
+    payoff and production files, and the identity of the corpus, which is too big to hash. It reads the files, so
+    it's called off the event loop
+
+    :param args:
+    :return:
+    """
+    key = [vars(args)]
+    for path in (args.payoffs_file, args.productions_file):
+        if path:
+            with open(path, 'rb') as f:
+                key.append(hashlib.sha256(f.read()).hexdigest())
+    if args.corpus:
+        stat = os.stat(args.corpus)
+        key.append([stat.st_ino, stat.st_size, stat.st_mtime_ns])
+    return json.dumps(key, sort_keys=True)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    """
+    A simulation queued on a `SimulationServer`. Its state is only changed from the server's event loop
+    """
+
+    def __init__(self, job_id, args, cache_key):
+        self.id = job_id
+        self.args = args
+        self.cache_key = cache_key
+        self.status = 'queued'
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.notes = []
+        self.error = None
+        # Checked by the simulation thread between chunks
+        self.cancel_requested = Event()
+        self.finished = asyncio.Event()
+        self._listeners = set()
+
+    def to_json(self):
+        return {'id': self.id, 'status': self.status, 'done': self.done, 'total': self.total, 'result': self.result,
+                'notes': self.notes, 'error': self.error}
+
+    def listen(self):
+        """
+        :return: A queue that gets the job's JSON every time it changes
+        """
+        queue = asyncio.Queue()
+        queue.put_nowait(self.to_json())
+        self._listeners.add(queue)
+        return queue
+
+    def stop_listening(self, queue):
+        self._listeners.discard(queue)
+
+    def update(self, **changes):
+        for name, value in changes.items():
+            setattr(self, name, value)
+        if self.status in FINISHED_STATUSES:
+            self.finished.set()
+        state = self.to_json()
+        for queue in self._listeners:
+            queue.put_nowait(state)
+
+
+class SimulationServer(object):
+    """
+    Runs review_game.py simulations for HTTP/JSON clients on localhost, keeping the things that make a cold run slow
+    warm between requests: a process pool the chunks of every job are simulated on, an LRU cache of label tables and
+    an LRU cache of the results of seeded jobs.
+
+    Jobs are queued and run `concurrent_jobs` at a time. Endpoints:
+
+    * POST /jobs: queue a job, with the parameters of `parse_job_args` as the JSON body. Returns the job
+    * POST /run: queue a job and wait for it to finish. Returns the finished job
+    * GET /jobs/<id>: the job, with its progress and, once it's done, its result rows
+    * GET /jobs/<id>/events: streams the job as newline delimited JSON every time it makes progress, until it finishes
+    * DELETE /jobs/<id>: cancel the job. Running jobs stop after their current chunk of repetitions, or with `exact`,
+    their current group size
+    * GET /stats: cache and queue statistics
+
+    Only the last `job_history_size` finished jobs are kept, so the jobs of a long running server don't grow without
+    bound. Jobs that were forgotten are not found.
+    """
+
+    def __init__(self, workers=os.cpu_count(), concurrent_jobs=1, label_cache_size=LABEL_CACHE_SIZE,
+                 result_cache_size=RESULT_CACHE_SIZE, job_history_size=JOB_HISTORY_SIZE):
+        self.workers = workers
+        self.labels = LRUCache(label_cache_size)
+        self.results = LRUCache(result_cache_size)
+        self.job_history_size = job_history_size
+        self.jobs = {}
+        # The ids of the finished jobs, from the first to finish
+        self._finished_jobs = OrderedDict()
+        self._job_ids = itertools.count(1)
+        self._concurrent_jobs = concurrent_jobs
+        self._queue = None
+        self._runners = []
+        self._threads = None
+        self._pool = None
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=8765):
+        """
+        Starts the workers and the job runners and listens for requests
+
+        :param host:
+        :param port: 0 picks a free port
+        :return: The port the server listens on
+        """
+        # Worker processes are started from a clean server process rather than forked from this threaded one
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+        self._threads = ThreadPoolExecutor(max_workers=self._concurrent_jobs)
+        await asyncio.gather(*[asyncio.wrap_future(self._pool.submit(_warm_up)) for _ in range(0, self.workers)])
+
+        self._queue = asyncio.Queue()
+        self._runners = [asyncio.create_task(self._run_jobs()) for _ in range(0, self._concurrent_jobs)]
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for job in self.jobs.values():
+            job.cancel_requested.set()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        for runner in self._runners:
+            runner.cancel()
+        if self._threads:
+            self._threads.shutdown(wait=True)
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+
+    async def submit(self, params):
+        """
+        Queues a job, or finishes it straight away if the result is cached
+
+        :param params: See `parse_job_args`
+        :return: The `Job`
+        """
+        args = parse_job_args(params)
+        # Unseeded jobs are random, so their results aren't reused
+        cache_key = None
+        if args.seed is not None:
+            cache_key = await asyncio.get_running_loop().run_in_executor(None, _result_cache_key, args)
+
+        job = Job(str(next(self._job_ids)), args, cache_key)
+        self.jobs[job.id] = job
+
+        result = self.results.get(cache_key) if cache_key else None
+        if result is not None:
+            self._finish(job, status='done', **result)
+        else:
+            self._queue.put_nowait(job)
+        return job
+
+    def cancel(self, job):
+        if job.status == 'queued':
+            self._finish(job, status='cancelled')
+        elif job.status == 'running':
+            job.cancel_requested.set()
+
+    def _finish(self, job, **changes):
+        """
+        Finishes a job, and forgets the oldest finished jobs past `job_history_size`
+
+        :param job:
+        :param changes: The final status and its details, see `Job.update`
+        :return:
+        """
+        job.update(**changes)
+        self._finished_jobs[job.id] = None
+        while len(self._finished_jobs) > self.job_history_size:
+            job_id, _ = self._finished_jobs.popitem(last=False)
+            del self.jobs[job_id]
+
+    async def _run_jobs(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if job.status != 'queued':
+                continue
+
+            job.update(status='running')
+            try:
+                result = await loop.run_in_executor(self._threads, self._simulate, job, loop)
+            except JobCancelled:
+                self._finish(job, status='cancelled')
+            except Exception as e:
+                self._finish(job, status='failed', error='{}: {}'.format(type(e).__name__, e))
+            else:
+                if job.cache_key:
+                    self.results.put(job.cache_key, result)
+                self._finish(job, status='done', **result)
+
+    def _simulate(self, job, loop):
+        """
+        Runs a job on a thread of `_threads`
+
+        :param job:
+        :param loop: The server's event loop
+        :return: The result rows, as JSON compatible lists, and the notes explaining them, as the `Job` attributes
+        """
+        args = job.args
+        args.workers = self.workers
+
+        # Fill in the label tables that are cached, and cache the ones the simulation calculates. The oversample and
+        # monte carlo tables depend on the random state, and so on the tables the job calculated before them, so
+        # only quantile tables are cached
+        sample_labels = {}
+        caches_labels = not args.exact and args.label_strategy == 'quantile'
+        if caches_labels:
+            for sample_size in sample_sizes_from_args(args):
+                for group_size in _rated_group_sizes(population_size=args.population, sample_size=sample_size):
+                    labels = self.labels.get(_label_cache_key(args, group_size))
+                    if labels is not None:
+                        sample_labels[group_size] = labels
+
+        def progress(done, total):
+            if job.cancel_requested.is_set():
+                raise JobCancelled()
+            loop.call_soon_threadsafe(lambda: job.update(done=done, total=total))
+
+        notes = []
+        rows = run_simulation(args, sample_labels=sample_labels if caches_labels else None, executor=self._pool,
+                              progress=progress, notes=notes)
+        if caches_labels:
+            for group_size, labels in sample_labels.items():
+                self.labels.put(_label_cache_key(args, group_size), labels)
+        return {'result': [[float(value) if isinstance(value, float) else value for value in row] for row in rows],
+                'notes': notes}
+
+    def stats(self):
+        return {'labels': self.labels.stats(), 'results': self.results.stats(), 'workers': self.workers,
+                'jobs': {status: len([job for job in self.jobs.values() if job.status == status])
+                         for status in JOB_STATUSES}}
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                method, path, body = await _read_request(reader)
+                await self._route(method, path, body, writer)
+            except (ValueError, json.JSONDecodeError) as e:
+                _write_response(writer, 400, {'error': str(e)})
+            except KeyError as e:
+                _write_response(writer, 404, {'error': 'Not found: {}'.format(e.args[0])})
+            except ConnectionError:
+                raise
+            except Exception as e:
+                _write_response(writer, 500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body, writer):
+        parts = [part for part in path.split('?')[0].split('/') if part]
+
+        if parts == ['stats'] and method == 'GET':
+            _write_response(writer, 200, self.stats())
+        elif parts == ['jobs'] and method == 'POST':
+            _write_response(writer, 202, (await self.submit(json.loads(body or b'{}'))).to_json())
+        elif parts == ['run'] and method == 'POST':
+            job = await self.submit(json.loads(body or b'{}'))
+            await job.finished.wait()
+            _write_response(writer, 200, job.to_json())
+        elif len(parts) == 2 and parts[0] == 'jobs' and method in ('GET', 'DELETE'):
+            job = self.jobs[parts[1]]
+            if method == 'DELETE':
+                self.cancel(job)
+            _write_response(writer, 200, job.to_json())
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events' and method == 'GET':
+            await self._stream_events(self.jobs[parts[1]], writer)
+        elif parts and parts[0] in ('stats', 'jobs', 'run'):
+            _write_response(writer, 405, {'error': 'Method not allowed'})
+        else:
+            raise KeyError(path)
+
+    async def _stream_events(self, job, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n'
+                     b'Connection: close\r\n\r\n')
+        queue = job.listen()
+        try:
+            while True:
+                state = await queue.get()
+                line = json.dumps(state).encode('utf-8') + b'\n'
+                writer.write('{:x}\r\n'.format(len(line)).encode('ascii') + line + b'\r\n')
+                await writer.drain()
+                if state['status'] in FINISHED_STATUSES:
+                    break
+        finally:
+            job.stop_listening(queue)
+        writer.write(b'0\r\n\r\n')
+
+
+def _warm_up():
+    return os.getpid()
+
+
+async def _read_request(reader):
+    """
+    Reads an HTTP/1.1 request
+
+    :param reader:
+    :return: The method, the path and the body
+    """
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) != 3:
+        raise ValueError("Malformed request line")
+    method, path, _ = request_line
+
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, body
+
+
+def _write_response(writer, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                 .format(status, _HTTP_REASONS[status], len(body)).encode('latin-1') + body)
+
+
+async def serve(args):
+    server = SimulationServer(workers=args.workers, concurrent_jobs=args.concurrent_jobs,
+                              label_cache_size=args.label_cache_size, result_cache_size=args.result_cache_size,
+                              job_history_size=args.job_history_size)
+    port = await server.start(host='127.0.0.1', port=args.port)
+    print("Listening on http://127.0.0.1:{}".format(port), flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main(args):
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Serves review_game.py simulations over HTTP/JSON on localhost, with warm "
+                                        "workers and cached label tables and results")
+
+    parser.add_argument("--port", type=int, default=8765, help="The port to listen on")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="The number of worker processes to simulate with")
+    parser.add_argument("--concurrent-jobs", type=int, default=1,
+                        help="The number of jobs to run at once. Jobs with the oversample or monte carlo label "
+                             "strategies are only reproducible one at a time")
+    parser.add_argument("--label-cache-size", type=int, default=LABEL_CACHE_SIZE,
+                        help="The number of label tables to keep")
+    parser.add_argument("--result-cache-size", type=int, default=RESULT_CACHE_SIZE,
+                        help="The number of results of seeded jobs to keep")
+    parser.add_argument("--job-history-size", type=int, default=JOB_HISTORY_SIZE,
+                        help="The number of finished jobs to keep, with their results")
+
+    args = parser.parse_args()
+
+    main(args)
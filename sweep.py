@@ -0,0 +1,278 @@
+import csv
+import hashlib
+import io
+import itertools
+import json
+import os
+from argparse import ArgumentParser
+from collections import Counter
+
+from review_game import simulate_ratings, calculate_monte_carlo_stats, default_sample_sizes, _rated_group_sizes
+
+# Grid spec keys that hold a list of values to sweep over. Every combination of their values is one cell of the grid
+GRID_AXES = ['performance_bins', 'rating_bins', 'population', 'production', 'sample_sizes']
+
+# Grid spec keys that apply to every cell, and their defaults
+GRID_SETTINGS = {
+    'payoffs': [[.5, 1.2, 1]],
+    'num_repetitions': 100,
+    'seed': 0,
+    'engine': 'python',
+    'label_strategy': 'quantile',
+    'confidence': .95,
+}
+
+
+# Part of the key of every cell result. Bump it whenever review_game.py gives different results for the same cell, e.g.
+# when populations are drawn differently, so results of the old code aren't replayed as current
+RESULT_VERSION = 1
+
+
+def _hash(value):
+    """
+    Content address of a JSON serializable value
+
+    :param value:
+    :return:
+    """
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _cell_hash(cell):
+    """
+    The key of a cell's results, in the cache and in the output
+
+    :param cell:
+    :return:
+    """
+    return _hash([RESULT_VERSION, cell])
+
+
+def expand_grid(spec):
+    """
+    Expands a grid spec into one configuration per cell. Each cell rates with a single group size, so that adding a
+    group size to the grid only adds cells. Because every repetition's population only depends on the seed, cells
+    that only differ by group size still rate the same populations.
+
+    Example spec:
+
+    {"performance_bins": [[5, 10, 50, 25, 10]], "rating_bins": [[5, 10, 50, 25, 10], [10, 10, 50, 20, 10]],
+     "population": [200, 1000], "sample_sizes": [8, 16, 32], "num_repetitions": 1000, "seed": 1}
+
+    `sample_sizes` is optional and defaults to the group sizes `review_game.py` tests for each population.
+
+    :param spec: Lists of values for each of `GRID_AXES`, and optional overrides of `GRID_SETTINGS`
+    :return: A list of configurations
+    """
+    unknown = set(spec) - set(GRID_AXES) - set(GRID_SETTINGS)
+    if unknown:
+        raise ValueError("Unknown grid spec keys: {}".format(', '.join(sorted(unknown))))
+
+    settings = dict(GRID_SETTINGS)
+    settings.update({key: value for key, value in spec.items() if key in GRID_SETTINGS})
+
+    cells = []
+    for performance_bins, rating_bins, population, production in itertools.product(
+            spec['performance_bins'], spec['rating_bins'], spec['population'],
+            spec.get('production', [[1.05, 1.1, 1.15, 1.2, 1.25]])):
+        for sample_size in spec.get('sample_sizes') or default_sample_sizes(population_size=population):
+            cell = dict(settings, performance_bins=performance_bins, rating_bins=rating_bins, population=population,
+                        production=production, sample_size=sample_size)
+            cells.append(cell)
+    return cells
+
+
+class ResultCache(object):
+    """
+    A local, content addressed cache of aggregated cell results and of sample label tables. Entries are files named by
+    the hash of everything that determines their content, written atomically so an interrupted sweep never leaves a
+    partial entry behind.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, '{}.json'.format(key))
+
+    def _read(self, kind, key):
+        try:
+            with open(self._path(kind, key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, kind, key, value):
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(value, f)
+        os.replace(path + '.tmp', path)
+
+    def get_result(self, cell):
+        return self._read('results', _cell_hash(cell))
+
+    def put_result(self, cell, rows):
+        self._write('results', _cell_hash(cell), rows)
+
+    @staticmethod
+    def _labels_key(cell, group_size):
+        return _hash([cell['label_strategy'], cell['rating_bins'], cell['population'], group_size])
+
+    @staticmethod
+    def _caches_labels(cell):
+        # The oversample and monte carlo tables depend on the random state, and so on the tables the cell calculated
+        # before them. Only the quantile tables are the same in every cell
+        return cell['label_strategy'] == 'quantile'
+
+    def get_sample_labels(self, cell, group_sizes):
+        """
+        :param cell:
+        :param group_sizes:
+        :return: Group size => sample labels, for the group sizes that are cached. Only quantile tables are cached
+        """
+        sample_labels = {}
+        if not self._caches_labels(cell):
+            return sample_labels
+        for group_size in group_sizes:
+            labels = self._read('labels', self._labels_key(cell, group_size))
+            if labels is not None:
+                sample_labels[group_size] = labels
+        return sample_labels
+
+    def put_sample_labels(self, cell, sample_labels):
+        if not self._caches_labels(cell):
+            return
+        for group_size, labels in sample_labels.items():
+            self._write('labels', self._labels_key(cell, group_size), [int(label) for label in labels])
+
+
+def run_cell(cell, cache, workers=1):
+    """
+    Gets the aggregated results of one cell from the cache, or simulates and caches them
+
+    :param cell:
+    :param cache:
+    :param workers:
+    :return: The rows `calculate_monte_carlo_stats` gives for the cell
+    """
+    rows = cache.get_result(cell)
+    if rows is not None:
+        return rows
+
+    group_sizes = _rated_group_sizes(population_size=cell['population'], sample_size=cell['sample_size'])
+    sample_labels = cache.get_sample_labels(cell, group_sizes)
+    rating_scores, rating_accuracy = simulate_ratings(performance_bins=cell['performance_bins'],
+                                                      population_size=cell['population'],
+                                                      sample_sizes=[cell['sample_size']],
+                                                      rating_bins=cell['rating_bins'],
+                                                      payoffs=[tuple(payoff) for payoff in cell['payoffs']],
+                                                      production=cell['production'],
+                                                      num_repetitions=cell['num_repetitions'],
+                                                      engine=cell['engine'],
+                                                      seed=cell['seed'],
+                                                      label_strategy=cell['label_strategy'],
+                                                      workers=workers,
+                                                      confidence=cell['confidence'],
+                                                      sample_labels=sample_labels)
+    cache.put_sample_labels(cell, sample_labels)
+
+    rows = calculate_monte_carlo_stats(scores=rating_scores, rating_accuracy=rating_accuracy,
+                                       confidence=cell['confidence'])
+    cache.put_result(cell, rows)
+    return rows
+
+
+def _completed_cells(output_path, cells):
+    """
+    The hashes of the cells that already have all their rows in the output file. An interrupted sweep can leave a
+    cell with only some of its rows, or a last line that was cut off. Those rows are removed from the output, so their
+    cells are run again. Rows of cells that aren't in `cells` are kept as they are.
+
+    :param output_path:
+    :param cells:
+    :return:
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, newline='') as f:
+        lines = f.readlines()
+
+    kept = lines
+    if kept and not kept[-1].endswith('\n'):
+        kept = kept[:-1]
+    # Each cell has one row per payoff
+    num_rows = {_cell_hash(cell): len(cell['payoffs']) for cell in cells}
+    hashes = [line.split(',', 1)[0] for line in kept]
+    counts = Counter(hashes)
+    completed = {cell_hash for cell_hash, count in counts.items() if num_rows.get(cell_hash) == count}
+    kept = [line for line, cell_hash in zip(kept, hashes) if cell_hash in completed or cell_hash not in num_rows]
+
+    if len(kept) != len(lines):
+        with open(output_path + '.tmp', 'w', newline='') as f:
+            f.writelines(kept)
+        os.replace(output_path + '.tmp', output_path)
+    return completed
+
+
+def run_sweep(spec, output_path, cache_dir, workers=1):
+    """
+    Runs every cell of the grid that isn't in `output_path` yet and appends its rows, one cell at a time, so an
+    interrupted sweep picks up where it left off. Each row is the cell's hash, its performance bins, rating bins,
+    population and production, followed by the columns of `calculate_monte_carlo_stats`. A cell's rows are appended
+    with a single write.
+
+    :param spec:
+    :param output_path:
+    :param cache_dir:
+    :param workers:
+    :return: The number of cells that were added to the output
+    """
+    cache = ResultCache(cache_dir)
+    cells = expand_grid(spec)
+    completed = _completed_cells(output_path, cells)
+
+    added = 0
+    with open(output_path, 'a', newline='') as f:
+        for cell in cells:
+            cell_hash = _cell_hash(cell)
+            if cell_hash in completed:
+                continue
+
+            rows = io.StringIO()
+            writer = csv.writer(rows)
+            for row in run_cell(cell, cache, workers=workers):
+                writer.writerow([cell_hash,
+                                 ' '.join(str(b) for b in cell['performance_bins']),
+                                 ' '.join(str(b) for b in cell['rating_bins']),
+                                 cell['population'],
+                                 ' '.join(str(p) for p in cell['production'])] + row)
+            f.write(rows.getvalue())
+            f.flush()
+            completed.add(cell_hash)
+            added += 1
+
+    return added
+
+
+def main(args):
+    with open(args.grid) as f:
+        spec = json.load(f)
+    run_sweep(spec=spec, output_path=args.output, cache_dir=args.cache_dir, workers=args.workers)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Runs review_game.py simulations for every cell of a parameter grid, "
+                                        "skipping cells that are already in the output or the cache")
+
+    parser.add_argument("grid", help="JSON grid spec. See `expand_grid`")
+    parser.add_argument("--output", required=True,
+                        help="CSV file to append the results to. Cells already in it are skipped")
+    parser.add_argument("--cache-dir", default='.review_game_cache',
+                        help="Directory for cached cell results and sample label tables")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of processes to spread each cell's repetitions across")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,48 @@
+import pytest
+
+from benchmark_review_game import benchmark_cases, run_benchmarks, compare_results, BENCHMARK_STAGES
+
+
+def test_benchmark_cases():
+    cases = benchmark_cases(grid={'population': [100, 1000], 'repetitions': [1, 10]},
+                            stages=['generate_population', 'rate_population_matrix'], max_employees=1000)
+    assert [{'stage': 'generate_population', 'population': 100, 'num_bins': 3},
+            {'stage': 'generate_population', 'population': 100, 'num_bins': 5}] == cases[:2]
+    assert 6 == len([case for case in cases if case['stage'] == 'generate_population'])
+    # 1000 employees x 10 repetitions is over the limit
+    assert 18 == len([case for case in cases if case['stage'] == 'rate_population_matrix'])
+
+    with pytest.raises(ValueError):
+        benchmark_cases(stages=['rate_everyone'])
+
+
+def test_run_benchmarks():
+    cases = benchmark_cases(grid={'population': [50], 'group_size': [8], 'num_bins': [5], 'repetitions': [2]})
+    baseline = run_benchmarks(cases, rounds=1)
+
+    assert sorted(BENCHMARK_STAGES) == sorted(result['stage'] for result in baseline['results'])
+    for result in baseline['results']:
+        assert 0 < result['employees_per_second']
+        assert 0 < result['peak_memory']
+
+
+def test_compare_results():
+    baseline = {'results': [
+        {'stage': 'rate_population', 'population': 100, 'group_size': 8, 'num_bins': 5, 'seconds': .1,
+         'employees_per_second': 1000., 'peak_memory': 1000},
+        {'stage': 'score_ratings', 'population': 100, 'num_bins': 5, 'seconds': .1, 'employees_per_second': 1000.,
+         'peak_memory': 1000},
+    ]}
+    current = {'results': [
+        dict(baseline['results'][0], employees_per_second=850., peak_memory=1300),
+        dict(baseline['results'][1], employees_per_second=700.),
+        {'stage': 'score_ratings', 'population': 1000, 'num_bins': 5, 'seconds': 1., 'employees_per_second': 1.,
+         'peak_memory': 10 ** 9},
+    ]}
+
+    assert [({'stage': 'rate_population', 'population': 100, 'group_size': 8, 'num_bins': 5}, 'peak_memory', 1000,
+             1300),
+            ({'stage': 'score_ratings', 'population': 100, 'num_bins': 5}, 'employees_per_second', 1000., 700.)] == \
+        compare_results(baseline, current)
+    assert [] == compare_results(baseline, current, threshold=.5)
+    assert [] == compare_results(baseline, baseline)
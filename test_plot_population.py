@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('matplotlib')
+
+import matplotlib  # noqa: E402
+
+matplotlib.use('Agg')
+
+from plot_population import _sample_grid, draw_samples, draw_averages  # noqa: E402
+
+
+def test__sample_grid():
+    population = [3, 1, 2, 0, 4, 4, 1, 1, 2, 2, 0, 0]
+    samples, averages = _sample_grid(population, sample_size=3, rows=2, cols=2)
+    assert [[[1, 2, 3], [0, 4, 4]], [[1, 1, 2], [0, 0, 2]]] == samples.tolist()
+    assert [[2.0, 2.7], [1.3, 0.7]] == averages
+
+
+def test_draw_samples():
+    population = [3, 1, 2, 0, 4, 4, 1, 1, 2, 2, 0, 0]
+    for draw in (draw_samples, draw_averages):
+        fig = draw(population, sample_size=3, rows=2, cols=2)
+        assert 1 == len(fig.axes)
+        assert ['2.0', '2.7', '1.3', '0.7'] == [text.get_text() for text in fig.axes[0].texts]
+        # The 9 non empty bars
+        assert 9 == len(fig.axes[0].collections[0].get_paths())
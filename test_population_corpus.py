@@ -0,0 +1,57 @@
+import os
+
+import numpy
+import pytest
+
+from population_corpus import PopulationCorpusWriter, PopulationCorpus, CORPUS_ALIGNMENT
+
+
+def test_corpus(tmpdir):
+    path = str(tmpdir.join('populations.corpus'))
+    populations = numpy.arange(5 * 7, dtype=numpy.uint8).reshape(5, 7) % 4
+    with PopulationCorpusWriter(path, metadata={'performance_bins': [25., 50., 25.], 'seed': 1}, num_repetitions=5,
+                                population_size=7) as writer:
+        writer.write(populations[:2])
+        writer.write(populations[2:].tolist())
+        writer.write(populations[:0])
+
+    corpus = PopulationCorpus(path)
+    assert 5 == len(corpus)
+    assert 7 == corpus.population_size
+    assert [25., 50., 25.] == corpus.metadata['performance_bins']
+    assert 1 == corpus.metadata['seed']
+    assert isinstance(corpus.populations, numpy.memmap)
+    assert numpy.array_equal(populations, corpus.populations)
+    # One uint8 per member, after an aligned header
+    assert 0 == (os.path.getsize(path) - populations.size) % CORPUS_ALIGNMENT
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_corpus_empty(tmpdir):
+    path = str(tmpdir.join('populations.corpus'))
+    PopulationCorpusWriter(path, metadata={}, num_repetitions=0, population_size=10).close()
+    corpus = PopulationCorpus(path)
+    assert 0 == len(corpus)
+    assert (0, 10) == corpus.populations.shape
+
+
+def test_corpus_errors(tmpdir):
+    path = str(tmpdir.join('populations.corpus'))
+    with pytest.raises(ValueError):
+        with PopulationCorpusWriter(path, metadata={}, num_repetitions=2, population_size=3) as writer:
+            writer.write(numpy.zeros((2, 4)))
+    with pytest.raises(ValueError):
+        with PopulationCorpusWriter(path, metadata={}, num_repetitions=2, population_size=3) as writer:
+            writer.write(numpy.zeros((3, 3)))
+
+    # An unfinished corpus is never moved into place
+    with pytest.raises(ValueError):
+        with PopulationCorpusWriter(path, metadata={}, num_repetitions=2, population_size=3) as writer:
+            writer.write(numpy.zeros((1, 3)))
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.tmp')
+
+    with open(path, 'wb') as f:
+        f.write(b'not a corpus')
+    with pytest.raises(ValueError):
+        PopulationCorpus(path)
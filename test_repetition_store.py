@@ -0,0 +1,57 @@
+import numpy
+import pytest
+
+from repetition_store import RepetitionStoreWriter, RepetitionStore
+
+
+def _records(configuration, repetitions):
+    return dict(configuration=[configuration] * len(repetitions), repetition=repetitions,
+                score=[r * 1.5 for r in repetitions], underestimates=[1] * len(repetitions),
+                correct=[2] * len(repetitions), overestimates=[3] * len(repetitions))
+
+
+def test_store(tmpdir):
+    path = str(tmpdir.join('store'))
+    with RepetitionStoreWriter(path) as writer:
+        assert 0 == writer.configuration_id((5, .5, 1.2, 1))
+        assert 1 == writer.configuration_id((10, .5, 1.2, 1))
+        assert 0 == writer.configuration_id([5, .5, 1.2, 1])
+        writer.write(**_records(0, [0, 1, 2]))
+        writer.write(**_records(1, [0, 1]))
+        writer.write(**_records(1, []))
+
+    store = RepetitionStore(path)
+    assert 5 == len(store)
+    assert [(5, .5, 1.2, 1), (10, .5, 1.2, 1)] == store.configurations
+    assert isinstance(store['score'], numpy.memmap)
+    assert [0, 0, 0, 1, 1] == store['configuration'].tolist()
+    assert [0, 1, 2, 0, 1] == store['repetition'].tolist()
+    assert [0., 1.5, 3., 0., 1.5] == store['score'].tolist()
+    assert [3] * 5 == store['overestimates'].tolist()
+
+    chunks = list(store.chunks(rows_per_chunk=2))
+    assert [[0, 1], [2, 0], [1]] == [chunk['repetition'].tolist() for chunk in chunks]
+    assert numpy.shares_memory(chunks[1]['score'], store['score'])
+
+
+def test_store_empty(tmpdir):
+    path = str(tmpdir.join('store'))
+    RepetitionStoreWriter(path).close()
+    store = RepetitionStore(path)
+    assert 0 == len(store)
+    assert [] == list(store.chunks())
+    assert 0 == len(store['score'])
+
+
+def test_store_write_errors(tmpdir):
+    path = str(tmpdir.join('store'))
+    with pytest.raises(ValueError):
+        with RepetitionStoreWriter(path) as writer:
+            writer.write(**dict(_records(0, [0, 1]), score=[1.]))
+
+    # An unfinished store can't be read
+    with pytest.raises(FileNotFoundError):
+        RepetitionStore(path)
+
+    with pytest.raises(ValueError):
+        RepetitionStoreWriter(path).write(configuration=[0])
@@ -1,8 +1,23 @@
+import io
+import itertools
+import random
+
+import numpy
 import pytest
 
+from repetition_store import RepetitionStoreWriter, RepetitionStore
+
 from review_game import _map_bins_to_labels, _generate_population, _calculate_sample_labels_oversample, \
     _rate_population, _score_ratings, _sample_labels_calculator, calculate_monte_carlo_stats, \
-    _get_rating_accuracy_stats, simulate_ratings
+    _get_rating_accuracy_stats, simulate_ratings, _rate_population_matrix, _calculate_sample_labels_quantile, \
+    _rated_group_sizes, _RunningStats, _confusion_matrix, _confusion_matrices, _get_rating_accuracy_by_bin, \
+    _score_confusion, _read_vectors, _binomial_survival, calculate_exact_stats, _stratified_counts, \
+    _repetition_strata, _generate_repetition_population, STRATIFIED_BLOCK_SIZE, REPETITIONS_PER_SAMPLE, \
+    _validate_levels, _rate_hierarchy, _simulate_repetitions_hierarchical, _Profiler, print_profile, \
+    MAX_TRACE_EVENTS, _racing_rounds, _race_elimination, optimize_sample_size, optimization_statement, \
+    _observe_population_matrix, build_parser, run_simulation, merge_shards, _AliasSampler, _bin_probabilities, \
+    _num_bins, _generate_population_matrix, ALIAS_COLUMNS, generate_corpus, write_state, read_state
+from population_corpus import PopulationCorpus
 
 
 def test__map_bins_to_labels():
@@ -37,6 +52,141 @@ def test__calculate_sample_label_oversample():
     assert (0 * 15 + 20 * 1 + 65 * 2) / 100 == pytest.approx(sum(labels) / len(labels), .1)
 
 
+def test__calculate_sample_labels_quantile():
+    assert [0] + [1] * 2 + [2] * 7 == _calculate_sample_labels_quantile(sample_size=10, bins=[10, 20])
+    assert [0, 2, 2, 2, 2] == _calculate_sample_labels_quantile(sample_size=5, bins=[20, 0])
+    assert [0] * 4 == _calculate_sample_labels_quantile(sample_size=4, bins=[100])
+    assert [1] * 3 == _calculate_sample_labels_quantile(sample_size=3, bins=[0])
+    assert [] == _calculate_sample_labels_quantile(sample_size=0, bins=[10, 20])
+
+    # A position exactly on a bin boundary gets the higher label, like the oversampled population does
+    assert [0, 1, 1, 1] == _calculate_sample_labels_quantile(sample_size=4, bins=[37.5])
+
+    # Converges with the oversampled labels
+    for sample_size in (3, 7, 13):
+        for bins in ([5, 10, 50, 25, 10], [15, 20]):
+            labels = _calculate_sample_labels_quantile(sample_size=sample_size, bins=bins)
+            assert sum(labels) == pytest.approx(
+                sum(_calculate_sample_labels_oversample(sample_size=sample_size, bins=bins,
+                                                        population_size=100000)), abs=1)
+
+
+def test__sample_labels_calculator():
+    get_sample_labels = _sample_labels_calculator(population_size=4, bins=[10, 20])
+    assert [1, 2, 2, 2] == get_sample_labels(sample_size=10)
+    assert [1, 2] == get_sample_labels(sample_size=2)
+
+    get_sample_labels = _sample_labels_calculator(population_size=100, bins=[10, 20], strategy='oversample')
+    assert [0] + [1] * 2 + [2] * 7 == get_sample_labels(sample_size=10)
+
+    with pytest.raises(ValueError):
+        _sample_labels_calculator(population_size=100, bins=[10, 20], strategy='unknown')
+
+
+def test__rated_group_sizes():
+    assert [5] == _rated_group_sizes(population_size=10, sample_size=5)
+    assert [4, 2] == _rated_group_sizes(population_size=10, sample_size=4)
+    assert [20, 10] == _rated_group_sizes(population_size=10, sample_size=20)
+
+
+def test__generate_population_antithetic():
+    population = _generate_population(bins=[50], population_size=100, rng=random.Random(1))
+    antithetic = _generate_population(bins=[50], population_size=100, rng=random.Random(1), antithetic=True)
+    assert [1 - label for label in population] == antithetic
+
+
+@pytest.mark.parametrize('weights', [[1], [.5, 99.5], [5, 10, 50, 25, 10], [0, 3, 0, 1], list(range(1, 40))])
+def test__AliasSampler(weights):
+    sampler = _AliasSampler(weights)
+    probabilities = numpy.array(weights) / sum(weights)
+
+    # The tables give every label exactly its probability
+    table_probabilities = numpy.bincount(numpy.arange(ALIAS_COLUMNS), weights=sampler.probabilities,
+                                         minlength=ALIAS_COLUMNS) + \
+        numpy.bincount(sampler.aliases, weights=1 - sampler.probabilities, minlength=ALIAS_COLUMNS)
+    assert probabilities == pytest.approx(table_probabilities[:len(weights)] / ALIAS_COLUMNS, abs=1e-12)
+    assert 0 == pytest.approx(table_probabilities[len(weights):].sum(), abs=1e-12)
+
+    rng = random.Random(1)
+    draws = [sampler.draw(rng) for _ in range(0, 20000)]
+    assert probabilities == pytest.approx(numpy.bincount(draws, minlength=len(weights)) / len(draws), abs=.015)
+
+    population = numpy.empty(100001, dtype=numpy.uint8)
+    sampler.fill(population, numpy.random.default_rng(1))
+    assert probabilities == pytest.approx(numpy.bincount(population, minlength=len(weights)) / len(population),
+                                          abs=.005)
+
+    # Filling even sized parts draws the same as filling all at once
+    parts = numpy.empty_like(population)
+    rng = numpy.random.default_rng(1)
+    sampler.fill(parts[:5000], rng)
+    sampler.fill(parts[5000:], rng)
+    assert numpy.array_equal(population, parts)
+
+    inverse = numpy.empty(1000, dtype=numpy.uint8)
+    antithetic = numpy.empty(1000, dtype=numpy.uint8)
+    sampler.fill_inverse(inverse, numpy.random.default_rng(2))
+    sampler.fill_inverse(antithetic, numpy.random.default_rng(2), antithetic=True)
+    if len(weights) == 2:
+        assert numpy.array_equal(inverse[inverse != antithetic], 1 - antithetic[inverse != antithetic])
+
+
+def test__AliasSampler_errors():
+    for weights in ([], [0, 0], [1, -1], [1] * (ALIAS_COLUMNS + 1)):
+        with pytest.raises(ValueError):
+            _AliasSampler(weights)
+
+
+def test__bin_probabilities():
+    assert [.005, .995] == pytest.approx(_bin_probabilities([.5]))
+    assert [.333, .333, .334] == pytest.approx(_bin_probabilities([33.3, 33.3, 33.4]))
+    assert 3 == _num_bins([33.3, 33.3, 33.4])
+    assert 2 == _num_bins([50, 50, 0])
+    with pytest.raises(ValueError):
+        _bin_probabilities([60, 50])
+
+    # Fractional bins work end to end
+    populations = _generate_population_matrix(bins=[.5, 99.5], population_size=100000, entropy=1, repetitions=[0])
+    assert .005 == pytest.approx(1 - populations.mean(), abs=.001)
+
+
+def test__stratified_counts():
+    assert [0, 0, 10] == _stratified_counts(bins=[0, 0], population_size=10, strata=[.5, .5])
+    assert [1000] == _stratified_counts(bins=[100], population_size=1000, strata=[.5])
+    assert [2, 0, 2, 0] == _stratified_counts(bins=[50, 0, 25], population_size=4, strata=[.6, .3, .9])
+    assert [0, 0] == _stratified_counts(bins=[50], population_size=0, strata=[.5])
+
+    counts = _stratified_counts(bins=[5, 10, 50, 25], population_size=1000, strata=[.5, .5, .5, .5])
+    assert 1000 == sum(counts)
+    assert [50, 100, 500, 250, 100] == pytest.approx(counts, abs=2)
+
+    # Uniform strata give multinomial counts
+    rng = numpy.random.default_rng(1)
+    counts = [_stratified_counts(bins=[20, 30], population_size=10, strata=rng.random(2)) for _ in range(0, 5000)]
+    assert [2, 3, 5] == pytest.approx(numpy.mean(counts, axis=0), abs=.05)
+    assert [1.6, 2.1, 2.5] == pytest.approx(numpy.var(counts, axis=0), abs=.15)
+
+
+def test__repetition_strata():
+    rng = random.Random(1)
+    strata = [_repetition_strata(entropy=3, repetition=repetition, rng=rng, dimensions=2)
+              for repetition in range(STRATIFIED_BLOCK_SIZE, 2 * STRATIFIED_BLOCK_SIZE)]
+    for dimension in zip(*strata):
+        assert list(range(0, STRATIFIED_BLOCK_SIZE)) == sorted(int(x * STRATIFIED_BLOCK_SIZE) for x in dimension)
+
+
+@pytest.mark.parametrize("variance_reduction", ['stratified', 'antithetic'])
+def test__generate_repetition_population(variance_reduction):
+    populations = [_generate_repetition_population(bins=[25, 50], population_size=50, entropy=4, repetition=repetition,
+                                                   variance_reduction=variance_reduction)
+                   for repetition in range(0, 2 * STRATIFIED_BLOCK_SIZE)]
+    assert [50] * len(populations) == [len(population) for population in populations]
+    assert populations[0] == _generate_repetition_population(bins=[25, 50], population_size=50, entropy=4,
+                                                             repetition=0, variance_reduction=variance_reduction)
+    if variance_reduction == 'antithetic':
+        assert [2 - label for label in populations[0]] == populations[1]
+
+
 def test__rate_population():
     population = [2, 0, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2]
 
@@ -69,6 +219,43 @@ def test__get_rating_accuracy_stats():
                                                    ratings=[10, 9, 11, 10])
 
 
+def test__confusion_matrix():
+    population = [2, 0, 1, 1, 2]
+    ratings = [1, 0, 1, 2, 3]
+    confusion = _confusion_matrix(population=population, ratings=ratings, num_labels=4)
+    assert [[1, 0, 0, 0], [0, 1, 1, 0], [0, 1, 0, 1], [0, 0, 0, 0]] == confusion
+
+    matrices = _confusion_matrices(populations=numpy.array([population, ratings], dtype=numpy.uint8),
+                                   ratings=numpy.array([ratings, population], dtype=numpy.uint8), num_labels=4)
+    assert [confusion, numpy.transpose(confusion).tolist()] == matrices.tolist()
+
+    assert [[0, 1, 0], [0, 1, 1], [1, 0, 0], [1, 0, 0]] == _get_rating_accuracy_by_bin(matrices)[1].tolist()
+    assert [[0, 1, 0], [0, 1, 1], [1, 0, 1], [0, 0, 0]] == _get_rating_accuracy_by_bin(confusion).tolist()
+
+
+def test__score_confusion():
+    population = [2, 0, 1, 1, 2, 4, 3]
+    ratings = [1, 0, 1, 2, 3, 2, 3]
+    production = [1.05, 1.1, 1.15, 1.2, 1.25]
+    confusion = [_confusion_matrix(population=population, ratings=ratings, num_labels=5)]
+
+    scores, accuracy = _score_confusion(confusion=confusion, num_bins=5, productions=[production, [1] * 5],
+                                        payoffs=[(-1, 1, .5), (0, 2, 0)])
+    for production_idx, production in enumerate([production, [1] * 5]):
+        for payoff_idx, payoff in enumerate([(-1, 1, .5), (0, 2, 0)]):
+            assert sum(_score_ratings(population=population, ratings=ratings, production=production,
+                                      underestimate_score=payoff[0], correct_score=payoff[1],
+                                      over_estimate_score=payoff[2])) == \
+                pytest.approx(scores[0, production_idx, payoff_idx])
+
+    assert list(_get_rating_accuracy_stats(population=population, ratings=ratings)) == accuracy[0, 0:3].tolist()
+    assert [0, 1, 0, 0, 1, 1, 1, 0, 1, 0, 1, 0, 1, 0, 0] == accuracy[0, 3:].tolist()
+
+
+def test__read_vectors():
+    assert [(.5, 1.2, 1.0), (0, 1, 0)] == _read_vectors(io.StringIO("0.5,1.2,1\n\n0,1,0\n"))
+
+
 def test_calculate_monte_carlo_stats():
     rating_scores = {(1, 2): [1, 3, 7, 13], (2, 2): [1, 3, 7, 130]}
     rating_accuracy_stats = {(1, 2): [(1, 2, 3), (3, 6, 9), (7, 14, 21), (13, 26, 39)],
@@ -77,6 +264,32 @@ def test_calculate_monte_carlo_stats():
     assert [[1, 2, 6.0, 6.0, 12.0, 18.0], [2, 2, 35.25, 35.25, 70.5, 105.75]] == sorted(averages)
 
 
+def test__running_stats():
+    values = [[1, 2], [3, 5], [7, 11], [13, 17], [19, 23]]
+    stats = _RunningStats.from_values(values[:2])
+    stats.merge(_RunningStats())
+    stats.merge(_RunningStats.from_values(values[2:]))
+
+    assert 5 == stats.count
+    assert numpy.mean(values, axis=0) == pytest.approx(stats.mean)
+    assert numpy.var(values, axis=0, ddof=1) == pytest.approx(stats.variance())
+    assert 1.96 * numpy.std(values, axis=0, ddof=1) / 5 ** .5 == pytest.approx(stats.confidence_interval(.95), 1e-3)
+
+    empty = _RunningStats()
+    empty.merge(_RunningStats.from_values([4]))
+    assert (1, 4.0) == (empty.count, empty.mean)
+    assert numpy.inf == empty.variance()
+
+
+def test_calculate_monte_carlo_stats_confidence():
+    rating_scores = {(1, 2): _RunningStats.from_values([1, 3, 7, 13])}
+    rating_accuracy_stats = {(1, 2): _RunningStats.from_values([(1, 2, 3), (3, 6, 9), (7, 14, 21), (13, 26, 39)])}
+    averages = calculate_monte_carlo_stats(scores=rating_scores, rating_accuracy=rating_accuracy_stats,
+                                           confidence=.95)
+    assert [[1, 2, 6.0, 6.0, 12.0, 18.0, pytest.approx(1.96 * numpy.std([1, 3, 7, 13], ddof=1) / 2, 1e-3), 4]] == \
+        averages
+
+
 def test_simulate_ratings():
     rating_scores, rating_accuracy = simulate_ratings([20, 20], population_size=5, sample_sizes=[3, 5],
                                                       rating_bins=[20, 20],
@@ -90,3 +303,680 @@ def test_simulate_ratings():
     assert 4 == len(averages)
     assert [3, -1, 1, 0] == averages[0][0:4] and [3, 0, 1, 0] == averages[1][0:4]
     assert [5, -1, 1, 0] == averages[2][0:4] and [5, 0, 1, 0] == averages[3][0:4]
+
+
+def test__rate_population_matrix():
+    populations = numpy.array([[2, 0, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2],
+                               [0, 1, 2, 2, 2, 1, 0, 2, 2, 1, 2, 0]], dtype=numpy.uint8)
+
+    for bins in ([0, 20], [20, 20], [10, 30, 40]):
+        for sample_size in (1, 3, 5, 12, 20):
+            get_sample_labels = _sample_labels_calculator(population_size=populations.shape[1], bins=bins)
+            ratings = _rate_population_matrix(populations=populations, sample_size=sample_size,
+                                              get_sample_labels=get_sample_labels)
+            for population, row_ratings in zip(populations, ratings):
+                assert _rate_population(population=list(population), sample_size=sample_size,
+                                        get_sample_labels=get_sample_labels) == list(row_ratings)
+
+
+def test__rate_population_matrix_selection():
+    observations = numpy.random.default_rng(0).normal(size=(3, 1000)).astype(numpy.float32)
+
+    for bins in ([0, 20], [5, 10, 50, 25, 10]):
+        for sample_size in (1, 7, 100, 999, 1000):
+            get_sample_labels = _sample_labels_calculator(population_size=observations.shape[1], bins=bins)
+            ratings = _rate_population_matrix(populations=observations, sample_size=sample_size,
+                                              get_sample_labels=get_sample_labels, selection=True)
+            assert numpy.uint8 == ratings.dtype
+            assert numpy.array_equal(_rate_population_matrix(populations=observations, sample_size=sample_size,
+                                                             get_sample_labels=get_sample_labels), ratings)
+
+
+def test__observe_population_matrix():
+    populations = numpy.array([[0, 1, 2, 2], [2, 2, 1, 0]], dtype=numpy.uint8)
+
+    observations = _observe_population_matrix(populations=populations, entropy=1, repetitions=[3, 4],
+                                              observation_noise=0)
+    assert numpy.float32 == observations.dtype
+    assert numpy.array_equal(populations, numpy.floor(observations))
+
+    # Each row comes from its repetition's own stream
+    noisy = _observe_population_matrix(populations=populations, entropy=1, repetitions=[3, 4], observation_noise=2)
+    assert numpy.array_equal(noisy[1:], _observe_population_matrix(populations=populations[1:], entropy=1,
+                                                                    repetitions=[4], observation_noise=2))
+    assert not numpy.array_equal(observations, noisy)
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy'])
+def test_simulate_ratings_observation_noise(engine):
+    arguments = dict(performance_bins=[5, 10, 50, 25, 10], population_size=100, sample_sizes=[10, 100],
+                     rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1)],
+                     production=[1.05, 1.1, 1.15, 1.2, 1.25], num_repetitions=20, engine=engine, seed=1)
+    scores, accuracy = simulate_ratings(**arguments)
+
+    # Members of the same performance bin only swap ratings, which doesn't change the confusion matrices
+    tiny_scores, tiny_accuracy = simulate_ratings(observation_noise=1e-4, **arguments)
+    for configuration in scores:
+        assert scores[configuration].mean == pytest.approx(tiny_scores[configuration].mean)
+        assert numpy.allclose(accuracy[configuration].mean, tiny_accuracy[configuration].mean)
+
+    _, noisy_accuracy = simulate_ratings(observation_noise=1, **arguments)
+    for configuration in scores:
+        assert noisy_accuracy[configuration].mean[1] < accuracy[configuration].mean[1]
+
+    with pytest.raises(ValueError):
+        simulate_ratings(observation_noise=-1, **arguments)
+    with pytest.raises(ValueError):
+        simulate_ratings(observation_noise=1, **dict(arguments, sample_sizes=[10, 100], hierarchical=True))
+
+
+def test_simulate_ratings_numpy():
+    rating_scores, rating_accuracy = simulate_ratings([20, 20], population_size=5, sample_sizes=[3, 5],
+                                                      rating_bins=[20, 20],
+                                                      payoffs=[(-1, 1, 0), (0, 1, 0)],
+                                                      num_repetitions=3,
+                                                      production=[1.05, 1.1, 1.15, 1.2, 1.25],
+                                                      engine='numpy', seed=1)
+    averages = calculate_monte_carlo_stats(scores=rating_scores, rating_accuracy=rating_accuracy)
+    averages.sort()
+
+    assert 4 == len(averages)
+    assert [3, -1, 1, 0] == averages[0][0:4] and [3, 0, 1, 0] == averages[1][0:4]
+    assert [5, -1, 1, 0] == averages[2][0:4] and [5, 0, 1, 0] == averages[3][0:4]
+    for average in averages:
+        assert 5 == pytest.approx(sum(average[5:]))
+
+
+@pytest.mark.parametrize("engine", ['python', 'numpy'])
+def test_simulate_ratings_seed(engine):
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=30, sample_sizes=[4, 7],
+                  rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25],
+                  num_repetitions=50, seed=7, engine=engine, label_strategy='oversample')
+
+    # The oversampled label tables are drawn after seeding too, whatever state the global random was left in
+    random.seed(1)
+    first = simulate_ratings(**kwargs)
+    random.seed(2)
+    assert first == simulate_ratings(**kwargs)
+
+
+@pytest.mark.parametrize("engine", ['python', 'numpy'])
+def test_simulate_ratings_workers(engine):
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=30, sample_sizes=[4, 30],
+                  rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1), (0, 1, 0)],
+                  production=[1.05, 1.1, 1.15, 1.2, 1.25], num_repetitions=600, seed=7, engine=engine,
+                  label_strategy='oversample')
+
+    rating_scores, rating_accuracy = simulate_ratings(workers=1, **kwargs)
+    for workers in (2, 3):
+        assert (rating_scores, rating_accuracy) == simulate_ratings(workers=workers, **kwargs)
+
+    other_scores, _ = simulate_ratings(workers=1, **dict(kwargs, seed=8))
+    assert rating_scores != other_scores
+
+
+@pytest.mark.parametrize("engine", ['python', 'numpy'])
+def test_simulate_ratings_productions(engine):
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=30, sample_sizes=[4, 30],
+                  rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1), (0, 1, 0)], num_repetitions=50, seed=2,
+                  engine=engine)
+    productions = [[1.05, 1.1, 1.15, 1.2, 1.25], [1, 2, 3, 4, 5]]
+
+    rating_scores, rating_accuracy = simulate_ratings(production=None, productions=productions, **kwargs)
+    assert 8 == len(rating_scores)
+    for production in productions:
+        single_scores, single_accuracy = simulate_ratings(production=production, **kwargs)
+        for key, scores in single_scores.items():
+            assert scores.mean == pytest.approx(rating_scores[key + tuple(production)].mean)
+            assert single_accuracy[key] == rating_accuracy[key + tuple(production)]
+
+    averages = calculate_monte_carlo_stats(scores=rating_scores, rating_accuracy=rating_accuracy, by_bin=True)
+    for average in averages:
+        by_bin = numpy.reshape(average[-15:], (5, 3))
+        assert average[-18:-15] == pytest.approx(by_bin.sum(axis=0).tolist())
+        assert 30 == pytest.approx(by_bin.sum())
+
+    with pytest.raises(ValueError):
+        simulate_ratings(production=[1, 2], **kwargs)
+
+
+def test_simulate_ratings_tolerance():
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=20, sample_sizes=[5, 20],
+                  rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25],
+                  num_repetitions=1, seed=5, engine='numpy', max_repetitions=5000)
+
+    rating_scores, _ = simulate_ratings(tolerance=.05, **kwargs)
+    for scores in rating_scores.values():
+        assert .05 >= scores.confidence_interval(.95)
+        assert 5000 > scores.count
+
+    # Each sample size stops as soon as it has converged
+    assert rating_scores[(5, .5, 1.2, 1)].count < rating_scores[(20, .5, 1.2, 1)].count
+
+    # Same answer however the chunks are spread across workers
+    assert (rating_scores, _) == simulate_ratings(tolerance=.05, workers=3, **kwargs)
+
+    # Stops at the cap
+    rating_scores, _ = simulate_ratings(tolerance=0, **kwargs)
+    assert {5000} == {scores.count for scores in rating_scores.values()}
+
+    with pytest.raises(ValueError):
+        simulate_ratings(tolerance=.2, **dict(kwargs, max_repetitions=None))
+
+
+@pytest.mark.parametrize("engine", ['python', 'numpy'])
+@pytest.mark.parametrize("variance_reduction", ['stratified', 'antithetic'])
+def test_simulate_ratings_variance_reduction(engine, variance_reduction):
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=40, sample_sizes=[5, 40],
+                  rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25],
+                  num_repetitions=1000, seed=13, engine=engine, variance_reduction=variance_reduction)
+    exact = calculate_exact_stats(confidence=.999, **{key: value for key, value in kwargs.items()
+                                                      if key not in ('num_repetitions', 'seed', 'engine',
+                                                                     'variance_reduction')})
+
+    rating_scores, rating_accuracy = simulate_ratings(**kwargs)
+    plain_scores, _ = simulate_ratings(**dict(kwargs, variance_reduction='none'))
+    averages = calculate_monte_carlo_stats(scores=rating_scores, rating_accuracy=rating_accuracy, confidence=.999,
+                                           plain_scores=plain_scores,
+                                           repetitions_per_sample=REPETITIONS_PER_SAMPLE[variance_reduction])
+
+    for average, exact_average in zip(averages, exact):
+        # Unbiased
+        assert abs(average[4] - exact_average[4]) < average[8]
+        assert -(-1000 // REPETITIONS_PER_SAMPLE[variance_reduction]) == average[9]
+        assert 0 < average[10]
+
+    # Same answer however the chunks are spread across workers
+    assert (rating_scores, rating_accuracy) == simulate_ratings(workers=2, **kwargs)
+
+    if variance_reduction == 'stratified':
+        assert 1.2 < averages[-1][10]
+
+
+def test__validate_levels():
+    _validate_levels([8])
+    _validate_levels([8, 64, 512])
+    for level_sizes in ([], [8, 8], [8, 60], [64, 8]):
+        with pytest.raises(ValueError):
+            _validate_levels(level_sizes)
+
+
+def test__rate_hierarchy():
+    get_sample_labels = _sample_labels_calculator(population_size=4, bins=[50])
+    population = numpy.array([1, 1, 0, 0], dtype=numpy.uint8)
+    levels = list(_rate_hierarchy(population=population, level_sizes=[2, 4], get_sample_labels=get_sample_labels,
+                                  num_labels=2))
+
+    assert [2, 4] == [level_size for level_size, _ in levels]
+    assert [numpy.uint8, numpy.uint8] == [ratings.dtype for _, ratings in levels]
+    assert [0, 1, 0, 1] == levels[0][1].tolist()
+    # Calibration keeps the order of the team ratings, where ranking everyone at once would give [1, 1, 0, 0]
+    assert [0, 1, 0, 1] == levels[1][1].tolist()
+
+    population = numpy.array([2, 0, 1, 2, 0, 0], dtype=numpy.uint8)
+    get_sample_labels = _sample_labels_calculator(population_size=6, bins=[30, 40])
+    levels = list(_rate_hierarchy(population=population, level_sizes=[6], get_sample_labels=get_sample_labels,
+                                  num_labels=3))
+    assert _rate_population(population=population.tolist(), sample_size=6,
+                            get_sample_labels=get_sample_labels) == levels[0][1].tolist()
+
+
+def test__simulate_repetitions_hierarchical():
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=1000, sample_sizes=[8, 64, 512],
+                  num_labels=5, get_sample_labels=_sample_labels_calculator(population_size=1000,
+                                                                            bins=[5, 10, 50, 25, 10]),
+                  entropy=3, first_repetition=4, num_repetitions=3)
+    confusion = _simulate_repetitions_hierarchical(**kwargs)
+    assert [8, 64, 512] == list(confusion)
+    assert [1000] * 9 == [int(c.sum()) for matrices in confusion.values() for c in matrices]
+
+    # Streaming the populations through in small chunks rates the same populations the same way
+    for level_size, matrices in _simulate_repetitions_hierarchical(chunk_size=600, **kwargs).items():
+        assert numpy.array_equal(confusion[level_size], matrices)
+
+    with pytest.raises(ValueError):
+        _simulate_repetitions_hierarchical(variance_reduction='stratified', **kwargs)
+
+
+def test_simulate_ratings_hierarchical():
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=1000, rating_bins=[5, 10, 50, 25, 10],
+                  payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25], num_repetitions=300, seed=3)
+    hierarchical = simulate_ratings(sample_sizes=[8, 64, 512], hierarchical=True, **kwargs)
+    flat = simulate_ratings(sample_sizes=[8, 64, 512], engine='numpy', **kwargs)
+
+    # The bottom level is rated just like flat groups, and every level above it is somewhere in between
+    assert hierarchical[0][(8, .5, 1.2, 1)] == flat[0][(8, .5, 1.2, 1)]
+    for level_size in (64, 512):
+        assert flat[0][(8, .5, 1.2, 1)].mean < hierarchical[0][(level_size, .5, 1.2, 1)].mean < \
+            flat[0][(level_size, .5, 1.2, 1)].mean
+
+    assert hierarchical == simulate_ratings(sample_sizes=[8, 64, 512], hierarchical=True, workers=2, **kwargs)
+
+    for bad_kwargs in (dict(sample_sizes=[8, 60]), dict(sample_sizes=[8, 64], variance_reduction='stratified'),
+                       dict(sample_sizes=[8, 64], common_random_numbers=False)):
+        with pytest.raises(ValueError):
+            simulate_ratings(hierarchical=True, **dict(kwargs, **bad_kwargs))
+
+
+def test_simulate_ratings_common_random_numbers():
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=40, rating_bins=[5, 10, 50, 25, 10],
+                  payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25], num_repetitions=20, seed=13,
+                  engine='numpy')
+
+    common, _ = simulate_ratings(sample_sizes=[5, 40], **kwargs)
+    independent, _ = simulate_ratings(sample_sizes=[5, 40], common_random_numbers=False, **kwargs)
+    assert common[(40, .5, 1.2, 1)] != independent[(40, .5, 1.2, 1)]
+
+    # Each group size's populations don't depend on the other group sizes
+    assert simulate_ratings(sample_sizes=[40], common_random_numbers=False, **kwargs)[0][(40, .5, 1.2, 1)] == \
+        independent[(40, .5, 1.2, 1)]
+    assert simulate_ratings(sample_sizes=[40], **kwargs)[0][(40, .5, 1.2, 1)] == common[(40, .5, 1.2, 1)]
+
+
+def test_simulate_ratings_engines_agree():
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=40, sample_sizes=[5, 40],
+                  rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25],
+                  num_repetitions=2000, seed=3)
+    python_averages = sorted(calculate_monte_carlo_stats(*simulate_ratings(engine='python', **kwargs)))
+    numpy_averages = sorted(calculate_monte_carlo_stats(*simulate_ratings(engine='numpy', **kwargs)))
+
+    for python_average, numpy_average in zip(python_averages, numpy_averages):
+        assert python_average[0:4] == numpy_average[0:4]
+        assert python_average[4:] == pytest.approx(numpy_average[4:], rel=.05)
+
+
+def test__binomial_survival():
+    assert [.875, .5, .125] == pytest.approx(_binomial_survival(3, .5).tolist())
+    assert [0, 0] == _binomial_survival(2, 0).tolist()
+    assert [1, 1] == _binomial_survival(2, 1).tolist()
+    assert 1 == pytest.approx(_binomial_survival(100000, .5)[0])
+    assert .5 == pytest.approx(_binomial_survival(100001, .5)[50000])
+
+
+def test_calculate_exact_stats_enumeration():
+    performance_bins = [20, 50]
+    probabilities = [.2, .5, .3]
+    population_size = 5
+    payoffs = [(-1, 1, .5)]
+    production = [1, 2, 3]
+
+    exact = calculate_exact_stats(performance_bins=performance_bins, population_size=population_size,
+                                  sample_sizes=[2, 5], rating_bins=[30, 30], payoffs=payoffs, production=production,
+                                  by_bin=True)
+
+    # Weigh every possible population by its probability
+    for average, sample_size in zip(exact, [2, 5]):
+        get_sample_labels = _sample_labels_calculator(population_size=population_size, bins=[30, 30])
+        expected = numpy.zeros(len(average) - 4)
+        for population in itertools.product(range(0, 3), repeat=population_size):
+            probability = numpy.prod([probabilities[label] for label in population])
+            ratings = _rate_population(population=list(population), sample_size=sample_size,
+                                       get_sample_labels=get_sample_labels)
+            scores, accuracy = _score_confusion(
+                confusion=[_confusion_matrix(population=population, ratings=ratings, num_labels=3)], num_bins=3,
+                productions=[production], payoffs=payoffs)
+            expected += probability * numpy.concatenate([scores[0, 0], accuracy[0]])
+        assert [sample_size, -1, 1, .5] == average[0:4]
+        assert expected.tolist() == pytest.approx(average[4:])
+
+
+def test_calculate_exact_stats_matches_monte_carlo():
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=50, sample_sizes=[5, 7, 50, 80],
+                  rating_bins=[10, 10, 40, 30, 10], payoffs=[(.5, 1.2, 1), (-1, 1, 0)],
+                  production=[1.05, 1.1, 1.15, 1.2, 1.25])
+    exact = calculate_exact_stats(confidence=.99, by_bin=True, **kwargs)
+    simulated = calculate_monte_carlo_stats(*simulate_ratings(num_repetitions=20000, seed=11, engine='numpy',
+                                                              **kwargs), confidence=.99, by_bin=True)
+
+    assert len(simulated) == len(exact)
+    for exact_average, simulated_average in zip(exact, simulated):
+        assert exact_average[0:4] == simulated_average[0:4]
+        assert [0.0, 0] == exact_average[8:10]
+        assert abs(exact_average[4] - simulated_average[4]) < simulated_average[8]
+        assert exact_average[5:8] + exact_average[10:] == \
+            pytest.approx(simulated_average[5:8] + simulated_average[10:], rel=.02, abs=.05)
+
+    # Production vectors need a production for every performance bin, like for simulations
+    with pytest.raises(ValueError, match="doesn't cover all 5 performance bins"):
+        calculate_exact_stats(**dict(kwargs, production=[1, 2, 3]))
+    with pytest.raises(ValueError, match="doesn't cover all 5 performance bins"):
+        calculate_exact_stats(productions=[[1, 2, 3, 4, 5], [1, 2]], **kwargs)
+
+
+def test_run_simulation_exact_columns():
+    # Trailing empty bins aren't performance bins, for --exact just like for simulations
+    arguments = ['--performance-bins', '50', '50', '0', '--sample-sizes', '5', '--production', '1', '2',
+                 '--per-bin-accuracy', '--seed', '1']
+    exact = run_simulation(build_parser().parse_args(arguments + ['--exact']))
+    simulated = run_simulation(build_parser().parse_args(arguments + ['--num-repetitions', '10']))
+    assert [len(row) for row in simulated] == [len(row) for row in exact]
+
+    with pytest.raises(ValueError):
+        run_simulation(build_parser().parse_args(['--exact', '--variance-reduction', 'antithetic']))
+
+
+def test__Profiler():
+    profiler = _Profiler()
+    with profiler.stage('rate', 8):
+        [0] * 1000
+    with profiler.stage('rate', 8):
+        pass
+    with pytest.raises(KeyError):
+        with profiler.stage('generate_population'):
+            raise KeyError()
+    profiler.label_lookup(8, hit=False)
+    profiler.label_lookup(8, hit=True)
+
+    assert [('rate', 8), ('generate_population', None)] == list(profiler.stages)
+    assert 2 == profiler.stages[('rate', 8)][1]
+    assert {8: [1, 1]} == profiler.label_lookups
+    assert ['rate', 'rate', 'generate_population'] == [event['name'] for event in profiler.chrome_trace()['traceEvents']]
+
+    other = _Profiler()
+    with other.stage('rate', 8):
+        pass
+    other.label_lookup(5, hit=True)
+    other.final_group_sizes.add(5)
+    other.dropped_events = 2
+    profiler.merge(other)
+    assert 3 == profiler.stages[('rate', 8)][1]
+    assert {8: [1, 1], 5: [1, 0]} == profiler.label_lookups
+    assert {5} == profiler.final_group_sizes
+    assert 4 == len(profiler.events)
+    assert 2 == profiler.dropped_events
+
+    other.events = other.events * MAX_TRACE_EVENTS
+    profiler.merge(other)
+    assert MAX_TRACE_EVENTS == len(profiler.events)
+    assert 8 == profiler.dropped_events
+
+
+@pytest.mark.parametrize("engine", ['python', 'numpy'])
+def test_simulate_ratings_profile(engine):
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=45, sample_sizes=[8, 20],
+                  rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25],
+                  num_repetitions=300, seed=1, engine=engine)
+    profiler = _Profiler()
+    sample_labels = {8: _calculate_sample_labels_quantile(sample_size=8, bins=[5, 10, 50, 25, 10])}
+
+    # Profiling doesn't change the results
+    assert simulate_ratings(**kwargs) == simulate_ratings(profiler=profiler, sample_labels=sample_labels,
+                                                          workers=2, **kwargs)
+
+    assert {('sample_labels', 5), ('sample_labels', 20), ('generate_population', None), ('rate', 8), ('rate', 20),
+            ('confusion', 8), ('confusion', 20), ('score', 8), ('score', 20)} == set(profiler.stages)
+    assert 2 == profiler.stages[('score', 8)][1]
+    assert {5} == profiler.final_group_sizes
+
+    # One lookup of the label tables before the run, then one per rating of a population (python) or chunk (numpy)
+    ratings = 300 if engine == 'python' else 2
+    # Both group sizes leave a final group of 5
+    assert {8: [1 + ratings, 0], 5: [1 + 2 * ratings, 1], 20: [ratings, 1]} == profiler.label_lookups
+
+    f = io.StringIO()
+    print_profile(f, profiler)
+    assert 'generate_population' in f.getvalue()
+
+
+@pytest.mark.parametrize("variance_reduction", ['none', 'antithetic'])
+def test_simulate_ratings_store(tmpdir, variance_reduction):
+    kwargs = dict(performance_bins=[5, 10, 50, 25, 10], population_size=45, sample_sizes=[8, 20],
+                  rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1), (0, 1, .5)], production=None,
+                  productions=[(1.05, 1.1, 1.15, 1.2, 1.25), (1, 1, 1, 1, 1)], num_repetitions=300, seed=1,
+                  engine='numpy', variance_reduction=variance_reduction)
+    path = str(tmpdir.join('store'))
+    with RepetitionStoreWriter(path) as writer:
+        rating_scores, rating_accuracy = simulate_ratings(store=writer, workers=2, **kwargs)
+    store = RepetitionStore(path)
+
+    assert 2 * 2 * 2 * 300 == len(store)
+    assert sorted(rating_scores) == sorted(store.configurations)
+    for configuration_id, configuration in enumerate(store.configurations):
+        selected = store['configuration'] == configuration_id
+        assert list(range(0, 300)) == sorted(store['repetition'][selected].tolist())
+        assert rating_scores[configuration].mean == pytest.approx(store['score'][selected].mean())
+        assert rating_accuracy[configuration].mean[0:3] == pytest.approx(
+            [store[column][selected].mean() for column in ('underestimates', 'correct', 'overestimates')])
+
+
+def test__racing_rounds():
+    assert [100, 200, 400, 800, 1000] == _racing_rounds(num_repetitions=100, max_repetitions=1000)
+    assert [50] == _racing_rounds(num_repetitions=100, max_repetitions=50)
+
+
+def test__race_elimination():
+    rng = numpy.random.default_rng(0)
+    noise = rng.normal(size=1000)
+    candidate_scores = {5: 90 + noise, 10: 100 + noise + rng.normal(scale=.1, size=1000), 20: 101 + noise}
+
+    # Paired, 10 and 20 are far apart even though the noise of each is much larger than the difference
+    assert ({5, 10}, {20}) == _race_elimination(candidate_scores, within=0, confidence=.95)
+    assert ({5}, {10, 20}) == _race_elimination(candidate_scores, within=.05, confidence=.95)
+    assert (set(), set()) == _race_elimination({5: noise, 10: -noise}, within=0, confidence=.95)
+
+
+@pytest.mark.parametrize('within', [0, .005])
+def test_optimize_sample_size(within):
+    arguments = dict(performance_bins=[5, 10, 50, 25, 10], population_size=200, rating_bins=[5, 10, 50, 25, 10],
+                     payoff=(.5, 1.2, 1), production=[1.05, 1.1, 1.15, 1.2, 1.25], seed=1)
+    result = optimize_sample_size(sample_sizes=[20, 25, 30, 40], within=within, num_repetitions=50,
+                                  max_repetitions=3200, engine='numpy', **arguments)
+
+    assert result['confirmed']
+    assert result['simulated'] < result['grid']
+
+    # The same answer as the full grid, which simulates the same repetitions
+    scores, _ = simulate_ratings(sample_sizes=[20, 25, 30, 40], rating_bins=arguments.pop('rating_bins'),
+                                 payoffs=[arguments.pop('payoff')], num_repetitions=result['repetitions'],
+                                 engine='numpy', **arguments)
+    averages = {configuration[0]: stats.mean for configuration, stats in scores.items()}
+    best = max(averages.values())
+    assert min(size for size, average in averages.items() if average >= (1 - within) * best) == result['sample_size']
+    assert averages[result['sample_size']] == pytest.approx(result['score'])
+
+    assert optimization_statement(result, within=within).startswith(
+        'Group size {} '.format(result['sample_size']))
+
+
+def test_optimize_sample_size_unresolved():
+    result = optimize_sample_size(performance_bins=[5, 10, 50, 25, 10], population_size=200, sample_sizes=[100, 101],
+                                  rating_bins=[5, 10, 50, 25, 10], payoff=(.5, 1.2, 1),
+                                  production=[1.05, 1.1, 1.15, 1.2, 1.25], num_repetitions=5, max_repetitions=10,
+                                  seed=1)
+    assert not result['confirmed']
+    assert [100, 101] == result['remaining']
+    assert 10 == result['repetitions']
+    assert optimization_statement(result).startswith("Group sizes 100 101 are still in contention")
+
+    # run_simulation hands the statement to its caller instead of printing it
+    notes = []
+    rows = run_simulation(build_parser().parse_args(['--optimize', '--sample-sizes', '100', '101', '--num-repetitions',
+                                                     '5', '--max-repetitions', '10', '--seed', '1']), notes=notes)
+    assert [optimization_statement(result)] == notes
+    assert [[result['sample_size'], .5, 1.2, 1, result['score'], result['confidence_interval'], 10, 0]] == rows
+
+    with pytest.raises(ValueError):
+        optimize_sample_size(performance_bins=[5, 10, 50, 25, 10], population_size=100,
+                             rating_bins=[5, 10, 50, 25, 10], payoff=(.5, 1.2, 1),
+                             production=[1.05, 1.1, 1.15, 1.2, 1.25], within=1)
+
+
+@pytest.mark.parametrize('variance_reduction', ['none', 'antithetic'])
+def test_merge_shards(tmpdir, variance_reduction):
+    arguments = ['--seed', '3', '--num-repetitions', '600', '--engine', 'numpy', '--sample-sizes', '5', '20',
+                 '--variance-reduction', variance_reduction]
+    expected = run_simulation(build_parser().parse_args(arguments))
+
+    paths = [str(tmpdir.join('shard{}.npz'.format(i))) for i in range(1, 4)]
+    for i, path in enumerate(paths, start=1):
+        assert [] == run_simulation(build_parser().parse_args(
+            arguments + ['--shard', '{}/3'.format(i), '--shard-file', path, '--workers', str(i)]))
+
+    assert expected == merge_shards(list(reversed(paths)))
+    assert expected == run_simulation(build_parser().parse_args(['--merge'] + paths))
+
+    with pytest.raises(ValueError, match='Missing shards 2 of 3'):
+        merge_shards([paths[0], paths[2]])
+    with pytest.raises(ValueError, match='both shard 1/3'):
+        merge_shards(paths + [paths[0]])
+
+    other = str(tmpdir.join('other.npz'))
+    run_simulation(build_parser().parse_args(arguments + ['--shard', '2/3', '--shard-file', other, '--seed', '4']))
+    with pytest.raises(ValueError, match='different experiment'):
+        merge_shards([paths[0], other, paths[2]])
+
+
+def test_shard_arguments():
+    assert (1, 8) == build_parser().parse_args(['--shard', '2/8']).shard
+    for shard in ('0/8', '9/8', '2-8'):
+        with pytest.raises(SystemExit):
+            build_parser().parse_args(['--shard', shard])
+
+    with pytest.raises(ValueError):
+        run_simulation(build_parser().parse_args(['--shard', '1/2', '--shard-file', 'shard.npz']))
+    with pytest.raises(ValueError):
+        simulate_ratings([5, 10, 50, 25, 10], population_size=10, sample_sizes=[5], rating_bins=[5, 10, 50, 25, 10],
+                         payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25], tolerance=1,
+                         max_repetitions=10, shard=(0, 2))
+
+
+@pytest.mark.parametrize('engine, variance_reduction', [('python', 'none'), ('numpy', 'none'),
+                                                        ('numpy', 'antithetic')])
+def test_corpus(tmpdir, engine, variance_reduction):
+    path = str(tmpdir.join('populations.corpus'))
+    generate_corpus(path, performance_bins=[5, 10, 50, 25, 10], population_size=100, num_repetitions=300, seed=3,
+                    variance_reduction=variance_reduction)
+    corpus = PopulationCorpus(path)
+    assert 300 == len(corpus)
+    assert 3 == corpus.metadata['seed']
+    # The populations the numpy engine draws with the same seed
+    assert numpy.array_equal(_generate_population_matrix(bins=[5, 10, 50, 25, 10], population_size=100,
+                                                         entropy=corpus.metadata['entropy'], repetitions=range(0, 300),
+                                                         variance_reduction=variance_reduction),
+                             corpus.populations)
+
+    arguments = dict(performance_bins=[5, 10, 50, 25, 10], population_size=100, sample_sizes=[5, 20, 100],
+                     rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1)],
+                     production=[1.05, 1.1, 1.15, 1.2, 1.25], num_repetitions=300,
+                     variance_reduction=variance_reduction)
+    expected = simulate_ratings(engine='numpy', seed=3, **arguments)
+    # The seed defaults to the corpus's
+    assert expected == simulate_ratings(engine=engine, corpus=path, **arguments)
+    assert expected == simulate_ratings(engine=engine, corpus=path, workers=2, **arguments)
+
+    # Other rating bins rate the same populations
+    other_scores, _ = simulate_ratings(engine=engine, corpus=path, **dict(arguments, rating_bins=[10, 10, 40, 30, 10]))
+    assert other_scores != expected[0]
+
+
+def test_corpus_hierarchical(tmpdir):
+    path = str(tmpdir.join('populations.corpus'))
+    generate_corpus(path, performance_bins=[5, 10, 50, 25, 10], population_size=320, num_repetitions=20, seed=5)
+    arguments = dict(performance_bins=[5, 10, 50, 25, 10], population_size=320, num_labels=5,
+                     get_sample_labels=_sample_labels_calculator(population_size=320, bins=[5, 10, 50, 25, 10]),
+                     entropy=PopulationCorpus(path).metadata['entropy'], first_repetition=3, num_repetitions=10,
+                     sample_sizes=[8, 32, 160], chunk_size=64)
+    expected = _simulate_repetitions_hierarchical(**arguments)
+    actual = _simulate_repetitions_hierarchical(corpus=path, **arguments)
+    assert all(numpy.array_equal(expected[size], actual[size]) for size in expected)
+
+
+def test_corpus_errors(tmpdir):
+    path = str(tmpdir.join('populations.corpus'))
+    generate_corpus(path, performance_bins=[5, 10, 50, 25, 10], population_size=100, num_repetitions=10, seed=3)
+    arguments = dict(performance_bins=[5, 10, 50, 25, 10], population_size=100, sample_sizes=[5],
+                     rating_bins=[5, 10, 50, 25, 10], payoffs=[(.5, 1.2, 1)],
+                     production=[1.05, 1.1, 1.15, 1.2, 1.25], num_repetitions=10, corpus=path)
+    for mismatch in (dict(performance_bins=[10, 10, 50, 25, 5]), dict(population_size=50),
+                     dict(variance_reduction='stratified'), dict(common_random_numbers=False),
+                     dict(num_repetitions=11)):
+        with pytest.raises(ValueError):
+            simulate_ratings(**dict(arguments, **mismatch))
+
+    # The race stops at the end of the corpus
+    result = optimize_sample_size(performance_bins=[5, 10, 50, 25, 10], population_size=100,
+                                  rating_bins=[5, 10, 50, 25, 10], payoff=(.5, 1.2, 1),
+                                  production=[1.05, 1.1, 1.15, 1.2, 1.25], sample_sizes=[50, 100], num_repetitions=5,
+                                  corpus=path)
+    assert 10 >= result['repetitions']
+
+    # Regenerating a corpus in place is picked up
+    simulate_ratings(**arguments)
+    generate_corpus(path, performance_bins=[5, 10, 50, 25, 10], population_size=100, num_repetitions=20, seed=3)
+    simulate_ratings(**dict(arguments, num_repetitions=20))
+
+    assert [] == run_simulation(build_parser().parse_args(['--generate-corpus', path, '--num-repetitions', '5']))
+    assert 5 == len(PopulationCorpus(path))
+    with pytest.raises(ValueError):
+        run_simulation(build_parser().parse_args(['--exact', '--corpus', path]))
+
+
+@pytest.mark.parametrize('engine, label_strategy', [('python', 'quantile'), ('numpy', 'quantile'),
+                                                    ('numpy', 'oversample')])
+def test_simulate_ratings_state(tmpdir, engine, label_strategy):
+    arguments = dict(performance_bins=[5, 10, 50, 25, 10], population_size=100, rating_bins=[5, 10, 50, 25, 10],
+                     payoffs=[(.5, 1.2, 1)], production=[1.05, 1.1, 1.15, 1.2, 1.25], engine=engine, seed=3,
+                     label_strategy=label_strategy)
+    state = {}
+    simulate_ratings(sample_sizes=[10, 50], num_repetitions=300, state=state, **arguments)
+    assert [10, 50] == sorted(state['accuracy'])
+    assert (300, 5, 3) == state['accuracy'][10].shape
+
+    # More repetitions and another sample size, through a file
+    path = str(tmpdir.join('state.npz'))
+    write_state(path, {'main': state})
+    state = read_state(path)['main']
+    assert simulate_ratings(sample_sizes=[10, 20, 50], num_repetitions=600, **arguments) == \
+        simulate_ratings(sample_sizes=[10, 20, 50], num_repetitions=600, state=state, **arguments)
+    assert {10: 600, 20: 600, 50: 600} == {size: len(accuracy) for size, accuracy in state['accuracy'].items()}
+
+    # Rescoring, and fewer repetitions, keeps the repetitions past them
+    rescored = dict(arguments, payoffs=[(0, 1, .5), (-.5, 1, .5)], production=[1, 2, 3, 4, 5])
+    assert simulate_ratings(sample_sizes=[20], num_repetitions=400, **rescored) == \
+        simulate_ratings(sample_sizes=[20], num_repetitions=400, state=state, **rescored)
+    assert 600 == len(state['accuracy'][20])
+
+    # Other populations start over
+    simulate_ratings(sample_sizes=[20], num_repetitions=10, state=state, **dict(arguments, seed=4))
+    assert {20: 10} == {size: len(accuracy) for size, accuracy in state['accuracy'].items()}
+
+
+def test_simulate_ratings_state_variance_reduction(tmpdir):
+    arguments = ['--seed', '3', '--engine', 'numpy', '--variance-reduction', 'antithetic']
+    path = str(tmpdir.join('state.npz'))
+    run_simulation(build_parser().parse_args(arguments + ['--sample-sizes', '5', '--state', path]))
+    assert {'main', 'pilot'} == set(read_state(path))
+
+    arguments += ['--sample-sizes', '5', '20', '--num-repetitions', '500', '--tolerance', '20']
+    assert run_simulation(build_parser().parse_args(arguments)) == \
+        run_simulation(build_parser().parse_args(arguments + ['--state', path, '--workers', '2']))
+
+    with pytest.raises(ValueError):
+        run_simulation(build_parser().parse_args(['--state', path]))
+    with pytest.raises(ValueError):
+        run_simulation(build_parser().parse_args(['--seed', '3', '--state', path, '--exact']))
+
+
+@pytest.mark.parametrize('arguments, last', [
+    (['--exact', '--sample-sizes', '5', '20'], (2, 2)),
+    (['--optimize', '--sample-sizes', '100', '101', '--num-repetitions', '5', '--max-repetitions', '10'], (10, 10)),
+    # The pilot run counts after the main run
+    (['--variance-reduction', 'antithetic', '--num-repetitions', '300', '--sample-sizes', '20'], (600, 600)),
+])
+def test_run_simulation_progress(arguments, last):
+    calls = []
+    run_simulation(build_parser().parse_args(arguments + ['--seed', '1', '--engine', 'numpy']),
+                   progress=lambda done, total: calls.append((done, total)))
+    assert 0 == calls[0][0]
+    assert last == calls[-1]
+
+    class Stop(Exception):
+        pass
+
+    # Stopping in the second half, which is the pilot run with variance reduction
+    def stop(done, total):
+        if done > last[0] // 2:
+            raise Stop()
+
+    with pytest.raises(Stop):
+        run_simulation(build_parser().parse_args(arguments + ['--seed', '1', '--engine', 'numpy']), progress=stop)
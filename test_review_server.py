@@ -0,0 +1,173 @@
+import asyncio
+import json
+
+import pytest
+
+from review_game import build_parser, run_simulation, generate_corpus
+from review_server import LRUCache, parse_job_args, SimulationServer, _result_cache_key
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert 1 == cache.get('a')
+    cache.put('c', 3)
+    # 'b' was the least recently used
+    assert cache.get('b') is None
+    assert 1 == cache.get('a') and 3 == cache.get('c')
+    assert {'size': 2, 'capacity': 2, 'hits': 3, 'misses': 1} == cache.stats()
+
+
+def test_parse_job_args():
+    assert build_parser().parse_args([]) == parse_job_args({})
+
+    args = parse_job_args({'sample_sizes': [5, '10'], 'seed': 3, 'engine': 'numpy', 'per_bin_accuracy': True,
+                           'production': [1, 2, 3, 4, 5]})
+    assert build_parser().parse_args(['--sample-sizes', '5', '10', '--seed', '3', '--engine', 'numpy',
+                                      '--per-bin-accuracy', '--production', '1', '2', '3', '4', '5']) == args
+
+    for params in ({'sed': 3}, {'workers': 4}, {'store': 'runs'}, {'engine': 'fortran'}, {'sample_sizes': 5},
+                   {'exact': 'yes'}, {'population': 'many'}, {'population': [1]}, {'seed': {}},
+                   {'payoffs_file': 5}, {'payoffs_file': '/nonexistent'}, {'corpus': '/nonexistent'},
+                   ['--seed', '3']):
+        with pytest.raises(ValueError):
+            parse_job_args(params)
+
+
+def test__result_cache_key(tmpdir):
+    payoffs = tmpdir.join('payoffs.csv')
+    payoffs.write('.5,1.2,1\n')
+    corpus = str(tmpdir.join('populations.corpus'))
+    generate_corpus(corpus, performance_bins=[5, 10, 50, 25, 10], population_size=200, num_repetitions=5, seed=1)
+    args = parse_job_args({'seed': 1, 'payoffs_file': str(payoffs), 'corpus': corpus, 'num_repetitions': 5})
+
+    key = _result_cache_key(args)
+    assert key == _result_cache_key(args)
+    payoffs.write('0,1,.5\n')
+    assert key != _result_cache_key(args)
+
+    # A regenerated corpus gets a new key
+    key = _result_cache_key(args)
+    generate_corpus(corpus, performance_bins=[5, 10, 50, 25, 10], population_size=200, num_repetitions=5, seed=2)
+    assert key != _result_cache_key(args)
+
+
+async def _request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = json.dumps(body).encode('utf-8') if body is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n'.format(method, path, len(data))
+                 .encode('latin-1') + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    status = int(head.split(b' ')[1])
+    if b'Transfer-Encoding: chunked' in head:
+        lines = []
+        while True:
+            size, _, body = body.partition(b'\r\n')
+            if not int(size, 16):
+                break
+            lines.append(json.loads(body[:int(size, 16)]))
+            body = body[int(size, 16) + 2:]
+        return status, lines
+    return status, json.loads(body)
+
+
+def test_server():
+    params = {'seed': 1, 'engine': 'numpy', 'sample_sizes': [5, 20], 'num_repetitions': 600}
+    expected = json.loads(json.dumps(run_simulation(parse_job_args(params))))
+
+    async def run():
+        server = SimulationServer(workers=2)
+        port = await server.start(port=0)
+        try:
+            status, job = await _request(port, 'POST', '/run', params)
+            assert 200 == status
+            assert 'done' == job['status']
+            assert (600, 600) == (job['done'], job['total'])
+            assert expected == job['result']
+            assert 2 == len(server.labels)
+
+            # Seeded results and the label tables are reused
+            status, job = await _request(port, 'POST', '/run', params)
+            assert expected == job['result']
+            assert 1 == server.results.hits
+            status, job = await _request(port, 'POST', '/run', dict(params, num_repetitions=300))
+            assert 2 == server.labels.hits
+
+            # Random label tables aren't cached
+            oversample = dict(params, label_strategy='oversample')
+            status, job = await _request(port, 'POST', '/run', oversample)
+            assert json.loads(json.dumps(run_simulation(parse_job_args(oversample)))) == job['result']
+            assert 2 == len(server.labels)
+
+            # Progress is streamed until the job finishes
+            status, job = await _request(port, 'POST', '/jobs', dict(params, seed=2))
+            assert 202 == status
+            status, events = await _request(port, 'GET', '/jobs/{}/events'.format(job['id']))
+            assert 200 == status
+            assert [0, 256, 512, 600] == [event['done'] for event in events if event['status'] == 'running'][-4:]
+            assert 'done' == events[-1]['status'] and events[-1]['result']
+
+            # Cancel a running job, and the job queued behind it
+            _, running = await _request(port, 'POST', '/jobs', dict(params, num_repetitions=10 ** 7))
+            _, queued = await _request(port, 'POST', '/jobs', dict(params, seed=3))
+            _, job = await _request(port, 'DELETE', '/jobs/{}'.format(queued['id']))
+            assert 'cancelled' == job['status']
+            await _request(port, 'DELETE', '/jobs/{}'.format(running['id']))
+            _, events = await _request(port, 'GET', '/jobs/{}/events'.format(running['id']))
+            assert 'cancelled' == events[-1]['status']
+
+            # The sentence --optimize prints to stderr comes with the result
+            optimize = {'seed': 1, 'optimize': True, 'sample_sizes': [100, 101], 'num_repetitions': 5,
+                        'max_repetitions': 10}
+            notes = []
+            rows = json.loads(json.dumps(run_simulation(parse_job_args(optimize), notes=notes)))
+            _, job = await _request(port, 'POST', '/run', optimize)
+            assert (rows, notes) == (job['result'], job['notes'])
+            assert [] == (await _request(port, 'POST', '/run', params))[1]['notes']
+
+            status, stats = await _request(port, 'GET', '/stats')
+            assert {'queued': 0, 'running': 0, 'done': 7, 'failed': 0, 'cancelled': 2} == stats['jobs']
+
+            assert (400, {'error': 'Unknown parameter: sed'}) == await _request(port, 'POST', '/jobs', {'sed': 1})
+            assert 400 == (await _request(port, 'POST', '/jobs', {'population': [1]}))[0]
+            assert 400 == (await _request(port, 'POST', '/jobs', {'payoffs_file': '/nonexistent', 'seed': 1}))[0]
+            assert 404 == (await _request(port, 'GET', '/jobs/100'))[0]
+            assert 405 == (await _request(port, 'PUT', '/jobs'))[0]
+
+            _, job = await _request(port, 'POST', '/run', {'levels': [8, 64], 'exact': True})
+            assert 'failed' == job['status']
+
+            # Unexpected errors are reported, not dropped with the connection
+            stats = server.stats
+            server.stats = lambda: 1 / 0
+            assert (500, {'error': 'ZeroDivisionError: division by zero'}) == await _request(port, 'GET', '/stats')
+            server.stats = stats
+        finally:
+            await server.stop()
+
+    asyncio.run(run())
+
+
+def test_server_job_history():
+    async def run():
+        server = SimulationServer(workers=1, job_history_size=2)
+        port = await server.start(port=0)
+        try:
+            jobs = [(await _request(port, 'POST', '/run', {'exact': True, 'population': population}))[1]
+                    for population in (10, 20, 30)]
+            assert ['done'] * 3 == [job['status'] for job in jobs]
+
+            # Only the last two finished jobs are kept
+            assert 404 == (await _request(port, 'GET', '/jobs/{}'.format(jobs[0]['id'])))[0]
+            assert 404 == (await _request(port, 'DELETE', '/jobs/{}'.format(jobs[0]['id'])))[0]
+            assert jobs[1:] == [(await _request(port, 'GET', '/jobs/{}'.format(job['id'])))[1] for job in jobs[1:]]
+            assert 2 == (await _request(port, 'GET', '/stats'))[1]['jobs']['done']
+        finally:
+            await server.stop()
+
+    asyncio.run(run())
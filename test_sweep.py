@@ -0,0 +1,83 @@
+import csv
+
+import pytest
+
+import sweep
+from review_game import _sample_labels_calculator
+from sweep import expand_grid, run_sweep, ResultCache, run_cell
+
+SPEC = {'performance_bins': [[5, 10, 50, 25, 10]], 'rating_bins': [[5, 10, 50, 25, 10], [10, 20, 40, 20, 10]],
+        'population': [20], 'sample_sizes': [5, 8], 'num_repetitions': 10, 'seed': 3}
+
+
+def test_expand_grid():
+    cells = expand_grid(SPEC)
+    assert 4 == len(cells)
+    assert [5, 8, 5, 8] == [cell['sample_size'] for cell in cells]
+    assert 10 == cells[0]['num_repetitions'] and 'python' == cells[0]['engine']
+
+    cells = expand_grid({'performance_bins': [[50]], 'rating_bins': [[50]], 'population': [40]})
+    assert [5, 10, 20, 40] == [cell['sample_size'] for cell in cells]
+
+    with pytest.raises(ValueError):
+        expand_grid(dict(SPEC, sample_size=[5]))
+
+
+def test_run_cell_cache(tmpdir, monkeypatch):
+    cache = ResultCache(str(tmpdir))
+    cell = expand_grid(SPEC)[1]
+
+    rows = run_cell(cell, cache)
+    assert rows == cache.get_result(cell)
+    get_sample_labels = _sample_labels_calculator(population_size=20, bins=cell['rating_bins'])
+    assert {8: get_sample_labels(sample_size=8), 4: get_sample_labels(sample_size=4)} == \
+        cache.get_sample_labels(cell, [8, 4, 3])
+    assert rows == run_cell(cell, cache)
+
+    # Results of another version of the simulation aren't replayed
+    monkeypatch.setattr(sweep, 'RESULT_VERSION', sweep.RESULT_VERSION + 1)
+    assert cache.get_result(cell) is None
+    monkeypatch.undo()
+
+    # Random label tables depend on what else the cell calculated, so they aren't cached
+    cell = dict(cell, label_strategy='oversample')
+    run_cell(cell, cache)
+    assert {} == cache.get_sample_labels(cell, [8, 4, 3])
+
+
+def test_run_sweep(tmpdir, monkeypatch):
+    output = str(tmpdir.join('sweep.csv'))
+    cache_dir = str(tmpdir.join('cache'))
+
+    assert 4 == run_sweep(SPEC, output, cache_dir)
+    with open(output) as f:
+        rows = list(csv.reader(f))
+    assert 4 == len(rows)
+    assert ['5 10 50 25 10', '10 20 40 20 10', '20', '1.05 1.1 1.15 1.2 1.25', '8', '0.5', '1.2', '1'] == \
+        rows[-1][1:9]
+
+    # Nothing left to run
+    assert 0 == run_sweep(SPEC, output, cache_dir)
+
+    # An interrupted sweep only runs the missing cells, and cached cells aren't simulated again
+    with open(output, 'w', newline='') as f:
+        csv.writer(f).writerows(rows[:1])
+    monkeypatch.setattr(sweep, 'simulate_ratings', None)
+    assert 3 == run_sweep(SPEC, output, cache_dir)
+    with open(output) as f:
+        assert rows == list(csv.reader(f))
+
+    # A cell with only some of its rows, and a cut off last line, are run again
+    spec = dict(SPEC, payoffs=[[.5, 1.2, 1], [0, 1, 0]])
+    output = str(tmpdir.join('payoffs.csv'))
+    monkeypatch.undo()
+    assert 4 == run_sweep(spec, output, cache_dir)
+    with open(output, newline='') as f:
+        lines = f.readlines()
+    assert 8 == len(lines)
+    with open(output, 'w', newline='') as f:
+        f.writelines(lines[:3] + [lines[3][:20]])
+    monkeypatch.setattr(sweep, 'simulate_ratings', None)
+    assert 3 == run_sweep(spec, output, cache_dir)
+    with open(output, newline='') as f:
+        assert lines == f.readlines()